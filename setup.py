@@ -36,10 +36,15 @@ module_ceres = Extension('tractor._ceres',
                          swig_opts=['-c++'],
                          )
 
+# The rendering kernels use OpenMP; set NO_OPENMP=1 to build without.
+openmp = [] if os.environ.get('NO_OPENMP') else ['-fopenmp']
+
 module_mix = Extension('tractor._mix',
                        sources = ['tractor/mix.i'],
                        include_dirs = numpy_inc,
                        extra_objects = [],
+                       extra_compile_args = openmp,
+                       extra_link_args = openmp,
                        undef_macros=['NDEBUG'],
     )
 #extra_compile_args=['-O0','-g'],
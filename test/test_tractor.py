@@ -9,6 +9,22 @@ from tractor.sdss import *
 from tractor.galaxy import *
 from tractor.ceres_optimizer import CeresOptimizer
 
+def make_psfex_model(bases, degree, x0=100., y0=200.):
+    '''
+    Returns a PsfExModel with the given N x 25 x 25 eigen-images, for
+    a polynomial of the given degree centered at (x0, y0) and scaled
+    by the same amounts.
+    '''
+    from tractor.psfex import PsfExModel
+    psfex = PsfExModel()
+    psfex.degree = degree
+    psfex.psfbases = bases
+    psfex.x0, psfex.y0 = x0, y0
+    psfex.xscale, psfex.yscale = x0, y0
+    psfex.radius = 13.
+    psfex.sampling = 1.
+    return psfex
+
 class TractorTest(unittest.TestCase):
     def test_expgal(self):
         ra,dec = 123., 45.
@@ -87,6 +103,1085 @@ class TractorTest(unittest.TestCase):
             tr.optimize_forced_photometry()
             print 'star', star
 
-        
+    def test_version_stamps(self):
+        import pickle
+        tim = Image(data=np.zeros((10,10)), invvar=np.ones((10,10)),
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+        src = PointSource(PixPos(5, 5), Flux(100.))
+        tr = Tractor([tim], [src])
+
+        v = tr.getVersion()
+        self.assertFalse(tr.changedSince(v))
+        vs = src.getVersion()
+        src.pos.x = 6.
+        self.assertTrue(src.changedSince(vs))
+        self.assertTrue(tr.changedSince(v))
+        self.assertFalse(tim.changedSince(v))
+
+        v = tr.getVersion()
+        tim.sky.setParams([1.])
+        self.assertTrue(tr.changedSince(v))
+
+        # changes made outside the setters bump the version too
+        tim.psf = GaussianMixturePSF(1., 0., 0., 2., 2., 0.)
+        v = tr.getVersion()
+        tim.psf.shiftBy(0.5, 0.)
+        self.assertTrue(tr.changedSince(v))
+
+        v = tr.getVersion()
+        tr.setParams(tr.getParams())
+        self.assertTrue(tr.changedSince(v))
+
+        src2 = PointSource(PixPos(1, 1), Flux(10.))
+        tr.addSource(src2)
+        v = tr.getVersion()
+        src2.brightness.setParams([20.])
+        self.assertTrue(tr.changedSince(v))
+        tr.removeSource(src2)
+        v = tr.getVersion()
+        src2.brightness.setParams([30.])
+        self.assertFalse(tr.changedSince(v))
+
+        # Parent links survive pickling
+        tr2 = pickle.loads(pickle.dumps(tr, -1))
+        v = tr2.getVersion()
+        tr2.catalog[0].brightness.setParams([1.])
+        self.assertTrue(tr2.changedSince(v))
+
+    def test_packed_params(self):
+        def make():
+            tim = Image(data=np.zeros((50,50)), invvar=np.ones((50,50)),
+                        psf=NCircularGaussianPSF([1.5], [1.]),
+                        photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+            srcs = [PointSource(PixPos(10, 10), Flux(100.)),
+                    ExpGalaxy(RaDecPos(1., 2.), NanoMaggies(r=3., g=4.),
+                              EllipseESoft(1., 0.1, 0.2)),
+                    FixedCompositeGalaxy(PixPos(20, 20), Flux(5.),
+                                         SoftenedFracDev(0.3),
+                                         EllipseESoft(1., 0.1, 0.2),
+                                         EllipseESoft(2., 0.1, 0.2))]
+            return Tractor([tim], srcs)
+        tr1 = make()
+        tr2 = make()
+        tr2.setPackedParams()
+
+        def check():
+            self.assertEqual(tr1.numberOfParams(), tr2.numberOfParams())
+            self.assertEqual(tr1.getParamNames(), tr2.getParamNames())
+            self.assertEqual(tr1.getParams(), tr2.getParams())
+            self.assertEqual(tr1.getAllParams(), tr2.getAllParams())
+        check()
+
+        p = np.array(tr1.getParams()) + 0.01
+        v = tr2.getVersion()
+        tr1.setParams(p)
+        tr2.setParams(p)
+        check()
+        self.assertTrue(tr2.changedSince(v))
+        # setting the same values is not a change
+        v = tr2.getVersion()
+        tr2.setParams(p)
+        self.assertFalse(tr2.changedSince(v))
+
+        for i in [0, 2, 5]:
+            self.assertEqual(tr1.setParam(i, 7.), tr2.setParam(i, 7.))
+            check()
+
+        for tr in [tr1, tr2]:
+            tr.freezeParam('images')
+            tr.catalog[1].freezeParam('brightness')
+        check()
+        # setting leaf params directly is seen in the packed storage
+        for tr in [tr1, tr2]:
+            tr.catalog[0].pos.x = 33.
+            tr.addSource(PointSource(PixPos(1, 1), Flux(1.)))
+        check()
+
+        tr2.setPackedParams(False)
+        check()
+
+        # SplineSky's params are its spline coefficients
+        from tractor.splinesky import SplineSky
+        grid = np.linspace(0., 50., 5)
+        tim = Image(data=np.zeros((50,50)), invvar=np.ones((50,50)),
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    photocal=LinearPhotoCal(1.),
+                    sky=SplineSky(grid, grid, np.ones((5,5))))
+        tr = Tractor([tim], [PointSource(PixPos(10, 10), Flux(100.))])
+        tr.setPackedParams()
+        tim.sky.setParams(np.array(tim.sky.getParams()) + 5.)
+        self.assertTrue(np.allclose(tr.getModelImage(0)[40,40], 6.))
+        p = np.array(tr.getParams())
+        I = [i for i,nm in enumerate(tr.getParamNames())
+             if nm.startswith('images.image0.sky.')]
+        p[I] -= 3.
+        tr.setParams(p)
+        self.assertTrue(np.allclose(tr.getModelImage(0)[40,40], 3.))
+        self.assertEqual(tr.getParams(), p.tolist())
+
+    def test_incremental_models(self):
+        W,H = 60,50
+        np.random.seed(42)
+        tim = Image(data=np.random.normal(size=(H,W)).astype(np.float32),
+                    invvar=np.ones((H,W)),
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+        srcs = [PointSource(PixPos(10, 10), Flux(100.)),
+                PointSource(PixPos(40, 30), Flux(50.)),
+                PointSource(PixPos(30, 20), Flux(200.))]
+        tr1 = Tractor([tim], srcs)
+        tr2 = Tractor([tim], srcs)
+        tr2.setIncrementalModels()
+
+        def check():
+            self.assertAlmostEqual(tr1.getLogLikelihood(),
+                                   tr2.getLogLikelihood(), places=4)
+            self.assertTrue(np.allclose(tr1.getModelImage(0),
+                                        tr2.getModelImage(0), atol=1e-5))
+            self.assertTrue(np.allclose(tr1.getChiImage(0),
+                                        tr2.getChiImage(0), atol=1e-5))
+        check()
+        # move one source
+        srcs[0].pos.x = 12.3
+        check()
+        # change a flux
+        srcs[2].brightness.setParams([20.])
+        check()
+        # remove a source
+        tr1.removeSource(srcs[1])
+        tr2.removeSource(srcs[1])
+        check()
+        # change the image (forces a rebuild)
+        tim.sky.setParams([1.])
+        check()
+        # emcee-style call
+        p = tr1.getParams()
+        self.assertAlmostEqual(tr1(p), tr2(p), places=4)
+        # model, chi and likelihood share one incremental state
+        self.assertEqual(len(tr2.incremental), 1)
+        # optimizer step: the line search calls getLogProb after setParams
+        getlnp = tr2.getLogProb
+        nlnp = [0]
+        def checked():
+            lnp = getlnp()
+            self.assertAlmostEqual(lnp, tr1.getLogProb(), places=4)
+            nlnp[0] += 1
+            return lnp
+        tr2.getLogProb = checked
+        tr2.optimize()
+        self.assertTrue(nlnp[0] > 0)
+        check()
+        self.assertEqual(len(tr2.incremental), 1)
+
+    def test_logprob_batch(self):
+        W,H = 40,40
+        np.random.seed(42)
+        tim = Image(data=np.random.normal(size=(H,W)).astype(np.float32),
+                    invvar=np.ones((H,W)),
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(0.5))
+        srcs = [PointSource(PixPos(10, 10), Flux(100.)),
+                ExpGalaxy(PixPos(25, 20), Flux(50.),
+                          EllipseESoft(0.5, 0.1, 0.2)),
+                PointSource(PixPos(30, 30), Flux(200.))]
+        tr = Tractor([tim], srcs)
+        tr.freezeParam('images')
+        srcs[2].freezeAllParams()
+        p0 = np.array(tr.getParams())
+
+        X = p0 + 0.1 * np.random.normal(size=(5, len(p0)))
+        # rows that differ only in fluxes
+        X[3] = p0
+        X[4] = p0
+        X[4, tr.getParamNames().index('catalog.source0.brightness.Flux')] = 120.
+        lnp = tr.getLogProbBatch(X)
+        self.assertTrue(np.allclose(tr.getParams(), p0))
+        for x,l in zip(X, lnp):
+            self.assertAlmostEqual(tr(x), l, places=3)
+        tr.setParams(p0)
+
+        # only fluxes thawed
+        for src in srcs[:2]:
+            src.freezeAllBut('brightness')
+        p0 = np.array(tr.getParams())
+        X = p0 * np.array([[1.], [1.1], [0.5]])
+        lnp = tr.getLogProbBatch(X)
+        for x,l in zip(X, lnp):
+            self.assertAlmostEqual(tr(x), l, places=3)
+
+    def test_blobs(self):
+        import multiprocessing
+        from tractor.blobs import find_blobs
+
+        W,H = 100,60
+        psf = NCircularGaussianPSF([1.5], [1.])
+        truth = [PointSource(PixPos(20, 20), Flux(100.)),
+                 PointSource(PixPos(24, 22), Flux(80.)),
+                 PointSource(PixPos(70, 40), Flux(120.)),
+                 PointSource(PixPos(50, 10), Flux(90.))]
+        tim = Image(data=np.zeros((H,W), np.float32),
+                    invvar=np.ones((H,W)) * 100.,
+                    psf=psf, photocal=LinearPhotoCal(1.),
+                    sky=ConstantSky(0.))
+        tim.data = Tractor([tim], truth).getModelImage(0)
+        tim.modelMinval = 1e-3
+
+        def make():
+            srcs = [src.copy() for src in truth]
+            for src in srcs:
+                src.pos.x += 0.3
+                src.pos.y -= 0.2
+                src.brightness.setParams([src.brightness.getValue() * 1.1])
+            tr = Tractor([tim], srcs)
+            tr.freezeParam('images')
+            # frozen sources are carried along, but not fit
+            srcs[3].freezeAllParams()
+            return tr
+
+        tr = make()
+        blobs = find_blobs(tr)
+        self.assertEqual(sorted([b.srcs for b in blobs]), [[0, 1], [2]])
+
+        pool = multiprocessing.Pool(2)
+        for mp in [None, pool]:
+            tr = make()
+            R = tr.optimize_blobs(mp=mp)
+            self.assertEqual(len(R), 2)
+            for src,true in zip(tr.catalog[:3], truth[:3]):
+                self.assertTrue(np.allclose(src.getParams(), true.getParams(),
+                                            atol=1e-3))
+            self.assertAlmostEqual(tr.catalog[3].getAllParams()[0], 50.3)
+        pool.close()
+        pool.join()
+
+    def test_source_index(self):
+        W,H = 300,200
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                    psf=NCircularGaussianPSF([1.], [1.]),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+        tim.modelMinval = 1e-3
+        np.random.seed(17)
+        srcs = [PointSource(PixPos(x, y), Flux(10.)) for x,y in
+                zip(np.random.uniform(0, W, 200), np.random.uniform(0, H, 200))]
+        tr = Tractor([tim], srcs)
+
+        def brute(x0, x1, y0, y1):
+            res = []
+            for src in tr.catalog:
+                p = tr.getModelPatch(tim, src)
+                if p is None or p.patch is None:
+                    continue
+                if p.overlapsBbox((x0, x1, y0, y1)):
+                    res.append(src)
+            return res
+
+        def check():
+            for box in [(0, W, 0, H), (10, 50, 20, 90), (100, 101, 100, 101),
+                        (250, 400, -10, 30)]:
+                self.assertEqual(tr.getSourcesInBox(tim, *box), brute(*box))
+            src = tr.catalog[3]
+            x,y = int(src.pos.x), int(src.pos.y)
+            self.assertTrue(src in tr.getSourcesAtPoint(tim, x, y))
+            self.assertEqual(tr.getSourcesAtPoint(tim, x, y),
+                             brute(x, x+1, y, y+1))
+            p = tr.getModelPatch(tim, src)
+            near = [s for s in brute(*p.getExtent()) if s is not src]
+            self.assertEqual(tr.getOverlappingSources(tim, src), near)
+        check()
+        # move sources
+        srcs[3].pos.x = 150.5
+        srcs[3].pos.y = 100.5
+        srcs[10].pos.setParams([20., 20.])
+        check()
+        tr.removeSource(srcs[5])
+        tr.addSource(PointSource(PixPos(150, 101), Flux(5.)))
+        check()
+
+    def test_matrix_free_update(self):
+        from tractor.lsqr_optimizer import LsqrOptimizer
+        np.random.seed(3)
+        tims = []
+        for k in range(2):
+            W,H = 80,60
+            tims.append(Image(data=np.random.normal(size=(H,W)).astype(np.float32),
+                              invvar=np.random.uniform(0.5, 2., size=(H,W)),
+                              psf=NCircularGaussianPSF([1.5 + k], [1.]),
+                              photocal=LinearPhotoCal(1.), sky=ConstantSky(0.)))
+        srcs = [ExpGalaxy(PixPos(20, 30), Flux(100.), EllipseESoft(1., 0.1, 0.1)),
+                PointSource(PixPos(-2, 10), Flux(50.)),
+                PointSource(PixPos(60, 40), Flux(30.))]
+        tr = Tractor(tims, srcs)
+        tr.freezeParam('images')
+        opt = LsqrOptimizer()
+        for kw in [dict(), dict(shared_params=False), dict(scale_columns=False)]:
+            X1 = opt.getUpdateDirection(tr, tr.getDerivs(), **kw)
+            X2 = opt.getUpdateDirection(tr, tr.getDerivs(), matrix_free=True,
+                                        **kw)
+            self.assertTrue(np.allclose(X1, X2, rtol=1e-4,
+                                        atol=1e-6 * np.abs(X1).max()))
+        s1 = opt.getUpdateDirection(tr, tr.getDerivs(), scales_only=True)
+        s2 = opt.getUpdateDirection(tr, tr.getDerivs(), scales_only=True,
+                                    matrix_free=True)
+        self.assertTrue(np.allclose(s1, s2))
+
+        tr.optimizer = LsqrOptimizer(matrix_free=True)
+        lnp0 = tr.getLogProb()
+        tr.optimize_loop()
+        self.assertTrue(tr.getLogProb() > lnp0)
+
+    def test_jacobian_structure_reuse(self):
+        from tractor.lsqr_optimizer import LsqrOptimizer
+        W,H = 60,50
+        np.random.seed(5)
+        tim = Image(data=np.random.normal(size=(H,W)).astype(np.float32),
+                    invvar=np.ones((H,W)),
+                    psf=GaussianMixturePSF(1., 0., 0., 2.25, 2.25, 0.),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+        srcs = [ExpGalaxy(PixPos(20, 20), Flux(100.), EllipseESoft(1., 0.1, 0.1)),
+                PointSource(PixPos(25, 22), Flux(50.))]
+        tr = Tractor([tim], srcs)
+        tr.freezeParam('images')
+        masks = [dict([(src, Patch(20-8, 20-8, np.ones((17,17), bool)))
+                       for src in srcs])]
+        tr.setModelMasks(masks)
+
+        opt1 = LsqrOptimizer(reuse_structure=False)
+        opt2 = LsqrOptimizer()
+        for step in range(3):
+            A1 = opt1.getUpdateDirection(tr, tr.getDerivs(), get_A_matrix=True)
+            A2 = opt2.getUpdateDirection(tr, tr.getDerivs(), get_A_matrix=True)
+            S = opt2._jstructure
+            if step > 0:
+                # footprints unchanged -> structure reused
+                self.assertTrue(S is S0)
+            S0 = S
+            self.assertTrue(np.allclose(A1.toarray(), A2.toarray()))
+            tr.setParams(np.array(tr.getParams()) + 0.1)
+        # new footprint -> new structure
+        tr.setModelMasks(None)
+        A1 = opt1.getUpdateDirection(tr, tr.getDerivs(), get_A_matrix=True)
+        A2 = opt2.getUpdateDirection(tr, tr.getDerivs(), get_A_matrix=True)
+        self.assertFalse(opt2._jstructure is S0)
+        self.assertTrue(np.allclose(A1.toarray(), A2.toarray()))
+
+    def test_update_solvers(self):
+        from tractor.lsqr_optimizer import LsqrOptimizer
+        W,H = 60,50
+        np.random.seed(7)
+        tims = [Image(data=np.random.normal(size=(H,W)).astype(np.float32),
+                      invvar=np.random.uniform(0.5, 2., size=(H,W)),
+                      psf=NCircularGaussianPSF([1.5 + k], [1.]),
+                      photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+                for k in range(2)]
+        srcs = [ExpGalaxy(PixPos(20, 20), Flux(100.), EllipseESoft(1., 0.1, 0.1)),
+                PointSource(PixPos(25, 22), Flux(50.)),
+                PointSource(PixPos(45, 30), Flux(20.))]
+        tr = Tractor(tims, srcs)
+        tr.freezeParam('images')
+        opt = LsqrOptimizer()
+        X0,V0 = opt.getUpdateDirection(tr, tr.getDerivs(), variance=True,
+                                       solver='dense')
+        self.assertEqual(opt.lastSolve['solver'], 'dense')
+        for solver in ['sparse', 'lsqr', 'lsmr', 'auto']:
+            for damp in [0., 1e-3]:
+                X,V = opt.getUpdateDirection(tr, tr.getDerivs(), variance=True,
+                                             solver=solver, damp=damp)
+                self.assertTrue(np.allclose(X, X0, rtol=1e-3,
+                                            atol=1e-5 * np.abs(X0).max()))
+                if solver in ['sparse', 'auto']:
+                    self.assertTrue(np.allclose(V, V0, rtol=1e-3))
+        self.assertEqual(opt.lastSolve['solver'], 'dense')
+        self.assertEqual(opt.solveStats['lsqr'][0], 2)
+
+        # degenerate: two identical sources -> the normal equations
+        # are singular, and 'auto' falls back to an iterative solver.
+        tr = Tractor(tims, [PointSource(PixPos(25, 22), Flux(50.)),
+                            PointSource(PixPos(25, 22), Flux(50.))])
+        tr.freezeParam('images')
+        X = opt.getUpdateDirection(tr, tr.getDerivs())
+        self.assertEqual(opt.lastSolve['solver'], 'lsmr')
+        self.assertTrue(np.all(np.isfinite(X)))
+
+    def test_linearized_line_search(self):
+        from tractor.lsqr_optimizer import LsqrOptimizer
+        W,H = 80,80
+        np.random.seed(3)
+        psf = NCircularGaussianPSF([1.5], [1.])
+        truth = [ExpGalaxy(PixPos(30, 40), Flux(500.), EllipseESoft(0.5, 0.2, 0.1)),
+                 PointSource(PixPos(50, 35), Flux(200.))]
+        tim = Image(data=np.zeros((H,W), np.float32), invvar=np.ones((H,W)),
+                    psf=psf, photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+        tim.data = (Tractor([tim], truth).getModelImage(0) +
+                    np.random.normal(size=(H,W))).astype(np.float32)
+        nlnp = {}
+        lnp = {}
+        for ls in ['ladder', 'linear']:
+            srcs = [src.copy() for src in truth]
+            for src in srcs:
+                src.pos.x += 0.7
+                src.pos.y -= 0.5
+                src.brightness.setParams([0.7 * src.brightness.getValue()])
+            tr = Tractor([tim], srcs, optimizer=LsqrOptimizer(linesearch=ls))
+            tr.freezeParam('images')
+            calls = [0]
+            getlnp = tr.getLogProb
+            def counted():
+                calls[0] += 1
+                return getlnp()
+            tr.getLogProb = counted
+            tr.optimize_loop()
+            nlnp[ls] = calls[0]
+            lnp[ls] = getlnp()
+        self.assertTrue(abs(lnp['linear'] - lnp['ladder']) < 1e-3)
+        self.assertTrue(5 * nlnp['linear'] <= nlnp['ladder'])
+
+    def test_galaxy_analytic_derivs(self):
+        from tractor.ellipses import EllipseE
+        W,H = 40,40
+        tim = Image(data=np.zeros((H,W), np.float32), invvar=np.ones((H,W)),
+                    psf=GaussianMixturePSF(1., 0., 0., 2.25, 2.25, 0.5),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+        for shape in [EllipseESoft(0.5, 0.2, -0.3), EllipseE(2., 0.3, 0.2),
+                      EllipseE(2., 0., 0.)]:
+            gal = ExpGalaxy(PixPos(20.3, 18.6), Flux(100.), shape)
+            tr = Tractor([tim], [gal])
+            derivs = gal.getParamDerivatives(tim)
+            self.assertEqual(len(derivs), gal.numberOfParams())
+            p0 = gal.getParams()
+            for i,deriv in enumerate(derivs):
+                step = 1e-4 * max(1., abs(p0[i]))
+                mods = []
+                # (one-sided: EllipseE is not differentiable at e = 0)
+                for s in [step, 0.]:
+                    gal.setParam(i, p0[i] + s)
+                    mods.append(tr.getModelImage(0).astype(float))
+                fd = (mods[0] - mods[1]) / step
+                d = np.zeros((H,W))
+                deriv.addTo(d)
+                self.assertTrue(np.abs(d - fd).max() < 1e-2 * np.abs(fd).max())
+
+    def test_galaxy_fft_derivs(self):
+        from tractor.psf import PixelizedPSF
+        yy,xx = np.mgrid[-12:13, -12:13]
+        pim = np.exp(-0.5 * (xx**2 + 0.8*yy**2 + 0.3*xx*yy) / 2.**2)
+        pim /= pim.sum()
+        W,H = 60,60
+        tim = Image(data=np.zeros((H,W), np.float32), invvar=np.ones((H,W)),
+                    psf=PixelizedPSF(pim),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+        gal = ExpGalaxy(PixPos(30.3, 28.6), Flux(1.),
+                        EllipseESoft(0.5, 0.2, -0.3))
+        derivs = gal.getParamDerivatives(tim)
+        self.assertEqual(len(derivs), gal.numberOfParams())
+        p0 = gal.getParams()
+        patch0 = gal.getUnitFluxModelPatch(tim)
+        step = 1e-5
+        # skip the brightness (index 2); compare unit-flux patches directly
+        for i in [0, 1, 3, 4, 5]:
+            mods = []
+            for s in [step, -step]:
+                gal.setParam(i, p0[i] + s)
+                x,y = tim.getWcs().positionToPixel(gal.getPosition())
+                mods.append(gal._realGetUnitFluxModelPatch(
+                    tim, x, y, 0., extent=patch0.getExtent()).patch)
+            gal.setParams(p0)
+            fd = (mods[0] - mods[1]) / (2. * step)
+            self.assertTrue(np.abs(derivs[i].patch - fd).max()
+                            < 1e-6 * np.abs(fd).max())
+
+    def test_sersic_derivs(self):
+        from tractor.sersic import SersicMixture, SersicGalaxy, SersicIndex
+        from tractor.psf import PixelizedPSF
+        mix = SersicMixture()
+        for n in [0.6, 0.93, 2.5, 4.01, 6.2]:
+            (amps,vars),(damps,dvars) = mix._lookup(n)
+            self.assertTrue(np.allclose(amps, [f(n) for f in mix.amps],
+                                        rtol=1e-8))
+            self.assertTrue(np.allclose(vars, [f(n) for f in mix.vars],
+                                        rtol=1e-8))
+            self.assertTrue(np.allclose(damps, [f(n, 1) for f in mix.amps],
+                                        rtol=1e-6))
+            self.assertTrue(np.allclose(dvars, [f(n, 1) for f in mix.vars],
+                                        rtol=1e-6))
+
+        yy,xx = np.mgrid[-12:13, -12:13]
+        pim = np.exp(-0.5 * (xx**2 + 0.8*yy**2 + 0.3*xx*yy) / 2.**2)
+        pim /= pim.sum()
+        W,H = 60,60
+        for psf in [GaussianMixturePSF(1., 0., 0., 2.25, 2.25, 0.5),
+                    PixelizedPSF(pim)]:
+            tim = Image(data=np.zeros((H,W), np.float32),
+                        invvar=np.ones((H,W)), psf=psf,
+                        photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+            gal = SersicGalaxy(PixPos(30.3, 28.6), Flux(1.),
+                               EllipseESoft(0.5, 0.2, -0.3), SersicIndex(2.3))
+            derivs = gal.getParamDerivatives(tim)
+            self.assertEqual(len(derivs), gal.numberOfParams())
+            patch0 = gal.getUnitFluxModelPatch(tim)
+            x,y = tim.getWcs().positionToPixel(gal.getPosition())
+            step = 1e-4
+            mods = []
+            for s in [step, -step]:
+                gal.sersicindex.setValue(2.3 + s)
+                mods.append(gal._realGetUnitFluxModelPatch(
+                    tim, x, y, 0., extent=patch0.getExtent()).patch)
+            gal.sersicindex.setValue(2.3)
+            fd = (mods[0] - mods[1]) / (2. * step)
+            d = derivs[-1]
+            self.assertEqual(d.getExtent(), patch0.getExtent())
+            self.assertTrue(np.abs(d.patch - fd).max()
+                            < 1e-4 * np.abs(fd).max())
+
+    def test_composite_fused_derivs(self):
+        from tractor.psf import PixelizedPSF
+        yy,xx = np.mgrid[-12:13, -12:13]
+        pim = np.exp(-0.5 * (xx**2 + 0.8*yy**2 + 0.3*xx*yy) / 2.**2)
+        pim /= pim.sum()
+        W,H = 60,60
+        for psf in [GaussianMixturePSF(1., 0., 0., 2.25, 2.25, 0.5),
+                    PixelizedPSF(pim)]:
+            tim = Image(data=np.zeros((H,W), np.float32),
+                        invvar=np.ones((H,W)), psf=psf,
+                        photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+            tim.modelMinval = 0.
+            pos = PixPos(30.3, 28.6)
+            sexp = EllipseESoft(0.5, 0.2, -0.3)
+            sdev = EllipseESoft(0.1, -0.1, 0.2)
+            gals = [FixedCompositeGalaxy(pos, Flux(10.), 0.3, sexp, sdev),
+                    CompositeGalaxy(pos, Flux(3.), sexp, Flux(7.), sdev)]
+            for gal in gals:
+                for frozen in [None, 'pos', 'shapeExp']:
+                    gal.thawAllParams()
+                    if frozen is not None:
+                        gal.freezeParam(frozen)
+                    fused = gal.getParamDerivatives(tim)
+                    separate = gal._getComponentParamDerivatives(tim)
+                    self.assertEqual(len(fused), gal.numberOfParams())
+                    self.assertEqual(len(separate), gal.numberOfParams())
+                    for d1,d2 in zip(fused, separate):
+                        self.assertEqual(d1.name, d2.name)
+                        im1 = np.zeros((H,W))
+                        im2 = np.zeros((H,W))
+                        d1.addTo(im1)
+                        d2.addTo(im2)
+                        self.assertTrue(np.abs(im1 - im2).max()
+                                        < 1e-6 * np.abs(im2).max())
+            gal = gals[1]
+            gal.thawAllParams()
+            mod = np.zeros((H,W))
+            gal.getModelPatch(tim).addTo(mod)
+            mod2 = np.zeros((H,W))
+            for p in gal._getModelPatches(tim):
+                p.addTo(mod2)
+            self.assertTrue(np.abs(mod - mod2).max() < 1e-6 * mod2.max())
+
+    def test_batch_rendering(self):
+        W,H = 80,60
+        psf = GaussianMixturePSF(np.array([0.8, 0.2]), np.zeros((2,2)),
+                                 np.array([[[2., 0.3],[0.3, 2.5]],
+                                           [[8., 0.],[0., 8.]]]))
+        tim = Image(data=np.zeros((H,W), np.float32), invvar=np.ones((H,W)),
+                    psf=psf, photocal=LinearPhotoCal(1.),
+                    sky=ConstantSky(3.))
+        srcs = [PointSource(PixPos(10.3, 12.8), Flux(50.)),
+                PointSource(PixPos(-2.5, 30.), Flux(20.)),
+                ExpGalaxy(PixPos(40.2, 30.7), Flux(100.),
+                          EllipseESoft(0.5, 0.2, -0.1)),
+                FixedCompositeGalaxy(PixPos(70.6, 50.1), Flux(80.), 0.3,
+                                     EllipseESoft(0., 0.2, 0.1),
+                                     EllipseESoft(0.5, -0.1, 0.))]
+        tr = Tractor([tim], srcs)
+        mod0 = tr.getModelImage(0)
+        tr.setBatchRendering()
+        mod1 = tr.getModelImage(0)
+        self.assertTrue(np.abs(mod1 - mod0).max() < 1e-4)
+        self.assertTrue(np.abs(mod1.sum() - mod0.sum()) < 1e-2)
+
+        pxy = [(10.3, 12.8), (50.5, 40.1), (-30., 5.)]
+        patches = psf.getPointSourcePatches(pxy, minvals=[1e-4]*3,
+                                            extent=[0,W,0,H])
+        self.assertTrue(patches[2] is None)
+        for (px,py),p in zip(pxy[:2], patches[:2]):
+            p0 = psf.getPointSourcePatch(px, py, minval=1e-4,
+                                         extent=[0,W,0,H])
+            a = np.zeros((H,W))
+            b = np.zeros((H,W))
+            p.addTo(a)
+            p0.addTo(b)
+            self.assertTrue(np.abs(a - b).max() < 1e-4)
+
+    def test_render_threads(self):
+        W,H = 60,50
+        tim = Image(data=np.zeros((H,W), np.float32), invvar=np.ones((H,W)),
+                    psf=GaussianMixturePSF(1., 0., 0., 2.25, 2.25, 0.5),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(1.))
+        srcs = [PointSource(PixPos(10.3, 12.8), Flux(50.)),
+                PointSource(PixPos(40., 30.), Flux(20.)),
+                ExpGalaxy(PixPos(30.2, 20.7), Flux(100.),
+                          EllipseESoft(0.5, 0.2, -0.1)),
+                DevGalaxy(PixPos(50.6, 40.1), Flux(80.),
+                          EllipseESoft(0.3, -0.1, 0.))]
+        tr = Tractor([tim], srcs)
+        tr.freezeParam('images')
+        mod0 = tr.getModelImage(0)
+        derivs0 = tr.getDerivs()
+        tr.setRenderThreads(3)
+        mod1 = tr.getModelImage(0)
+        derivs1 = tr.getDerivs()
+        self.assertTrue(np.allclose(mod0, mod1, atol=1e-5))
+        self.assertEqual(len(derivs0), len(derivs1))
+        for d0,d1 in zip(derivs0, derivs1):
+            self.assertEqual(len(d0), len(d1))
+            for (p0,im0),(p1,im1) in zip(d0, d1):
+                self.assertEqual(p0.getExtent(), p1.getExtent())
+                self.assertTrue(np.all(p0.patch == p1.patch))
+
+    def test_single_precision(self):
+        from tractor.mixture_profiles import MixtureOfGaussians
+        mog = MixtureOfGaussians(np.array([0.7, 0.3]),
+                                 np.array([[2000.2, 1500.7], [2000.9, 1500.1]]),
+                                 np.array([[[4., 1.],[1., 3.]],
+                                           [[20., -2.],[-2., 15.]]]))
+        x0,x1,y0,y1 = 1970, 2030, 1480, 1520
+        pd = mog.evaluate_grid(x0, x1, y0, y1, 0.3, -0.2)
+        ps = mog.evaluate_grid(x0, x1, y0, y1, 0.3, -0.2, precision='single')
+        self.assertEqual(ps.patch.dtype, np.float32)
+        big = (pd.patch > 1e-4 * pd.patch.max())
+        self.assertTrue(np.max(np.abs(ps.patch - pd.patch)[big] /
+                               pd.patch[big]) < 1e-5)
+
+        mask = (np.arange((y1-y0)*(x1-x0)).reshape((y1-y0, x1-x0)) % 3) > 0
+        pm = mog.evaluate_grid_masked(x0, y0, mask, 0.3, -0.2, derivs=True,
+                                      precision='single')
+        pa = mog.evaluate_grid_approx3(x0, x1, y0, y1, 0.3, -0.2, 1e-6,
+                                       derivs=True, doslice=False)
+        self.assertTrue(np.all(pm[0].patch[~mask] == 0))
+        for a,m in zip(pa, pm):
+            self.assertTrue(np.abs((a.patch - m.patch)[mask]).max() <
+                            1e-4 * np.abs(a.patch).max())
+        self.assertRaises(ValueError, mog.evaluate_grid, x0, x1, y0, y1,
+                          0., 0., precision='half')
+
+        W,H = 60,50
+        psf = GaussianMixturePSF(np.array([0.8, 0.2]), np.zeros((2,2)),
+                                 np.array([[[2., 0.3],[0.3, 2.5]],
+                                           [[8., 0.],[0., 8.]]]))
+        srcs = [PointSource(PixPos(10.3, 12.8), Flux(50.)),
+                ExpGalaxy(PixPos(30.2, 20.7), Flux(100.),
+                          EllipseESoft(0.5, 0.2, -0.1))]
+        mods = []
+        for precision in ['double', 'single']:
+            tim = Image(data=np.zeros((H,W), np.float32),
+                        invvar=np.ones((H,W)), psf=psf,
+                        photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+            tim.modelPrecision = precision
+            tim.modelMinval = 1e-6
+            tr = Tractor([tim], srcs)
+            mods.append(tr.getModelImage(0))
+            tr.getDerivs()
+        self.assertTrue(np.abs(mods[0] - mods[1]).max() < 1e-4)
+
+    def test_multires_rendering(self):
+        from tractor.mixture_profiles import (MixtureOfGaussians,
+                                              get_dev_mixture)
+        dev = get_dev_mixture()
+        psf = MixtureOfGaussians(np.array([0.8, 0.2]), np.zeros((2,2)),
+                                 np.array([[[2., 0.3],[0.3, 2.5]],
+                                           [[8., 0.],[0., 8.]]]))
+        mog = MixtureOfGaussians(dev.amp, dev.mean + np.array([150.3, 140.6]),
+                                 dev.var * 20.**2).convolve(psf)
+        x0,x1,y0,y1 = 0, 300, 0, 280
+        truth = mog.evaluate_grid(x0, x1, y0, y1, 0., 0.).patch
+        for minval in [1e-6, 1e-7]:
+            steps = mog._multires_steps(minval, 8)
+            self.assertTrue(steps.max() > 1)
+            self.assertEqual(steps.min(), 1)
+            p = mog.evaluate_grid_multires(x0, x1, y0, y1, 0., 0., minval,
+                                           doslice=False)
+            self.assertEqual(p.shape, truth.shape)
+            # truncation plus interpolation budgets
+            self.assertTrue(np.abs(p.patch - truth).max() < 2. * minval)
+            ps = mog.evaluate_grid_multires(x0, x1, y0, y1, 0., 0., minval)
+            full = np.zeros_like(truth)
+            ps.addTo(full)
+            self.assertTrue(np.all(full == p.patch))
+
+        W,H = 200,200
+        src = DevGalaxy(PixPos(100.2, 99.7), Flux(1000.),
+                        EllipseESoft(2.5, 0.2, -0.1))
+        mods = []
+        for maxstep in [1, 8]:
+            tim = Image(data=np.zeros((H,W), np.float32),
+                        invvar=np.ones((H,W)),
+                        psf=GaussianMixturePSF(1., 0., 0., 2.25, 2.25, 0.5),
+                        photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+            tim.modelMinval = 1e-3
+            tim.modelMaxStep = maxstep
+            mods.append(Tractor([tim], [src]).getModelImage(0))
+        self.assertTrue(np.abs(mods[0] - mods[1]).max() < 2e-3)
+
+    def test_mixture_operations(self):
+        import pickle
+        from tractor.mixture_profiles import (MixtureOfGaussians,
+                                              get_dev_mixture)
+        dev = get_dev_mixture()
+        psf = MixtureOfGaussians(np.array([0.7, 0.3]),
+                                 np.array([[0.1, 0.], [0., 0.2]]),
+                                 np.array([[[1., 0.1],[0.1, 2.]],
+                                           [[4., 0.],[0., 3.]]]))
+        self.assertFalse(hasattr(psf, '__dict__'))
+        scale = np.array([[1.3, 0.2], [-0.4, 0.9]])
+        amix = dev.apply_affine(np.array([3., 4.]), scale)
+        for k in range(dev.K):
+            v = np.dot(scale.T, np.dot(dev.var[k], scale))
+            self.assertTrue(np.allclose(amix.var[k], v))
+            self.assertTrue(np.all(amix.var[k] == amix.var[k].T))
+        cmix = amix.convolve(psf)
+        self.assertEqual(cmix.K, amix.K * psf.K)
+        for j in range(psf.K):
+            for i in range(amix.K):
+                k = j * amix.K + i
+                self.assertTrue(np.allclose(cmix.amp[k],
+                                            amix.amp[i] * psf.amp[j]))
+                self.assertTrue(np.allclose(cmix.mean[k],
+                                            amix.mean[i] + psf.mean[j]))
+                self.assertTrue(np.allclose(cmix.var[k],
+                                            amix.var[i] + psf.var[j]))
+        # trusted: no copies
+        mix = MixtureOfGaussians.trusted(cmix.amp, cmix.mean, cmix.var)
+        self.assertTrue(mix.var is cmix.var)
+        self.assertEqual((mix.K, mix.D), (cmix.K, 2))
+        for protocol in [0, 2]:
+            mix2 = pickle.loads(pickle.dumps(mix, protocol))
+            self.assertTrue(np.all(mix2.amp == mix.amp))
+            self.assertTrue(np.all(mix2.var == mix.var))
+            self.assertEqual(mix2.K, mix.K)
+
+    def test_approx3_truncation(self):
+        from tractor.mixture_profiles import MixtureOfGaussians
+        from tractor.mix import c_gauss_2d_approx3_extent
+        # a compact core plus a wide, faint wing
+        mog = MixtureOfGaussians(np.array([0.9, 0.1]),
+                                 np.array([[0., 0.], [1., -1.]]),
+                                 np.array([[[4., 1.],[1., 3.]],
+                                           [[200., 0.],[0., 150.]]]))
+        x0,x1,y0,y1 = 0, 600, 0, 600
+        fx,fy = 300.3, 299.8
+        minval = 1e-5
+        truth = mog.evaluate_grid(x0, x1, y0, y1, fx, fy).patch
+        e = 1e-4
+        dx = (mog.evaluate_grid(x0, x1, y0, y1, fx+e, fy).patch -
+              mog.evaluate_grid(x0, x1, y0, y1, fx-e, fy).patch) / (2.*e)
+        for precision in ['double', 'single']:
+            p,px,py = mog.evaluate_grid_approx3(x0, x1, y0, y1, fx, fy, minval,
+                                                derivs=True,
+                                                precision=precision)
+            # only the union of the components' ellipses is rendered
+            self.assertTrue(p.shape[0] < 100 and p.shape[1] < 100)
+            full = np.zeros_like(truth)
+            p.addTo(full)
+            self.assertTrue(np.abs(full - truth).max() < 1.01 * minval)
+            full[:,:] = 0.
+            px.addTo(full)
+            self.assertTrue(np.abs(full - dx).max() < 1e-4)
+
+        rtn,sx0,sx1,sy0,sy1 = c_gauss_2d_approx3_extent(
+            x0, x1, y0, y1, fx, fy, minval, mog.amp, mog.mean, mog.var,
+            300, 300, 1)
+        self.assertEqual(rtn, 0)
+        p = mog.evaluate_grid_approx3(x0, x1, y0, y1, fx, fy, minval,
+                                      doslice=False)
+        self.assertEqual(p.shape, truth.shape)
+        I,J = np.nonzero(p.patch)
+        self.assertTrue(I.min() >= sy0 and I.max() < sy1)
+        self.assertTrue(J.min() >= sx0 and J.max() < sx1)
+
+    def test_param_derivs_truncation(self):
+        from tractor.mixture_profiles import MixtureOfGaussians
+        mog = MixtureOfGaussians(np.array([0.9, 0.1]),
+                                 np.array([[0., 0.], [1., -1.]]),
+                                 np.array([[[4., 1.],[1., 3.]],
+                                           [[200., 0.],[0., 150.]]]))
+        x0,x1,y0,y1 = 0, 200, 0, 200
+        fx,fy = 100.3, 99.8
+        minval = 1e-5
+        # one amplitude derivative per component: each is non-zero
+        # exactly where that component was evaluated.
+        dparams = np.zeros((mog.K, mog.K, 6))
+        for k in range(mog.K):
+            dparams[k,k,5] = 1.
+        p,full = mog.evaluate_grid_param_derivs(x0, x1, y0, y1, fx, fy,
+                                                dparams)
+        p,trunc = mog.evaluate_grid_param_derivs(x0, x1, y0, y1, fx, fy,
+                                                 dparams, minval=minval,
+                                                 value=False)
+        self.assertTrue(p is None)
+        nfull = sum(np.count_nonzero(d.patch) for d in full)
+        ntrunc = sum(np.count_nonzero(d.patch) for d in trunc)
+        self.assertTrue(ntrunc < 0.2 * nfull)
+        for d,t in zip(full, trunc):
+            self.assertTrue(np.abs(d.patch - t.patch).max() < 1.01 * minval)
+
+    def test_psf_subpixel_library(self):
+        import pickle
+        from tractor.psf import PixelizedPSF
+        from tractor.patch import Patch
+        yy,xx = np.mgrid[-12:13, -12:13]
+        pim = np.exp(-0.5 * (xx**2 + 0.8*yy**2 + 0.3*xx*yy) / 2.**2)
+        pim /= pim.sum()
+        exact = PixelizedPSF(pim)
+        psf = PixelizedPSF(pim)
+        err = psf.setSubpixelLibrary(nsub=32)
+        self.assertTrue(err > 0 and err < 1e-2)
+        bound = psf.getSubpixelErrorBound()
+        np.random.seed(42)
+        for px,py in np.random.uniform(20., 30., size=(20,2)):
+            p0 = exact.getPointSourcePatch(px, py)
+            p1 = psf.getPointSourcePatch(px, py)
+            self.assertEqual((p0.x0,p0.y0), (p1.x0,p1.y0))
+            self.assertTrue(np.abs(p0.patch - p1.patch).max() <= bound)
+        # exactly on a library phase
+        p0 = exact.getPointSourcePatch(25.25, 24.5)
+        p1 = psf.getPointSourcePatch(25.25, 24.5)
+        self.assertTrue(np.abs(p0.patch - p1.patch).max() < 1e-12)
+        # modelMask padding / clipping
+        mm = Patch(10, 15, np.ones((12,30), bool))
+        p0 = exact.getPointSourcePatch(24.3, 20.7, modelMask=mm)
+        p1 = psf.getPointSourcePatch(24.3, 20.7, modelMask=mm)
+        self.assertEqual(p1.shape, (12,30))
+        self.assertTrue(np.abs(p0.patch - p1.patch).max() <= bound)
+        # memory budget
+        psf.setSubpixelLibrary(nsub=32, maxbytes=10 * pim.nbytes)
+        for px in np.linspace(0., 1., 50):
+            psf.getPointSourcePatch(px, 0.3)
+        self.assertTrue(len(psf.sublibrary) <= 10)
+        psf2 = pickle.loads(pickle.dumps(psf))
+        self.assertTrue(psf2.sublibrary is None)
+        p1 = psf2.getPointSourcePatch(24.3, 20.7)
+        p0 = exact.getPointSourcePatch(24.3, 20.7)
+        self.assertTrue(np.abs(p0.patch - p1.patch).max() <= bound)
+
+    def test_psf_lanczos_derivs(self):
+        from tractor.psf import PixelizedPSF
+        from tractor.patch import Patch
+        yy,xx = np.mgrid[-12:13, -12:13]
+        pim = np.exp(-0.5 * (xx**2 + 0.8*yy**2 + 0.3*xx*yy) / 2.**2)
+        pim /= pim.sum()
+        psf = PixelizedPSF(pim)
+        # (the subpixel library is not used for derivatives)
+        psf.setSubpixelLibrary(nsub=8)
+        step = 1e-6
+        for px,py,mm in [(20.3, 18.6, None), (21.9, 19.05, None),
+                         (20.45, 18.0, Patch(5, 10, np.ones((20,30), bool)))]:
+            p0,pdx,pdy = psf.getPointSourcePatch(px, py, derivs=True,
+                                                 modelMask=mm)
+            exact = PixelizedPSF(pim)
+            self.assertTrue(np.abs(p0.patch - exact.getPointSourcePatch(
+                px, py, modelMask=mm).patch).max() < 1e-15)
+            for d,(sx,sy) in [(pdx, (step,0.)), (pdy, (0.,step))]:
+                self.assertEqual(d.getExtent(), p0.getExtent())
+                fd = (exact.getPointSourcePatch(px+sx, py+sy,
+                                                modelMask=mm).patch -
+                      exact.getPointSourcePatch(px-sx, py-sy,
+                                                modelMask=mm).patch) / (2.*step)
+                self.assertTrue(np.abs(d.patch - fd).max()
+                                < 1e-6 * np.abs(fd).max())
+
+        W,H = 40,40
+        tim = Image(data=np.zeros((H,W), np.float32), invvar=np.ones((H,W)),
+                    psf=PixelizedPSF(pim), photocal=LinearPhotoCal(1.),
+                    sky=ConstantSky(0.))
+        src = PointSource(PixPos(20.3, 18.6), Flux(10.))
+        src.pos.setStepSizes([1e-4, 1e-4])
+        fast = src.getParamDerivatives(tim)
+        slow = src.getParamDerivatives(tim, fastPosDerivs=False)
+        self.assertEqual(fast[0].name, 'd(ptsrc)/d(pos.x)')
+        for i in [0, 1]:
+            d0 = np.zeros((H,W))
+            d1 = np.zeros((H,W))
+            fast[i].addTo(d0)
+            slow[i].addTo(d1)
+            self.assertTrue(np.abs(d0 - d1).max() < 1e-2 * np.abs(d1).max())
+
+        # RA,Dec positions, through a rotated TAN WCS
+        from astrometry.util.util import Tan
+        from tractor.wcs import TanWcs
+        cd = 0.262 / 3600.
+        wcs = TanWcs(Tan(150., 2., 20., 20., -0.8 * cd, 0.6 * cd,
+                         0.6 * cd, 0.8 * cd, float(W), float(H)))
+        tim = Image(data=np.zeros((H,W), np.float32), invvar=np.ones((H,W)),
+                    psf=PixelizedPSF(pim), photocal=LinearPhotoCal(1.),
+                    sky=ConstantSky(0.), wcs=wcs)
+        src = PointSource(wcs.pixelToPosition(20.3, 18.6), Flux(10.))
+        tr = Tractor([tim], [src])
+        derivs = src.getParamDerivatives(tim)
+        p0 = src.pos.getParams()
+        step = 1e-8
+        for i in [0, 1]:
+            mods = []
+            for s in [step, -step]:
+                src.pos.setParam(i, p0[i] + s)
+                mods.append(tr.getModelImage(0).astype(float))
+            src.pos.setParam(i, p0[i])
+            fd = (mods[0] - mods[1]) / (2. * step)
+            d = np.zeros((H,W))
+            derivs[i].addTo(d)
+            self.assertTrue(np.abs(d - fd).max() < 1e-2 * np.abs(fd).max())
+
+        # a fit on the default (pixel-scale 1) WCS converges
+        tim = Image(data=np.zeros((H,W), np.float32), invvar=np.ones((H,W)),
+                    psf=PixelizedPSF(pim), photocal=LinearPhotoCal(1.),
+                    sky=ConstantSky(0.))
+        truth = PointSource(PixPos(20.3, 18.6), Flux(1000.))
+        tr = Tractor([tim], [truth])
+        tim.data = tr.getModelImage(0).astype(np.float32)
+        src = PointSource(PixPos(19.8, 19.1), Flux(954.))
+        tr = Tractor([tim], [src])
+        tr.freezeParam('images')
+        tr.optimize_loop()
+        self.assertTrue(np.allclose(src.getParams(), [20.3, 18.6, 1000.],
+                                    atol=1e-3))
+
+    def test_psfex_at_many(self):
+        import pickle
+        np.random.seed(7)
+        psfex = make_psfex_model(
+            np.random.normal(size=(6, 25, 25)).astype(np.float32), 2,
+            x0=1000., y0=2000.)
+        x = np.random.uniform(0, 2048, size=10)
+        y = np.random.uniform(0, 4096, size=10)
+        terms = psfex.polynomials_many(x, y)
+        self.assertEqual(terms.shape, (10, 6))
+        for sampling in [1., 0.75]:
+            psfex.sampling = sampling
+            ims = psfex.at_many(x, y)
+            self.assertEqual(ims.shape, (10, 25, 25))
+            for i in range(len(x)):
+                self.assertTrue(np.allclose(terms[i], psfex.polynomials(x[i], y[i])))
+                im = psfex.at(x[i], y[i])
+                self.assertTrue(np.abs(ims[i] - im).max()
+                                < 1e-5 * np.abs(im).max())
+        self.assertFalse('_nativebases' in pickle.loads(pickle.dumps(psfex)).__dict__)
+
+    def test_cache_stats(self):
+        from tractor.cache import Cache, NullCache
+        a = np.zeros(100)
+        cache = Cache(maxsize=10, maxbytes=2 * a.nbytes)
+        for i in range(3):
+            cache.put(i, np.zeros(100))
+        self.assertEqual(cache.get(0, None), None)
+        self.assertTrue(cache.get(2) is not None)
+        self.assertEqual(cache.stats(), (1, 1, 2, 2 * a.nbytes))
+        nc = NullCache()
+        nc.put(0, a)
+        self.assertEqual(nc.get(0, None), None)
+        self.assertEqual(nc.stats(), (0, 0, 0, 0))
+
+    def test_psfex_fourier_cache(self):
+        import pickle
+        from tractor.psfex import PixelizedPsfEx
+        np.random.seed(7)
+        psfex = make_psfex_model(np.random.uniform(size=(3, 25, 25)), 1)
+        psf = PixelizedPsfEx(None, psfex=psfex)
+        exact = PixelizedPsfEx(None, psfex=psfex.copy())
+        psf.setFourierCache(rounding=16)
+        P1 = psf.getFourierTransform(10., 20., 16)[0]
+        # cells are counted from the model origin (100,200)
+        P0 = exact.getFourierTransform(100. - 5.5 * 16, 200. - 11.5 * 16, 16)[0]
+        self.assertTrue(np.all(P0 == P1))
+        self.assertEqual(psf.getFourierCacheStats()[:3], (0, 1, 1))
+        # same cell
+        P2 = psf.getFourierTransform(15.9, 23., 16)[0]
+        self.assertTrue(P2 is P1)
+        self.assertEqual(psf.getFourierCacheStats()[:3], (1, 1, 1))
+        # a shifted copy shares the cache: (10,15) there is (15,20) here
+        sub = psf.getShifted(5., 5.)
+        self.assertTrue(sub.getFourierTransform(10., 15., 16)[0] is P1)
+        self.assertEqual(psf.getFourierCacheStats()[:3], (2, 1, 1))
+        # byte budget
+        nb = psf.getFourierCacheStats()[3]
+        psf.setFourierCache(rounding=16, maxbytes=3 * nb)
+        for x in range(0, 160, 16):
+            psf.getFourierTransform(x, 0., 16)
+        hits,misses,n,nbytes = psf.getFourierCacheStats()
+        self.assertEqual((hits, misses, n), (0, 10, 3))
+        self.assertTrue(nbytes <= 3 * nb)
+        # pickling drops the cached FFTs but keeps the settings
+        psf2 = pickle.loads(pickle.dumps(psf))
+        self.assertEqual(psf2.getFourierCacheStats(), (0, 0, 0, 0))
+        self.assertEqual(psf2.fftsumcache.rounding, 16)
+        self.assertTrue(np.all(psf2.getFourierTransform(10., 20., 16)[0] == P1))
+        # FFTs of another size are cached separately
+        psf2.setFourierCache(rounding=16)
+        psf2.getFourierTransform(10., 20., 16)
+        P3 = psf2.getFourierTransform(10., 20., 40)[0]
+        self.assertNotEqual(P3.shape, P1.shape)
+        self.assertEqual(psf2.getFourierCacheStats()[:3], (0, 2, 2))
+
+    def test_spatial_psf_cache(self):
+        import pickle
+        from tractor.psfex import PixelizedPsfEx, VaryingGaussianPSF
+        np.random.seed(7)
+        psfex = make_psfex_model(np.random.uniform(size=(3, 25, 25)), 1)
+        psf = PixelizedPsfEx(None, psfex=psfex)
+        psf.setSpatialCache(rounding=10)
+        im = psf.getImage(3., 4.)
+        # cells are counted from the model origin (100,200)
+        self.assertTrue(np.all(im == psfex.at(5., 5.)))
+        self.assertTrue(psf.getImage(0.5, 9.) is im)
+        self.assertEqual(psf.getSpatialCacheStats()[:3], (1, 1, 1))
+        sub = psf.getShifted(10., 0.)
+        self.assertTrue(sub.getImage(-7., 5.) is im)
+        # byte budget
+        psf.setSpatialCache(rounding=10, maxbytes=4 * im.nbytes)
+        psf.precomputeSpatialCache(100, 100, threads=2)
+        hits,misses,n,nbytes = psf.getSpatialCacheStats()
+        self.assertEqual(n, 4)
+        self.assertTrue(nbytes <= 4 * im.nbytes)
+        psf.setSpatialCache(rounding=10)
+        psf.precomputeSpatialCache(100, 100, threads=2)
+        self.assertEqual(psf.getSpatialCacheStats()[2], 11 * 11)
+        self.assertTrue(np.all(psf.getImage(73., 41.) == psfex.at(75., 45.)))
+        # pickling drops the cached values but keeps the settings
+        psf2 = pickle.loads(pickle.dumps(psf))
+        self.assertEqual(psf2.getSpatialCacheStats(), (0, 0, 0, 0))
+        self.assertEqual(psf2.spatialcache.rounding, 10)
+        psf.setSpatialCache(rounding=0)
+        self.assertTrue(np.all(psf.getImage(3., 4.) == psfex.at(3., 4.)))
+
+        # a spline-interpolated single Gaussian
+        vpsf = VaryingGaussianPSF(100, 100, nx=5, ny=5, K=1)
+        XX = YY = np.linspace(0., 100., 5)
+        pp = np.zeros((5, 5, 6))
+        pp[:,:,0] = 1.
+        pp[:,:,3] = pp[:,:,4] = 2. + np.arange(5)[np.newaxis,:]
+        vpsf.fitSavedData(pp, XX, YY)
+        vpsf.setSpatialCache(rounding=20)
+        mog = vpsf.psfAt(31., 55.)
+        self.assertTrue(vpsf.psfAt(39., 45.) is mog)
+        self.assertEqual(mog.getParams(), vpsf._psfAt(30., 50.).getParams())
+
+        # WisePSF's cache is for its grid of stamps (instantiateAt);
+        # the fitted model is not rounded to the grid.
+        from wise.wise_psf import WisePSF
+        wpsf = WisePSF(1, ngrid=5)
+        XX = YY = np.linspace(0., wpsf.W - 1, 5)
+        mog = GaussianMixturePSF(np.array([0.6, 0.3, 0.1]), np.zeros((3, 2)),
+                                 np.array([np.eye(2) * v for v in [1., 4., 9.]]))
+        pp = np.zeros((5, 5, mog.numberOfParams()))
+        pp[:,:,:] = mog.getParams()
+        f = 1. + 0.5 * np.arange(5)
+        pp[:,:,3:] *= f[:,np.newaxis,np.newaxis] * f[np.newaxis,:,np.newaxis]
+        wpsf.fitSavedData(pp, XX, YY)
+        exact = [wpsf.psfAt(131., 555.).getParams(),
+                 wpsf.getPointSourcePatch(131., 555.).patch]
+        wpsf.setSpatialCache()
+        self.assertEqual(wpsf.psfAt(131., 555.).getParams(), exact[0])
+        self.assertTrue(np.all(wpsf.getPointSourcePatch(131., 555.).patch
+                               == exact[1]))
+        self.assertEqual(wpsf.getSpatialCacheStats(), (0, 0, 0, 0))
+
+
 if __name__ == '__main__':
     unittest.main()
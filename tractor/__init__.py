@@ -30,7 +30,7 @@ __all__ = [
     #'GaussianPriors',
     # engine
     'Patch', 'Image', 'Images',
-    'Catalog', 'Tractor',
+    'Catalog', 'Tractor', 'LogProbPool',
     # psfex
     'VaryingGaussianPSF', 'PsfEx',
     # ellipses
@@ -1,3 +1,219 @@
+// Helpers shared by c_gauss_2d_approx3 and the single-precision
+// kernels (gauss_float.c): each mixture component is evaluated only
+// inside the ellipse where it is above its share of "minval" (its
+// analytic iso-density contour), by solving for the chord of the
+// ellipse in each row.
+
+// Computes the scaled inverse covariances "II" (as in eval_all_dxy),
+// "scales", and means offset by (fx,fy) "mxy" of the K components,
+// and the exponent "cuts" below which each is not evaluated: for
+// minval > 0, where it drops below minval * amp[k] / sum(amp)
+// (so that the sum of the omitted parts is < minval), floored at
+// -100; otherwise "defcut".  Components that can't be evaluated get
+// scale zero.  Returns 1 if all scales are zero.
+static int approx3_setup(int K, const double* amp, const double* mean,
+                         const double* var, double fx, double fy,
+                         double minval, double defcut,
+                         double* II, double* scales, double* mxy,
+                         double* cuts) {
+    const int D = 2;
+    double tpd = pow(2.*M_PI, D);
+    double ampsum = 0.;
+    int allzero = 1;
+    int k;
+    for (k=0; k<K; k++)
+        ampsum += amp[k];
+    for (k=0; k<K; k++) {
+        double* I = II + 3*k;
+        double v0 = var[k*D*D + 0];
+        double v1 = (var[k*D*D + 1] + var[k*D*D + 2]) * 0.5;
+        double v2 = var[k*D*D + 3];
+        double det = v0*v2 - v1*v1;
+        // we fold the -0.5 in the Gaussian exponent term in here...
+        double isc = -0.5 / det;
+        I[0] =  v2 * isc;
+        // we also fold in the 2*dx*dy term here
+        I[1] = -v1 * isc * 2.0;
+        I[2] =  v0 * isc;
+        scales[k] = amp[k] / sqrt(tpd * det);
+        mxy[2*k + 0] = mean[k*D + 0] + fx;
+        mxy[2*k + 1] = mean[k*D + 1] + fy;
+        if (minval > 0.) {
+            cuts[k] = log(minval * sqrt(tpd * det) / ampsum);
+            // (!(x >= y)) to handle NaNs.
+            if (!(cuts[k] >= -100.))
+                cuts[k] = -100.;
+        } else
+            cuts[k] = defcut;
+        if (!(det > 0.) || !isfinite(scales[k]) ||
+            !isfinite(I[0]) || !isfinite(I[1]) || !isfinite(I[2]) ||
+            !isfinite(mxy[2*k + 0]) || !isfinite(mxy[2*k + 1]) ||
+            (cuts[k] >= 0.))
+            scales[k] = 0.;
+        if (scales[k] != 0.)
+            allzero = 0;
+    }
+    return allzero;
+}
+
+// Sets "hull" to the box of radius "minradius" around (xc,yc)
+// (moved inside [x0,x1) x [y0,y1)), which is evaluated regardless of
+// the cuts; or returns NULL if minradius < 0.
+static int* approx3_hull(int x0, int x1, int y0, int y1,
+                         int xc, int yc, int minradius, int* hull) {
+    if (minradius < 0)
+        return NULL;
+    xc = MAX(x0, MIN(x1 - 1, xc));
+    yc = MAX(y0, MIN(y1 - 1, yc));
+    hull[0] = MAX(x0, xc - minradius);
+    hull[1] = MIN(x1, xc + minradius + 1);
+    hull[2] = MAX(y0, yc - minradius);
+    hull[3] = MIN(y1, yc + minradius + 1);
+    return hull;
+}
+
+// The range [*xlo, *xhi) of pixels in row "iy", within [x0,x1), to
+// evaluate component "k" at: the chord of its ellipse, extended to
+// the hull in its rows.  Returns 0 if empty.
+static int approx3_row(int k, const double* II, const double* mxy,
+                       const double* cuts, int x0, int x1, int iy,
+                       const int* hull, int* xlo, int* xhi) {
+    const double* I = II + 3*k;
+    double dy = iy - mxy[2*k + 1];
+    double b = I[1] * dy;
+    // I[0] < 0
+    double disc = b*b - 4. * I[0] * (I[2] * dy * dy - cuts[k]);
+    *xlo = x1;
+    *xhi = x0;
+    if (disc >= 0.) {
+        double sq = sqrt(disc);
+        // (clamp in double precision; the ellipse can be huge)
+        *xlo = (int)MAX((double)x0, ceil (mxy[2*k] + (-b + sq) / (2. * I[0])));
+        *xhi = (int)MIN((double)x1, floor(mxy[2*k] + (-b - sq) / (2. * I[0])) + 1.);
+    }
+    if (hull && (iy >= hull[2]) && (iy < hull[3])) {
+        if (*xlo >= *xhi) {
+            *xlo = hull[0];
+            *xhi = hull[1];
+        } else {
+            *xlo = MIN(*xlo, hull[0]);
+            *xhi = MAX(*xhi, hull[1]);
+        }
+    }
+    return (*xlo < *xhi);
+}
+
+// Sets "bbox" to the union of the bounding boxes of the components'
+// ellipses and the hull, within [x0,x1) x [y0,y1): [bx0,bx1,by0,by1],
+// empty (bx0 >= bx1) if none.
+static void approx3_extent(int K, const double* II, const double* scales,
+                           const double* mxy, const double* cuts,
+                           int x0, int x1, int y0, int y1,
+                           const int* hull, int* bbox) {
+    int k;
+    bbox[0] = x1;
+    bbox[1] = x0;
+    bbox[2] = y1;
+    bbox[3] = y0;
+    if (hull && (hull[0] < hull[1]) && (hull[2] < hull[3]))
+        memcpy(bbox, hull, 4 * sizeof(int));
+    for (k=0; k<K; k++) {
+        const double* I = II + 3*k;
+        // the variance, from the scaled inverse:
+        // I = -0.5 * inv(V), with I[1] including the factor of 2.
+        double det = I[0]*I[2] - 0.25*I[1]*I[1];
+        double vxx = -0.5 * I[2] / det;
+        double vyy = -0.5 * I[0] / det;
+        double rx, ry;
+        if (scales[k] == 0.)
+            continue;
+        rx = sqrt(-2. * cuts[k] * vxx);
+        ry = sqrt(-2. * cuts[k] * vyy);
+        bbox[0] = (int)MIN((double)bbox[0], MAX((double)x0, ceil (mxy[2*k]   - rx)));
+        bbox[1] = (int)MAX((double)bbox[1], MIN((double)x1, floor(mxy[2*k]   + rx) + 1.));
+        bbox[2] = (int)MIN((double)bbox[2], MAX((double)y0, ceil (mxy[2*k+1] - ry)));
+        bbox[3] = (int)MAX((double)bbox[3], MIN((double)y1, floor(mxy[2*k+1] + ry) + 1.));
+    }
+}
+
+static int approx3_get_mixture(PyObject* ob_amp, PyObject* ob_mean,
+                               PyObject* ob_var, int* K,
+                               PyObject** np_amp, PyObject** np_mean,
+                               PyObject** np_var) {
+    PyArray_Descr* dtype = PyArray_DescrFromType(PyArray_DOUBLE);
+    int req = NPY_C_CONTIGUOUS | NPY_ALIGNED;
+    const int D = 2;
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    *np_amp  = PyArray_FromAny(ob_amp,  dtype, 1, 1, req, NULL);
+    *np_mean = PyArray_FromAny(ob_mean, dtype, 2, 2, req, NULL);
+    *np_var  = PyArray_FromAny(ob_var,  dtype, 3, 3, req, NULL);
+    if (!*np_amp || !*np_mean || !*np_var) {
+        ERR("amp, mean, var must be double arrays\n");
+        return 1;
+    }
+    *K = (int)PyArray_DIM(*np_amp, 0);
+    if ((PyArray_DIM(*np_mean, 0) != *K) || (PyArray_DIM(*np_mean, 1) != D) ||
+        (PyArray_DIM(*np_var, 0) != *K) || (PyArray_DIM(*np_var, 1) != D) ||
+        (PyArray_DIM(*np_var, 2) != D)) {
+        ERR("mean, var must be K x D, K x D x D\n");
+        return 1;
+    }
+    return 0;
+}
+
+static int c_gauss_2d_approx3_extent(int x0, int x1, int y0, int y1,
+                                     double fx, double fy, double minval,
+                                     PyObject* ob_amp,
+                                     PyObject* ob_mean,
+                                     PyObject* ob_var,
+                                     int xc, int yc,
+                                     int minradius,
+                                     int* sx0, int* sx1, int* sy0, int* sy1) {
+    // The part of [x0,x1), [y0,y1) that c_gauss_2d_approx3 (with the
+    // same arguments) can touch, as a slice (sx0,sx1,sy0,sy1) of its
+    // result array: callers can allocate just that.
+    PyObject *np_amp=NULL, *np_mean=NULL, *np_var=NULL;
+    int K;
+    int rtn = -1;
+    int hull[4];
+    int bbox[4] = { 0, 0, 0, 0 };
+
+    if (approx3_get_mixture(ob_amp, ob_mean, ob_var, &K,
+                            &np_amp, &np_mean, &np_var))
+        goto bailout;
+    rtn = 0;
+    if ((x0 < x1) && (y0 < y1)) {
+        double II[3*K];
+        double scales[K];
+        double mxy[2*K];
+        double cuts[K];
+        approx3_setup(K, PyArray_DATA(np_amp), PyArray_DATA(np_mean),
+                      PyArray_DATA(np_var), fx, fy, minval, -100.,
+                      II, scales, mxy, cuts);
+        approx3_extent(K, II, scales, mxy, cuts, x0, x1, y0, y1,
+                       approx3_hull(x0, x1, y0, y1, xc, yc, minradius, hull),
+                       bbox);
+    }
+    if ((bbox[0] >= bbox[1]) || (bbox[2] >= bbox[3]))
+        bbox[0] = bbox[1] = bbox[2] = bbox[3] = 0;
+    else {
+        bbox[0] -= x0;
+        bbox[1] -= x0;
+        bbox[2] -= y0;
+        bbox[3] -= y0;
+    }
+ bailout:
+    *sx0 = bbox[0];
+    *sx1 = bbox[1];
+    *sy0 = bbox[2];
+    *sy1 = bbox[3];
+    Py_XDECREF(np_amp);
+    Py_XDECREF(np_mean);
+    Py_XDECREF(np_var);
+    return rtn;
+}
+
 static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
                               // (fx,fy): center position
                               // which offsets "means"
@@ -16,44 +232,39 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
 
     // [x0,x1), [y0,y1)
     //
+    // Each component is evaluated only inside the ellipse where it is
+    // above minval * amp[k] / sum(amp) (see approx3_setup); a pixel
+    // where the mixture is above minval is always inside at least one
+    // of them.  The results are added to *ob_result*.
+    //
     // ob_mask: numpy array, shape (y1-y0, x1-x0), boolean: which
     // pixels to evaluate.
     //
     // ob_xderiv: if not NULL, result array for x derivative
     // ob_yderiv: if not NULL, result array for y derivative
     //
-    // xc, yc: "center" pixel from which to begin evaluation.  If
-    // outside x0,x1,y0,y1, the largest boundary value will be chosen
-    // as the start point.
+    // xc, yc: "center" pixel (moved inside the box if outside it).
     //
-    // minradius: minimum number of pixels to evaluate, regardless of minval
+    // minradius: all pixels within this distance (in x and y) of the
+    // center are evaluated, regardless of minval.
     //
     // sx0,sx1,sy0,sy1: min and max (exclusive) pixel coords in
     // *ob_result* containing non-zero values; appropriate for
-    // building a slice.  
-
-    //(within this function, we use inclusive coords, but increment
-    // sx1,sy1 just before returning).
-
-    int nexp0 = n_exp;
+    // building a slice.
 
     double *amp, *mean, *var, *result;
     double *xderiv=NULL, *yderiv=NULL;
     uint8_t* mask=NULL;
-    const int D=2;
-    int K, k;
+    int K;
     int rtn = -1;
     PyObject *np_amp=NULL, *np_mean=NULL, *np_var=NULL, *np_result=NULL;
     PyObject *np_xderiv=NULL, *np_yderiv=NULL, *np_mask=NULL;
-    double tpd;
     int W,H;
-    int R;
-    double *pxd = NULL, *pyd = NULL;
-    int off;
+    int hull[4];
+    int bx0 = x1, bx1 = x0, by0 = y1, by1 = y0;
 
     W = x1 - x0;
     H = y1 - y0;
-    tpd = pow(2.*M_PI, D);
 
     if (get_np(ob_amp, ob_mean, ob_var, ob_result, ob_xderiv, ob_yderiv,
                ob_mask, W, H,
@@ -62,6 +273,7 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
         printf("get_np failed\n");
         goto bailout;
     }
+    rtn = 0;
 
     amp    = PyArray_DATA(np_amp);
     mean   = PyArray_DATA(np_mean);
@@ -74,385 +286,59 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
     if (np_mask)
         mask   = PyArray_DATA(np_mask);
 
+    if ((K == 0) || (W <= 0) || (H <= 0))
+        goto bailout;
+
+    Py_BEGIN_ALLOW_THREADS
     {
         double II[3*K];
-        double VV[3*K];
         double scales[K];
-        double maxD[K];
-
-        uint8_t aw[4*W];
-        uint8_t ah[4*H];
-        memset(aw, 0, sizeof(aw));
-        memset(ah, 0, sizeof(ah));
-
-        // Starting from the central pixel (xc,yc), evaluate expanding
-        // rings of pixels.  We mark pixels we want to evaluate in four
-        // arrays, for the top, bottom, left, and right of the ring.  For
-        // any pixel that evaluates above minval, we mark all its
-        // neighbors for evaluation next time.
-        // The "top" and "bottom" arrays take priority over the L,R.
-        // That is, we only mark pixel +R,+R in the TOP array, not the Left.
-        uint8_t* doT = aw;
-        uint8_t* doB = aw + W;
-        uint8_t* doL = ah;
-        uint8_t* doR = ah + H;
-        uint8_t* nextT = aw + 2*W;
-        uint8_t* nextB = aw + 3*W;
-        uint8_t* nextL = ah + 2*H;
-        uint8_t* nextR = ah + 3*H;
-
-        double ampsum = 0.;
-        for (k=0; k<K; k++)
-            ampsum += amp[k];
-            
-        // We symmetrize the covariance matrix,
-        // so V,I just have three elements for each K: x**2, xy, y**2.
-        for (k=0; k<K; k++) {
-            // We also scale the I to make the Gaussian evaluation easier
-            double det;
-            double isc;
-            double* V = VV + 3*k;
-            double* I = II + 3*k;
-            V[0] =  var[k*D*D + 0];
-            V[1] = (var[k*D*D + 1] + var[k*D*D + 2])*0.5;
-            V[2] =  var[k*D*D + 3];
-            det = V[0]*V[2] - V[1]*V[1];
-            // we fold the -0.5 in the Gaussian exponent term in here...
-            isc = -0.5 / det;
-            I[0] =  V[2] * isc;
-            // we also fold in the 2*dx*dy term here
-            I[1] = -V[1] * isc * 2.0;
-            I[2] =  V[0] * isc;
-            scales[k] = amp[k] / sqrt(tpd * det);
-            if (minval > 0.0) {
-                maxD[k] = log(minval * sqrt(tpd*det) / ampsum);
-                if (maxD[k] < -100.)
-                    maxD[k] = -100.;
-            } else {
-                maxD[k] = -100.;
-            }
-        }
-
-        // is the given starting pixel xc,yc outside the box the be evaluated?
-        if ((xc < x0) || (yc < y0) || (xc >= x1) || (yc >= y1)) {
-            // Find max pixel on the boundary and use that as xc,yc
-            int newxc, newyc;
-            int ix,iy;
-            double maxpix = 0.;
-            newxc = (x0+x1)/2;
-            newyc = (y0+y1)/2;
-            // We search along the edge(s) nearest the given xc,yc.
-            if ((xc < x0) || (xc >= x1)) {
-                if (xc < x0) {
-                    ix = x0;
-                } else {
-                    ix = x1-1;
-                }
-                for (iy=y0; iy<y1; iy++) {
-                    double v = eval_all(K, scales, II, mean, ix-fx, iy-fy);
-                    if (v > maxpix) {
-                        maxpix = v;
-                        newxc = ix;
-                        newyc = iy;
-                    }
-                }
-            }
-            if ((yc < y0) || (yc >= y1)) {
-                if (yc < y0) {
-                    iy = y0;
-                } else {
-                    iy = y1-1;
-                }
-                for (ix=x0; ix<x1; ix++) {
-                    double v = eval_all(K, scales, II, mean, ix-fx, iy-fy);
-                    if (v > maxpix) {
-                        maxpix = v;
-                        newxc = ix;
-                        newyc = iy;
-                    }
-                }
-            }
-            xc = newxc;
-            yc = newyc;
-        }
-
-#define SET(arr, i, lo, hi)                                 \
-        { if ((i >= lo) && (i < hi)) { arr[i - lo] = 1; } }
-
-        // Mark the eight neighbors around the central pixel as needing to be done.
-        if (yc > y0) {
-            SET(nextB, xc+1, x0,x1);
-            SET(nextB, xc,   x0,x1);
-            SET(nextB, xc-1, x0,x1);
-        }
-        if (yc < (y1-1)) {
-            SET(nextT, xc,   x0,x1);
-            SET(nextT, xc+1, x0,x1);
-            SET(nextT, xc-1, x0,x1);
-        }
-        if (xc > x0) {
-            SET(nextL, yc,   y0,y1);
-        }
-        if (xc < (x1-1)) {
-            SET(nextR, yc,   y0,y1);
-        }
-
-        off = (yc - y0)*W + (xc - x0);
-        if (xderiv)
-            pxd = xderiv + off;
-        if (yderiv)
-            pyd = yderiv + off;
-        result[off] = eval_all_dxy(K, scales, II, mean, xc-fx, yc-fy, pxd, pyd, maxD);
-
-        *sx0 = xc-x0;
-        *sx1 = *sx0;
-        *sy0 = yc-y0;
-        *sy1 = *sy0;
-
-        //printf("xc,yc %i,%i, vs x [%i,%i], y [%i,%i] -> res %g\n",
-        //xc, yc, x0, x1, y0, y1, result[off]);
-
-        for (R=1;; R++) {
-            uint8_t any = 0;
-            uint8_t anyrow;
-            int xx, yy;
-            int i;
-            double* rrow;
-            uint8_t* tmparr;
-
-            // Swap "do" and "next" arrays (do <= next)
-            tmparr = doT;
-            doT = nextT;
-            nextT = tmparr;
-            tmparr = doB;
-            doB = nextB;
-            nextB = tmparr;
-            tmparr = doL;
-            doL = nextL;
-            nextL = tmparr;
-            tmparr = doR;
-            doR = nextR;
-            nextR = tmparr;
-            memset(nextT, 0, W);
-            memset(nextB, 0, W);
-            memset(nextL, 0, H);
-            memset(nextR, 0, H);
-
-            // Beautiful ASCII art...
-            if (0) {
-                printf("R = %i, xc,yc = (%i,%i)\n", R, xc, yc);
-                for (i=MAX(xc-x0-R, 0); i<=MIN(xc-x0+R, W-1); i++) {
-                    printf("%c", (doT[i] ? '*' : '-'));
-                }
-                printf("\n");
-                for (i=MIN(yc-y0+R-1, H-1); i>=MAX(yc-y0-R+1, 0); i--) {
-                    printf("%c", (doL[i] ? '*' : '|'));
-                    int j;
-                    for (j=MAX(xc-x0-R, 0)+1; j<=MIN(xc-x0+R, W-1)-1; j++)
-                        printf(" ");
-                    printf("%c", (doR[i] ? '*' : '|'));
-                    printf("\n");
-                }
-                for (i=MAX(xc-x0-R, 0); i<=MIN(xc-x0+R, W-1); i++) {
-                    printf("%c", (doB[i] ? '*' : '-'));
-                }
-                printf("\n");
-                printf("\n");
-
-                for (i=0; i<H; i++) {
-                    int j;
-                    for (j=0; j<W; j++) {
-                        if (i == (yc+R-y0)) {
-                            printf("%c", (doT[j] ? '*' : '-'));
-                        } else if (i == (yc-R-y0)) {
-                            printf("%c", (doB[j] ? '*' : '-'));
-                        } else if (j == (xc-R-x0)) {
-                            printf("%c", (doL[i] ? '*' : '-'));
-                        } else if (j == (xc+R-x0)) {
-                            printf("%c", (doR[i] ? '*' : '-'));
-                        } else {
-                            printf(".");
-                        }
-                    }
-                    printf("\n");
-                }
-                printf("\n");
-            }
-
-            // top
-            yy = yc + R;
-            if (yy < y1) {
-                anyrow = 0;
-                off = (yy - y0)*W;
-                rrow = result + off;
-                if (xderiv)
-                    pxd = xderiv + off;
-                if (yderiv)
-                    pyd = yderiv + off;
-                for (i=0; i<W; i++) {
-                    double r;
-                    if (!doT[i])
-                        continue;
-                    any = 1;
-                    anyrow = 1;
-                    xx = x0 + i;
-                    r = eval_all_dxy(K, scales, II, mean, xx-fx, yy-fy,
-                                     (pxd ? pxd+i : NULL), (pyd ? pyd+i : NULL),
-                                     maxD);
-
-                    //result[(yy - y0)*W + (xx - x0)] = r;
-                    rrow[i] = r;
-                    //printf("top[xx=%i] = %g\n", xx, r);
-
-                    // If we're inside the minradius, mark the next pixels as game
-                    //printf("r=%g vs minval %g; R=%i vs minradius %i\n", r, minval, R, minradius);
-                    if ((R > minradius) && (r < minval))
-                        continue;
-                    // leftmost pixel of Top, and not at the left edge...
-                    if ((xx == (xc - R)) && (xx > x0)) {
-                        //printf("setting L\n");
-                        SET(nextL, yy  , y0,y1);
-                        SET(nextL, yy-1, y0,y1);
-                    }
-                    // rightmost pixel of Top, and not at the right edge...
-                    if ((xx == (xc + R)) && (xx < (x1-1))) {
-                        //printf("setting R\n");
-                        SET(nextR, yy  , y0,y1);
-                        SET(nextR, yy-1, y0,y1);
-                    }
-                    // not the top edge...
-                    if (yy < (y1-1)) {
-                        //printf("setting T\n");
-                        SET(nextT, xx-1, x0,x1);
-                        SET(nextT, xx  , x0,x1);
-                        SET(nextT, xx+1, x0,x1);
-                    }
-                }
-                if (anyrow) {
-                    *sy1 = yy - y0;
-                }
-            }
-            // bottom
-            yy = yc - R;
-            if (yy >= y0) {
-                anyrow = 0;
-                off = (yy - y0)*W;
-                rrow = result + off;
-                if (xderiv)
-                    pxd = xderiv + off;
-                if (yderiv)
-                    pyd = yderiv + off;
-                for (i=0; i<W; i++) {
-                    double r;
-                    if (!doB[i])
-                        continue;
-                    any = 1;
-                    anyrow = 1;
-                    xx = x0 + i;
-                    r = eval_all_dxy(K, scales, II, mean, xx-fx, yy-fy,
-                                     (pxd?pxd+i:NULL), (pyd?pyd+i:NULL), maxD);
-                    //result[(yy - y0)*W + (xx - x0)] = r;
-                    rrow[i] = r;
-                    //printf("bottom[xx=%i] = %g\n", xx, r);
-                    //printf("r=%g vs minval %g; R=%i vs minradius %i\n", r, minval, R, minradius);
-                    if ((R > minradius) && (r < minval))
-                        continue;
-                    // leftmost pixel in Bottom, and not left edge?
-                    if ((xx == (xc - R)) && (xx > x0)) {
-                        //printf("setting L\n");
-                        SET(nextL, yy  , y0,y1);
-                        SET(nextL, yy+1, y0,y1);
-                    }
-                    // rightmost pixel in Bottom, and not right edge?
-                    if ((xx == (xc + R)) && (xx < (x1-1))) {
-                        //printf("setting R\n");
-                        SET(nextR, yy  , y0,y1);
-                        SET(nextR, yy+1, y0,y1);
-                    }
-                    // not the bottom edge?
-                    if (yy > y0) {
-                        //printf("setting B\n");
-                        SET(nextB, xx-1, x0,x1);
-                        SET(nextB, xx  , x0,x1);
-                        SET(nextB, xx+1, x0,x1);
-                    }
-                }
-                if (anyrow) {
-                    *sy0 = yy - y0;
-                }
-            }
+        double mxy[2*K];
+        double cuts[K];
+        int* phull = approx3_hull(x0, x1, y0, y1, xc, yc, minradius, hull);
+        int iy;
 
-            // left
-            xx = xc - R;
-            if (xx >= x0) {
-                anyrow = 0;
-                for (i=0; i<H; i++) {
-                    double r;
-                    if (!doL[i])
-                        continue;
-                    any = 1;
-                    anyrow = 1;
-                    yy = y0 + i;
-                    off = (yy - y0)*W + (xx - x0);
-                    r = eval_all_dxy(K, scales, II, mean, xx-fx, yy-fy,
-                                     (xderiv ? xderiv+off : NULL),
-                                     (yderiv ? yderiv+off : NULL), maxD);
-                    result[off] = r;
-                    //printf("left[yy=%i] = %g\n", xx, r);
-                    //printf("r=%g vs minval %g; R=%i vs minradius %i\n", r, minval, R, minradius);
-                    if ((R > minradius) && (r < minval))
+        if (!approx3_setup(K, amp, mean, var, fx, fy, minval, -100.,
+                           II, scales, mxy, cuts)) {
+            #pragma omp parallel for schedule(dynamic) reduction(min:bx0,by0) reduction(max:bx1,by1) if ((long)W * H * K > OMP_MIN_EVALS)
+            for (iy=y0; iy<y1; iy++) {
+                npy_intp off = (npy_intp)(iy - y0) * W - x0;
+                int k, ix, xlo, xhi;
+                for (k=0; k<K; k++) {
+                    const double* I = II + 3*k;
+                    double dy = iy - mxy[2*k + 1];
+                    double b = I[1] * dy;
+                    double c = I[2] * dy * dy;
+                    if (scales[k] == 0.)
                         continue;
-                    // not the left edge?
-                    if (xx > x0) {
-                        //printf("setting L\n");
-                        SET(nextL, yy-1, y0,y1);
-                        SET(nextL, yy  , y0,y1);
-                        SET(nextL, yy+1, y0,y1);
-                    }
-                }
-                if (anyrow) {
-                    *sx0 = xx - x0;
-                }
-            }
-            // right
-            xx = xc + R;
-            if (xx < x1) {
-                anyrow = 0;
-                for (i=0; i<H; i++) {
-                    double r;
-                    if (!doR[i])
-                        continue;
-                    any = 1;
-                    anyrow = 1;
-                    yy = y0 + i;
-                    off = (yy - y0)*W + (xx - x0);
-                    r = eval_all_dxy(K, scales, II, mean, xx-fx, yy-fy,
-                                     (xderiv ? xderiv+off : NULL),
-                                     (yderiv ? yderiv+off : NULL), maxD);
-                    result[off] = r;
-                    //printf("right[yy=%i] = %g\n", yy, r);
-                    //printf("r=%g vs minval %g; R=%i vs minradius %i\n", r, minval, R, minradius);
-                    if ((R > minradius) && (r < minval))
+                    if (!approx3_row(k, II, mxy, cuts, x0, x1, iy, phull,
+                                     &xlo, &xhi))
                         continue;
-                    // not the right edge?
-                    if (xx < (x1-1)) {
-                        //printf("setting R\n");
-                        SET(nextR, yy-1, y0,y1);
-                        SET(nextR, yy  , y0,y1);
-                        SET(nextR, yy+1, y0,y1);
+                    for (ix=xlo; ix<xhi; ix++) {
+                        double dx = ix - mxy[2*k];
+                        double G;
+                        if (mask && !mask[off + ix])
+                            continue;
+                        G = scales[k] * exp((I[0] * dx + b) * dx + c);
+                        result[off + ix] += G;
+                        // The negative sign here is because we want
+                        // the derivatives with respect to the means,
+                        // not x,y.
+                        if (xderiv)
+                            xderiv[off + ix] += -G * (2. * I[0] * dx + b);
+                        if (yderiv)
+                            yderiv[off + ix] += -G * (2. * I[2] * dy + I[1] * dx);
                     }
-                }
-                if (anyrow) {
-                    *sx1 = xx - x0;
+                    bx0 = MIN(bx0, xlo);
+                    bx1 = MAX(bx1, xhi);
+                    by0 = MIN(by0, iy);
+                    by1 = MAX(by1, iy+1);
                 }
             }
-            if (!any)
-                break;
         }
-        rtn = 0;
-
-#undef SET
     }
+    Py_END_ALLOW_THREADS
+
 bailout:
     Py_XDECREF(np_amp);
     Py_XDECREF(np_mean);
@@ -462,10 +348,13 @@ bailout:
     Py_XDECREF(np_yderiv);
     Py_XDECREF(np_mask);
 
-    //printf("N exp calls: %i\n", n_exp - nexp0);
-
-    (*sx1)++;
-    (*sy1)++;
-
-    return rtn;
+    if ((bx0 >= bx1) || (by0 >= by1)) {
+        *sx0 = *sx1 = *sy0 = *sy1 = 0;
+    } else {
+        *sx0 = bx0 - x0;
+        *sx1 = bx1 - x0;
+        *sy0 = by0 - y0;
+        *sy1 = by1 - y0;
     }
+    return rtn;
+}
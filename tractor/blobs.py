@@ -0,0 +1,249 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+`blobs.py`
+===========
+
+Splitting a Tractor into independent "blobs": connected groups of
+sources whose footprints overlap, each of which can be optimized on
+its own (cropped) piece of the images, possibly in parallel.
+'''
+from __future__ import print_function
+import numpy as np
+
+from .engine import Tractor, logverb
+from .patch import Patch
+
+class Blob(object):
+    '''
+    A connected group of thawed sources.
+
+    - `srcs`: list of indices into the Tractor's catalog
+    - `boxes`: list (one per image) of the [x0, x1, y0, y1) bounding
+      box of the group's footprints in that image, or None if the
+      group does not touch that image.
+    '''
+    def __init__(self, srcs, boxes):
+        self.srcs = srcs
+        self.boxes = boxes
+
+    def __str__(self):
+        return 'Blob: %i sources, touching %i images' % (
+            len(self.srcs), len([b for b in self.boxes if b is not None]))
+
+def source_footprint(tractor, img, src, minsb=None, margin=0):
+    '''
+    Returns the [x0, x1, y0, y1) bounding box (clipped to the image) of
+    source *src* in image *img* -- its model mask if the Tractor has
+    them, otherwise its rendered model patch -- or None if it does not
+    touch the image.
+    '''
+    mask = tractor._getModelMaskFor(img, src)
+    if mask is None:
+        if tractor.expectModelMasks:
+            return None
+        kw = {}
+        if minsb is not None:
+            kw.update(minsb=minsb)
+        mask = tractor.getModelPatch(img, src, **kw)
+    if mask is None or mask.patch is None:
+        return None
+    H,W = img.shape
+    x0,x1,y0,y1 = mask.getExtent(margin=margin)
+    x0,x1 = max(x0, 0), min(x1, W)
+    y0,y1 = max(y0, 0), min(y1, H)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return (x0,x1,y0,y1)
+
+def _footprints(tractor, minsb=None, margin=0):
+    # [image][catalog index] -> box or None
+    cat = tractor.getCatalog()
+    fps = []
+    for img in tractor.getImages():
+        if minsb is not None:
+            fps.append([None if src is None else
+                        source_footprint(tractor, img, src, minsb=minsb,
+                                         margin=margin) for src in cat])
+            continue
+        # default footprints come from the Tractor's spatial index
+        idx = tractor.getSourceIndex(img)
+        H,W = img.shape
+        boxes = []
+        for src in cat:
+            box = None if src is None else idx.getBox(id(src))
+            if box is not None and margin:
+                x0,x1,y0,y1 = box
+                box = (max(x0 - margin, 0), min(x1 + margin, W),
+                       max(y0 - margin, 0), min(y1 + margin, H))
+            boxes.append(box)
+        fps.append(boxes)
+    return fps
+
+def _overlapping_pairs(boxes):
+    '''
+    Given an (N,4) array of [x0, x1, y0, y1) boxes, returns the
+    (i,j) index pairs of overlapping boxes (sweeping in x).
+    '''
+    I = np.argsort(boxes[:,0], kind='mergesort')
+    pairs = []
+    active = []
+    for i in I:
+        x0,x1,y0,y1 = boxes[i]
+        active = [j for j in active if boxes[j,1] > x0]
+        for j in active:
+            if boxes[j,2] < y1 and y0 < boxes[j,3]:
+                pairs.append((j, i))
+        active.append(i)
+    return pairs
+
+def find_blobs(tractor, minsb=None, margin=0, footprints=None):
+    '''
+    Splits the thawed sources of *tractor* into connected groups whose
+    footprints (see `source_footprint`) overlap in any image, expanded
+    by *margin* pixels.  (*footprints* can be given to avoid
+    re-rendering them; see `optimize_blobs`.)
+
+    Returns a list of `Blob` objects.
+    '''
+    cat = tractor.getCatalog()
+    if tractor.isParamFrozen('catalog'):
+        return []
+    srcis = [i for i in cat.getThawedParamIndices()
+             if cat[i] is not None and cat[i].numberOfParams() > 0]
+    if footprints is None:
+        footprints = _footprints(tractor, minsb=minsb, margin=margin)
+
+    # union-find over the thawed sources
+    parent = range(len(srcis))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    allboxes = []
+    for fp in footprints:
+        boxes = [fp[i] for i in srcis]
+        allboxes.append(boxes)
+        K = [k for k,b in enumerate(boxes) if b is not None]
+        if len(K) < 2:
+            continue
+        for a,b in _overlapping_pairs(np.array([boxes[k] for k in K])):
+            ra,rb = find(K[a]), find(K[b])
+            if ra != rb:
+                parent[max(ra,rb)] = min(ra,rb)
+
+    groups = {}
+    for k in range(len(srcis)):
+        groups.setdefault(find(k), []).append(k)
+
+    blobs = []
+    for root in sorted(groups.keys()):
+        K = groups[root]
+        bboxes = []
+        for boxes in allboxes:
+            bb = [boxes[k] for k in K if boxes[k] is not None]
+            if len(bb) == 0:
+                bboxes.append(None)
+                continue
+            bb = np.array(bb)
+            bboxes.append((bb[:,0].min(), bb[:,1].max(),
+                           bb[:,2].min(), bb[:,3].max()))
+        blobs.append(Blob([srcis[k] for k in K], bboxes))
+    return blobs
+
+def blob_tractor(tractor, blob, minsb=None, margin=0, footprints=None):
+    '''
+    Creates a Tractor for *blob*: its images are cropped
+    (`Image.subimage`) to the blob's bounding boxes, its catalog holds
+    copies of the blob's sources (thawed) and of any other sources
+    touching the cropped region (frozen), and its Image parameters are
+    frozen.
+    '''
+    if footprints is None:
+        footprints = _footprints(tractor, minsb=minsb, margin=margin)
+    cat = tractor.getCatalog()
+    members = [cat[i] for i in blob.srcs]
+    srcs = [src.copy() for src in members]
+    others = {}
+
+    subimgs = []
+    submasks = []
+    for img,box,fp in zip(tractor.getImages(), blob.boxes, footprints):
+        if box is None:
+            continue
+        x0,x1,y0,y1 = box
+        subimgs.append(img.subimage(x0, x1, y0, y1))
+        # other sources touching the crop
+        if minsb is None:
+            idx = tractor.getSourceIndex(img)
+            near = [idx.order[k] for k in idx.queryBox(
+                x0 - margin, x1 + margin, y0 - margin, y1 + margin)]
+        else:
+            near = range(len(cat))
+        for i in near:
+            ob = fp[i]
+            if (i in blob.srcs or ob is None or ob[0] >= x1 or x0 >= ob[1] or
+                ob[2] >= y1 or y0 >= ob[3]):
+                continue
+            if not i in others:
+                others[i] = cat[i].copy()
+        masks = {}
+        if tractor.modelMasks is not None:
+            for i,sub in zip(blob.srcs, srcs) + others.items():
+                mask = tractor._getModelMaskFor(img, cat[i])
+                if mask is not None:
+                    masks[sub] = Patch(mask.x0 - x0, mask.y0 - y0, mask.patch)
+        submasks.append(masks)
+
+    subcat = srcs + [others[i] for i in sorted(others.keys())]
+    subtr = Tractor(subimgs, subcat, optimizer=tractor.optimizer)
+    subtr.modtype = tractor.modtype
+    subtr.freezeParam('images')
+    for j in range(len(srcs), len(subcat)):
+        subtr.catalog.freezeParam(j)
+    if tractor.modelMasks is not None:
+        subtr.setModelMasks(submasks, assumeMasks=tractor.expectModelMasks)
+    return subtr
+
+def _optimize_blob(X):
+    (subtr, nsrcs, kwargs) = X
+    R = subtr.optimize_loop(**kwargs)
+    return [subtr.catalog[j].getParams() for j in range(nsrcs)], R
+
+def optimize_blobs(tractor, mp=None, blobs=None, minsb=None, margin=0,
+                   **kwargs):
+    '''
+    Optimizes the thawed sources of *tractor* blob by blob: each blob
+    (see `find_blobs`) gets its own Tractor (see `blob_tractor`) on
+    which `optimize_loop(**kwargs)` is run; the resulting source
+    parameters are then set in *tractor*.
+
+    The Image parameters are not fit.
+
+    - `mp`: optional multiprocessing object with a `map` method (eg,
+      multiprocessing.Pool or astrometry.util.multiproc) to optimize
+      the blobs in parallel; only the cropped images are shipped.
+
+    Returns a list of (blob, result) pairs, where "result" is the
+    return value of `optimize_loop` for that blob.
+    '''
+    fp = _footprints(tractor, minsb=minsb, margin=margin)
+    if blobs is None:
+        blobs = find_blobs(tractor, footprints=fp)
+    logverb('Optimizing', len(blobs), 'blobs')
+    args = [(blob_tractor(tractor, blob, minsb=minsb, footprints=fp),
+             len(blob.srcs), kwargs) for blob in blobs]
+    if mp is None:
+        results = map(_optimize_blob, args)
+    else:
+        results = mp.map(_optimize_blob, args)
+    cat = tractor.getCatalog()
+    R = []
+    for blob,(params,r) in zip(blobs, results):
+        for i,p in zip(blob.srcs, params):
+            cat[i].setParams(p)
+        R.append((blob, r))
+    return R
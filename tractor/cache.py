@@ -19,8 +19,7 @@ class TractorCacheMixin(object):
             return super(TractorCacheMixin, self).getModelPatch(
                 img, src, **kwargs)
 
-        deps = (img.hashkey(), src.hashkey())
-        deps = hash(deps)
+        deps = (img.versionkey(), src.versionkey())
         mv,mod = self.cache.get(deps, (0.,None))
         if minsb is None:
             minsb = img.modelMinval
@@ -45,6 +44,11 @@ try:
     from collections import OrderedDict
 except:
     from ordereddict import OrderedDict
+import threading
+
+# Caches may be shared by the threads of Tractor.setRenderThreads;
+# the (pure-python) OrderedDict must not be modified concurrently.
+_cachelock = threading.RLock()
 
 '''
 LRU cache.
@@ -52,13 +56,27 @@ This code is based on: http://code.activestate.com/recipes/498245-lru-and-lfu-ca
 By: Raymond Hettinger
 License: Python Software Foundation (PSF) license.
 '''
+def _nbytes(val):
+    '''
+    Returns the number of bytes in the numpy arrays in *val* (an array
+    or a tuple or list, possibly nested).
+    '''
+    if isinstance(val, (tuple, list)):
+        return sum([_nbytes(v) for v in val])
+    return getattr(val, 'nbytes', 0)
+
 class Cache(object):
     class Entry(object):
         pass
-    def __init__(self, maxsize=1000, sizeattr='size'):
+    def __init__(self, maxsize=1000, sizeattr='size', maxbytes=None):
+        '''
+        An LRU cache of at most *maxsize* entries and, if *maxbytes*
+        is given, at most *maxbytes* bytes of numpy arrays.
+        '''
         self.clear()
         self.maxsize = maxsize
         self.sizeattr = sizeattr
+        self.maxbytes = maxbytes
 
     def __del__(self):
         # OrderedDict objects seem to be prone to leaving garbage around...
@@ -82,6 +100,7 @@ class Cache(object):
             #   print 'real', refcnt(vv)
         self.hits = 0
         self.misses = 0
+        self.nbytes = 0
         
     def __setitem__(self, key, val):
         sz = 0
@@ -94,21 +113,36 @@ class Cache(object):
         e.val = val
         e.size = sz
         e.hits = 0
-        # purge LRU item
-        if len(self.dict) >= self.maxsize:
-            self.dict.popitem(0)
-        self.dict[key] = e
+        maxbytes = getattr(self, 'maxbytes', None)
+        e.nbytes = 0
+        if maxbytes is not None:
+            e.nbytes = _nbytes(val)
+        with _cachelock:
+            old = self.dict.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            # purge LRU item(s)
+            while len(self.dict) and (
+                    len(self.dict) >= self.maxsize or
+                    (maxbytes is not None and
+                     self.nbytes + e.nbytes > maxbytes)):
+                k,old = self.dict.popitem(0)
+                if old is not None:
+                    self.nbytes -= old.nbytes
+            self.dict[key] = e
+            self.nbytes += e.nbytes
 
     def __getitem__(self, key):
-        # pop
-        try:
-            e = self.dict.pop(key)
-        except KeyError:
-            self.misses += 1
-            raise
-        self.hits += 1
-        # reinsert (to record recent use)
-        self.dict[key] = e
+        with _cachelock:
+            # pop
+            try:
+                e = self.dict.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            # reinsert (to record recent use)
+            self.dict[key] = e
         if e is None:
             return e
         e.hits += 1
@@ -163,6 +197,13 @@ class Cache(object):
                     size = v.size
             print '  ', hits, size, k
 
+    def stats(self):
+        '''
+        Returns (hits, misses, number of entries, bytes held), the
+        bytes being counted only if *maxbytes* was given.
+        '''
+        return (self.hits, self.misses, len(self), self.nbytes)
+
     def totalSize(self):
         sz = 0
         for k,v in self.dict.items():
@@ -201,8 +242,165 @@ class NullCache(object):
         return args[1]
     def put(self, *args):
         pass
+    def stats(self):
+        return (0, 0, 0, 0)
+
     def totalSize(self):
         return 0
     def __len__(self):
         return len(self.dict)
 
+
+
+class SpatialCache(object):
+    '''
+    A cache of a function of pixel position, f(x, y), that evaluates
+    it at the center of the *rounding* x *rounding*-pixel cell
+    containing the requested position; positions within a cell share
+    one value.  The values are kept in an LRU Cache of at most
+    *maxsize* entries and *maxbytes* bytes of numpy arrays.
+
+    The cached values are returned as-is, so callers must not modify
+    them.  Pickling keeps the settings but drops the values.
+    '''
+    def __init__(self, rounding=16, maxbytes=64*1024*1024, maxsize=10000):
+        self.rounding = rounding
+        self.maxbytes = maxbytes
+        self.maxsize = maxsize
+        self.cache = Cache(maxsize=maxsize, maxbytes=maxbytes)
+
+    def __getstate__(self):
+        return (self.rounding, self.maxbytes, self.maxsize)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        '''
+        Returns (hits, misses, number of entries, bytes held).
+        '''
+        return self.cache.stats()
+
+    def cell(self, x, y, origin=(0.,0.)):
+        '''
+        Returns the integer (ix, iy) of the cell containing (*x*, *y*),
+        counting cells from *origin*.
+        '''
+        import math
+        ox,oy = origin
+        return (int(math.floor((x - ox) / self.rounding)),
+                int(math.floor((y - oy) / self.rounding)))
+
+    def center(self, ix, iy, origin=(0.,0.)):
+        ox,oy = origin
+        return (ox + (ix + 0.5) * self.rounding,
+                oy + (iy + 0.5) * self.rounding)
+
+    def __call__(self, func, x, y, origin=(0.,0.), key=None):
+        '''
+        Returns *func* evaluated at the center of the cell containing
+        (*x*, *y*).
+
+        The values are cached under *key* (default: the function's
+        name) and the cell.
+        '''
+        if key is None:
+            key = func.__name__
+        ix,iy = self.cell(x, y, origin)
+        val = self.cache.get((key, ix, iy), None)
+        if val is None:
+            val = func(*self.center(ix, iy, origin))
+            self.cache.put((key, ix, iy), val)
+        return val
+
+    def precompute(self, func, W, H, origin=(0.,0.), threads=None, key=None):
+        '''
+        Evaluates *func* for every cell overlapping the image
+        [0,W) x [0,H), using *threads* Python threads (default: the
+        number of CPUs).  If the grid does not fit in the cache, the
+        cells evaluated first are evicted.
+        '''
+        if key is None:
+            key = func.__name__
+        ix0,iy0 = self.cell(0, 0, origin)
+        ix1,iy1 = self.cell(W, H, origin)
+        cells = [(ix,iy) for iy in range(iy0, iy1+1)
+                 for ix in range(ix0, ix1+1)]
+        def _eval(cell):
+            return func(*self.center(cell[0], cell[1], origin))
+        if threads is None:
+            import multiprocessing
+            threads = multiprocessing.cpu_count()
+        # (the first cell is evaluated alone, so that any lazy setup
+        # in *func* is not run concurrently)
+        vals = [_eval(cells[0])]
+        if threads > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(threads)
+            try:
+                vals.extend(pool.map(_eval, cells[1:]))
+            finally:
+                pool.close()
+        else:
+            vals.extend(map(_eval, cells[1:]))
+        for (ix,iy),val in zip(cells, vals):
+            self.cache.put((key, ix, iy), val)
+
+
+class SpatialCacheMixin(object):
+    '''
+    Lets a spatially varying PSF opt in to caching the PSFs it
+    instantiates, with a `SpatialCache` set by `setSpatialCache`.
+
+    Subclasses route the method to be cached through
+    `_spatialCached`, name it in *spatialCachedMethod* for
+    `precomputeSpatialCache`, and may override `_spatialCacheOrigin`
+    to count the cells in their own frame.
+    '''
+    spatialcache = None
+    spatialCachedMethod = None
+
+    def setSpatialCache(self, rounding=16, maxbytes=64*1024*1024,
+                        maxsize=10000):
+        '''
+        Caches this PSF's instantiations at the centers of
+        *rounding*-pixel cells; see `SpatialCache`.  *rounding* = 0
+        turns the cache off.
+        '''
+        if rounding:
+            self.spatialcache = SpatialCache(rounding=rounding,
+                                             maxbytes=maxbytes,
+                                             maxsize=maxsize)
+        else:
+            self.spatialcache = None
+
+    def getSpatialCacheStats(self):
+        '''
+        Returns (hits, misses, number of entries, bytes held), or None
+        if the cache is off.
+        '''
+        if self.spatialcache is None:
+            return None
+        return self.spatialcache.stats()
+
+    def precomputeSpatialCache(self, W, H, method=None, threads=None):
+        '''
+        Fills the cache (which must be on) for a whole W x H image, in
+        parallel; see `SpatialCache.precompute`.
+        '''
+        if method is None:
+            method = self.spatialCachedMethod
+        self.spatialcache.precompute(getattr(self, method), W, H,
+                                     origin=self._spatialCacheOrigin(),
+                                     threads=threads)
+
+    def _spatialCacheOrigin(self):
+        return (0., 0.)
+
+    def _spatialCached(self, func, x, y):
+        if self.spatialcache is None:
+            return func(x, y)
+        return self.spatialcache(func, x, y, origin=self._spatialCacheOrigin())
@@ -85,6 +85,7 @@ class CfhtPhotoCal(BaseParams):
 	def setParam(self, i, p):
 		assert(i == 0)
 		self.phot_c = p
+		self.bumpVersion()
 
 	def getParamNames(self):
 		return ['phot_c']
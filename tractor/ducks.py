@@ -31,6 +31,17 @@ class Params(object):
         '''
         return ()
 
+    def versionkey(self):
+        '''
+        Returns a cheap cache key for the current state of this
+        `Params` object; it must change whenever the state does.
+
+        `BaseParams` implements this with a modification stamp (see
+        `BaseParams.getVersion`); this default falls back to
+        `hashkey()`.
+        '''
+        return self.hashkey()
+
     #def __hash__(self):
     #    ''' Params must be hashable. '''
     #    return None
@@ -250,6 +261,21 @@ class Source(Params):
         '''
         pass
 
+    def getModelMixtures(self, img, minsb=None):
+        '''
+        Returns a list of (MixtureOfGaussians, (fx,fy), [x0,x1,y0,y1],
+        counts, minval) tuples that, rendered with
+        MixtureOfGaussians.evaluate_grid_batch (offset by (fx,fy),
+        into the box [x0,x1), [y0,y1), with amplitudes scaled by
+        counts, to the surface brightness minval), sum to this
+        Source's model in the given `Image`.  This lets the Tractor
+        render many sources with a single call into the C extension.
+
+        Returns None if this Source cannot be rendered that way (eg,
+        with a pixelized PSF); getModelPatch() is then used.
+        '''
+        return None
+
 class Brightness(Params):
     '''
     Duck-type definition of the brightness of an astronomical source.
@@ -143,6 +143,66 @@ class EllipseE(ParamList):
                               [-st / ab, ct]])
         return G
 
+    def _getBasisTerms(self):
+        '''
+        Returns (r_deg, dr_deg, e, de): the radius in degrees and its
+        derivative with respect to the first parameter, and the
+        ellipticity and its derivative with respect to the hypot of
+        the last two parameters.
+        '''
+        return (self.re / 3600., 1. / 3600., self.e, 1.)
+
+    def getRaDecBasisDerivatives(self):
+        '''
+        Returns the derivatives of getRaDecBasis() with respect to the
+        (thawed) parameters, as a list of 2x2 matrices.
+
+        At e = 0 the basis is not differentiable in e1,e2 (it rotates
+        discontinuously); there we return matrices dG such that
+        dG G^T + G dG^T is the derivative of G G^T -- which is all a
+        profile depends on -- in the direction of increasing e1 or e2.
+        '''
+        r, dr, e, de = self._getBasisTerms()
+        a1,a2 = self.getAllParams()[1:]
+        h = np.hypot(a1, a2)
+        theta = np.arctan2(a2, a1) / 2.
+
+        # G = r * R(theta) * diag(q, 1), with q = 1/ab
+        maxab = 1000.
+        if e >= 1. or (1.+e)/(1.-e) >= maxab:
+            q,dq = 1./maxab, 0.
+        else:
+            q,dq = (1.-e)/(1.+e), -2./(1.+e)**2
+
+        # (dr, de, theta, dtheta) for each parameter
+        if h > 0:
+            terms = [(dr, 0., theta, 0.),
+                     (0., de * a1 / h, theta, -a2 / (2. * h**2)),
+                     (0., de * a2 / h, theta,  a1 / (2. * h**2))]
+        else:
+            terms = [(dr, 0., theta, 0.),
+                     (0., de, 0., 0.),
+                     (0., de, np.pi/4., 0.)]
+        def rotation(th):
+            ct = np.cos(th)
+            st = np.sin(th)
+            return np.array([[ ct, st],
+                             [-st, ct]])
+        R0 = rotation(theta)
+        S = np.diag([q, 1.])
+        dG = []
+        for dri,dei,th,dth in terms:
+            R = rotation(th)
+            dR = rotation(th + np.pi/2.)
+            dS = np.diag([dq * dei, 0.])
+            d = (dri * np.dot(R, S) +
+                 r * (dth * np.dot(dR, S) + np.dot(R, dS)))
+            if th != theta:
+                # at e = 0, where G = r R0
+                d = np.dot(d, np.dot(R.T, R0))
+            dG.append(d)
+        return [dG[i] for i in self.getThawedParamIndices()]
+
     def getTensor(self, cd):
         # G takes unit vectors (in r_e) to degrees (~intermediate world coords)
         G = self.getRaDecBasis()
@@ -250,7 +310,13 @@ class EllipseESoft(EllipseE):
         Returns position angle in *radians*
         '''
         return np.arctan2(self.ee2, self.ee1) / 2.
-    
+
+    def _getBasisTerms(self):
+        r = self.re
+        dr = r if (-100 < self.logre < 100) else 0.
+        ee = np.hypot(self.ee1, self.ee2)
+        return (r / 3600., dr / 3600., 1. - np.exp(-ee), np.exp(-ee))
+
     # Have to override this because all parameter values are legal,
     # unlike the superclass.
     def isLegal(self):
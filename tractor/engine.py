@@ -15,8 +15,9 @@ import numpy as np
 
 from astrometry.util.ttime import Time
 
-from .utils import MultiParams, _isint, get_class_from_name
-from .patch import Patch
+from .utils import (MultiParams, PackedParams, _isint, _contains,
+                    get_class_from_name)
+from .patch import Patch, add_patches
 from .image import Image
 
 def logverb(*args):
@@ -38,6 +39,33 @@ def set_fp_err():
     '''
     return np.seterr(all='raise')
         
+def _merge_boxes(boxes, W, H):
+    '''
+    Given a list of [x0,x1,y0,y1) boxes, clips them to the image
+    bounds (W,H) and merges any that overlap, returning a list of
+    disjoint boxes that cover them.
+    '''
+    merged = []
+    for (x0,x1,y0,y1) in boxes:
+        x0,x1 = max(x0, 0), min(x1, W)
+        y0,y1 = max(y0, 0), min(y1, H)
+        if x0 >= x1 or y0 >= y1:
+            continue
+        # Absorb any existing boxes that overlap this one (which may
+        # grow it to overlap others, hence the loop).
+        overlap = True
+        while overlap:
+            overlap = False
+            for i,(bx0,bx1,by0,by1) in enumerate(merged):
+                if bx0 < x1 and x0 < bx1 and by0 < y1 and y0 < by1:
+                    x0,x1 = min(x0,bx0), max(x1,bx1)
+                    y0,y1 = min(y0,by0), max(y1,by1)
+                    del merged[i]
+                    overlap = True
+                    break
+        merged.append((x0,x1,y0,y1))
+    return merged
+
 class Catalog(MultiParams):
     '''
     A list of Source objects.  This class allows the Tractor to treat
@@ -90,6 +118,28 @@ class OptResult():
     # quack
     pass
 
+class IncrementalModel(object):
+    '''
+    The persistent state kept by the Tractor for one Image when
+    incremental model-image maintenance is turned on (see
+    `Tractor.setIncrementalModels`): the model image, chi image and
+    chi-squared, plus the last model Patch rendered for each source.
+
+    *imkey* is the Image's versionkey when the model was built; if the
+    Image changes, the model is rebuilt from scratch.  *sources* is a
+    dict keyed by id(source), with values (source, key, mask, patch)
+    where *key* identifies the source parameters (and model mask) the
+    patch was rendered with.
+    '''
+    def __init__(self, img, imkey, minsb):
+        self.img = img
+        self.imkey = imkey
+        self.minsb = minsb
+        self.sources = {}
+        self.mod = None
+        self.chi = None
+        self.chisq = 0.
+
 class Tractor(MultiParams):
     '''
     Heavy farm machinery.
@@ -121,6 +171,14 @@ class Tractor(MultiParams):
         self.modtype = np.float32
         self.modelMasks = None
         self.expectModelMasks = False
+        self.incrementalModels = False
+        self.batchRendering = False
+        self.renderThreads = 1
+        self._renderPool = None
+        self.clearIncrementalModels()
+        self.packedParams = None
+        self.clearSourceIndexes()
+        self._imageIndices = {}
         if optimizer is None:
             from .lsqr_optimizer import LsqrOptimizer
             self.optimizer = LsqrOptimizer()
@@ -145,12 +203,21 @@ class Tractor(MultiParams):
 
     # For pickling
     def __getstate__(self):
-        version = 1
+        # (the incremental model buffers are not pickled; they get
+        # rebuilt on demand.  Nor is the render thread pool.)
+        version = 4
         S = (version, self.getImages(), self.getCatalog(), self.liquid,
              self.modtype, self.modelMasks, self.expectModelMasks,
-             self.optimizer)
+             self.optimizer, self.incrementalModels,
+             self.packedParams is not None, self.batchRendering)
         return S
     def __setstate__(self, state):
+        self.incrementalModels = False
+        self.batchRendering = False
+        self.renderThreads = 1
+        self._renderPool = None
+        self.packedParams = None
+        packed = False
         if len(state) == 6:
             # "backwards compat"
             (images, catalog, self.liquid, self.modtype, self.modelMasks,
@@ -160,7 +227,70 @@ class Tractor(MultiParams):
         elif len(state) == 8:
             (ver, images, catalog, self.liquid, self.modtype, self.modelMasks,
              self.expectModelMasks, self.optimizer) = state
+        elif len(state) == 9:
+            (ver, images, catalog, self.liquid, self.modtype, self.modelMasks,
+             self.expectModelMasks, self.optimizer,
+             self.incrementalModels) = state
+        elif len(state) == 10:
+            (ver, images, catalog, self.liquid, self.modtype, self.modelMasks,
+             self.expectModelMasks, self.optimizer,
+             self.incrementalModels, packed) = state
+        elif len(state) == 11:
+            (ver, images, catalog, self.liquid, self.modtype, self.modelMasks,
+             self.expectModelMasks, self.optimizer,
+             self.incrementalModels, packed, self.batchRendering) = state
         self.subs = [images, catalog]
+        self._adoptSubs()
+        self.clearIncrementalModels()
+        self.clearSourceIndexes()
+        self._imageIndices = {}
+        if packed:
+            self.setPackedParams()
+
+    def setPackedParams(self, packed=True):
+        '''
+        Turns on (or off) packed parameter storage: the parameters of
+        all the thawed Images and Sources are stored in one contiguous
+        numpy array, so that getParams() and setParams() (which the
+        optimizers call many times per step) become single vectorized
+        operations rather than walks over the whole Params tree.  See
+        `PackedParams`.
+        '''
+        if self.packedParams is not None:
+            self.packedParams.unpack()
+            self.packedParams = None
+        if packed:
+            self.packedParams = PackedParams(self)
+
+    def _getPackedParams(self):
+        pp = self.packedParams
+        if pp is not None and not pp.isValid():
+            pp.pack()
+        return pp
+
+    def numberOfParams(self):
+        pp = self._getPackedParams()
+        if pp is None:
+            return super(Tractor, self).numberOfParams()
+        return pp.numberOfParams()
+
+    def getParams(self):
+        pp = self._getPackedParams()
+        if pp is None:
+            return super(Tractor, self).getParams()
+        return pp.getParams()
+
+    def setParams(self, p):
+        pp = self._getPackedParams()
+        if pp is None:
+            return super(Tractor, self).setParams(p)
+        pp.setParams(p)
+
+    def setParam(self, i, p):
+        pp = self._getPackedParams()
+        if pp is None or pp.isMirrored(i):
+            return super(Tractor, self).setParam(i, p)
+        return pp.setParam(i, p)
 
     def getNImages(self):
         return len(self.images)
@@ -257,6 +387,17 @@ class Tractor(MultiParams):
         '''
         return self.optimizer.optimize_loop(self, **kwargs)
 
+    def optimize_blobs(self, **kwargs):
+        '''
+        Splits the thawed sources into connected groups of overlapping
+        sources ("blobs") and runs `optimize_loop` on each
+        independently, on cropped images, optionally in parallel.
+
+        See `tractor.blobs.optimize_blobs` for the arguments.
+        '''
+        from .blobs import optimize_blobs
+        return optimize_blobs(self, **kwargs)
+
     def getDerivs(self):
         '''
         Computes model-image derivatives for each parameter.
@@ -301,7 +442,7 @@ class Tractor(MultiParams):
                     allderivs.append([(deriv, img)])
                 del mod0
 
-        for src in srcs:
+        def srcderivs(src):
             srcderivs = [[] for i in range(src.numberOfParams())]
             for img in self.images:
                 derivs = self._getSourceDerivatives(src, img)
@@ -309,7 +450,14 @@ class Tractor(MultiParams):
                     if deriv is None:
                         continue
                     srcderivs[k].append((deriv, img))
-            allderivs.extend(srcderivs)
+            return srcderivs
+
+        if self.renderThreads > 1 and len(srcs) > 1:
+            allsrcderivs = self._getRenderPool().map(srcderivs, srcs)
+        else:
+            allsrcderivs = map(srcderivs, srcs)
+        for d in allsrcderivs:
+            allderivs.extend(d)
         #print('allderivs:', len(allderivs))
         #print('N params:', self.numberOfParams())
 
@@ -339,16 +487,280 @@ class Tractor(MultiParams):
         self.modelMasks = masks
         assert((masks is None) or (len(masks) == len(self.images)))
         self.expectModelMasks = (masks is not None) and assumeMasks
+        self.clearIncrementalModels()
+        self.clearSourceIndexes()
+
+    def setIncrementalModels(self, incremental=True):
+        '''
+        Turns on (or off) incremental model-image maintenance.
+
+        In this mode, the Tractor keeps a persistent model image, chi
+        image and chi-squared for each Image, plus the last model
+        patch rendered for each source.  When a model image, chi
+        image or likelihood is requested, only the sources whose
+        version stamps (or model masks) have changed since the last call
+        are re-rendered: their old patches are subtracted and the new
+        ones added, and chi and chi-squared are updated over just the
+        affected pixels.  This makes eg the line search in the
+        optimizer, or emcee steps that move a few sources, cost
+        O(changed sources) rather than O(all sources).
+
+        If an Image's own parameters (sky, PSF, etc) change, its model
+        is rebuilt from scratch.
+
+        Only the default calls (all sources, sky included, default
+        *minsb*; getModelImage's default is the Image's modelMinval,
+        which is 0 unless set) are maintained incrementally; other calls are
+        computed from scratch as usual.  The chi image and likelihood
+        are computed with *minsb* = 0, so an Image with a non-zero
+        modelMinval keeps two persistent models.  These are kept in
+        double precision to avoid accumulating round-off errors.
+        '''
+        self.incrementalModels = incremental
+        self.clearIncrementalModels()
+
+    def setBatchRendering(self, batch=True):
+        '''
+        Turns on (or off) batch rendering in getModelImage.
+
+        In this mode, sources that can be described as mixtures of
+        Gaussians (see Source.getModelMixtures) -- point sources and
+        galaxies with mixture-of-Gaussians PSFs -- are rendered
+        straight into the model image with a single call into the C
+        extension, rather than one call (and one Patch) per source.
+        Sources with model masks, and all others, are rendered as
+        usual.
+
+        The truncation differs slightly from getModelPatch(): each
+        source's components are evaluated over its whole box down to
+        the *minsb* surface brightness.
+        '''
+        self.batchRendering = batch
+
+    def setRenderThreads(self, nthreads=None):
+        '''
+        Sets the number of Python threads used to render sources in
+        getModelImage and compute their derivatives in getDerivs
+        (default: the number of CPUs; 1 turns this off).
+
+        The C rendering kernels release the GIL, so sources rendered
+        in different threads run concurrently.  getModelImage
+        partitions the sources across the threads, each of which
+        accumulates its sources into its own model buffer; the
+        buffers are summed at the end.  getDerivs computes the
+        sources' derivatives in parallel.
+
+        This setting (and the thread pool) are not pickled.
+        '''
+        if nthreads is None:
+            import multiprocessing
+            nthreads = multiprocessing.cpu_count()
+        nthreads = max(1, int(nthreads))
+        if self._renderPool is not None and nthreads != self.renderThreads:
+            self._renderPool.close()
+            self._renderPool = None
+        self.renderThreads = nthreads
+
+    def _getRenderPool(self):
+        if self._renderPool is None:
+            from multiprocessing.pool import ThreadPool
+            self._renderPool = ThreadPool(self.renderThreads)
+        return self._renderPool
+
+    def clearIncrementalModels(self):
+        '''
+        Drops all incremental model-image state; see
+        `setIncrementalModels`.
+        '''
+        self.incremental = {}
+
+    def _getIncrementalModel(self, img, minsb):
+        '''
+        Returns the up-to-date IncrementalModel for the given Image,
+        building or updating it as necessary.
+        '''
+        # (getModelImage's default minsb is the Image's modelMinval,
+        # while getChiImage and getLogLikelihood render to minsb=0;
+        # they share one state per Image only if modelMinval is 0,
+        # and otherwise two are kept and updated)
+        if minsb is None:
+            minsb = img.modelMinval
+        key = (id(img), minsb)
+        imkey = img.versionkey()
+        state = self.incremental.get(key, None)
+        if state is None or state.img is not img or state.imkey != imkey:
+            state = self._buildIncrementalModel(img, imkey, minsb)
+            self.incremental[key] = state
+            return state
+
+        mod = state.mod
+        H,W = mod.shape
+        # Pixel regions [x0,x1,y0,y1] where the model changed.
+        regions = []
+        def _remove(patch):
+            if patch is None or patch.patch is None:
+                return
+            patch.addTo(mod, scale=-1.)
+            regions.append(patch.getExtent())
+        def _add(patch):
+            if patch is None or patch.patch is None:
+                return
+            patch.addTo(mod)
+            regions.append(patch.getExtent())
+
+        current = set()
+        for src in self.catalog:
+            if src is None:
+                continue
+            sid = id(src)
+            current.add(sid)
+            mask = self._getModelMaskFor(img, src)
+            skey = (src.versionkey(), id(mask))
+            old = state.sources.get(sid, None)
+            if old is not None and old[1] == skey:
+                continue
+            patch = self.getModelPatch(img, src, minsb=minsb)
+            if old is not None:
+                _remove(old[3])
+            _add(patch)
+            state.sources[sid] = (src, skey, mask, patch)
+
+        # Sources that have been removed from the catalog
+        for sid in list(state.sources.keys()):
+            if sid in current:
+                continue
+            _remove(state.sources.pop(sid)[3])
+
+        if len(regions) == 0:
+            return state
+
+        data = img.getImage()
+        ie = img.getInvError()
+        chi = state.chi
+        for (x0,x1,y0,y1) in _merge_boxes(regions, W, H):
+            slc = (slice(y0, y1), slice(x0, x1))
+            state.chisq -= np.sum(chi[slc]**2)
+            chi[slc] = (data[slc] - mod[slc]) * ie[slc]
+            state.chisq += np.sum(chi[slc]**2)
+        return state
+
+    def _buildIncrementalModel(self, img, imkey, minsb):
+        state = IncrementalModel(img, imkey, minsb)
+        mod = np.zeros(img.getModelShape(), np.float64)
+        img.getSky().addTo(mod)
+        for src in self.catalog:
+            if src is None:
+                continue
+            mask = self._getModelMaskFor(img, src)
+            patch = self.getModelPatch(img, src, minsb=minsb)
+            state.sources[id(src)] = (src, (src.versionkey(), id(mask)),
+                                      mask, patch)
+            if patch is not None:
+                patch.addTo(mod)
+        state.mod = mod
+        state.chi = (img.getImage() - mod) * img.getInvError()
+        state.chisq = np.sum(state.chi**2)
+        return state
+
+    def _getImageIndex(self, image):
+        # (cached) self.images.index(image)
+        i = self._imageIndices.get(id(image))
+        if i is None or i >= len(self.images) or self.images[i] is not image:
+            self._imageIndices = dict([(id(im),j) for j,im
+                                       in enumerate(self.images)])
+            i = self._imageIndices.get(id(image))
+            if i is None:
+                raise ValueError('Image not in this Tractor')
+        return i
 
     def _getModelMaskFor(self, image, src):
         if self.modelMasks is None:
             return None
-        i = self.images.index(image)
+        i = self._getImageIndex(image)
         try:
             return self.modelMasks[i][src]
         except KeyError:
             return None
 
+    def clearSourceIndexes(self):
+        '''
+        Drops the spatial indexes built by `getSourceIndex`.
+        '''
+        self.sourceIndexes = {}
+
+    def getSourceIndex(self, img, cellsize=64):
+        '''
+        Returns a `SourceIndex` of the pixel bounding boxes of the
+        sources in image *img*: their model masks if set (see
+        `setModelMasks`), otherwise their rendered model patches.
+
+        The index is kept up to date as the catalog changes: boxes are
+        recomputed only for sources whose parameters have changed
+        (according to their version stamps), and the whole index is
+        rebuilt if the image changes.  Keys are id(source).
+        '''
+        from .sourceindex import SourceIndex
+        from .blobs import source_footprint
+        if _isint(img):
+            img = self.getImage(img)
+        idx = self.sourceIndexes.get(id(img))
+        imkey = img.versionkey()
+        if idx is None or idx.img is not img or idx.imkey != imkey:
+            H,W = img.shape
+            idx = SourceIndex(W, H, cellsize=cellsize)
+            idx.img = img
+            idx.imkey = imkey
+            idx.version = None
+            self.sourceIndexes[id(img)] = idx
+        version = self.getVersion()
+        if idx.version == version:
+            return idx
+        # catalog order, for sorting query results
+        idx.order = {}
+        for i,src in enumerate(self.catalog):
+            if src is None:
+                continue
+            key = id(src)
+            idx.order[key] = i
+            stamp = (src.getVersion(), id(self._getModelMaskFor(img, src)))
+            e = idx.get(key)
+            if e is not None and e[0] is src and e[2] == stamp:
+                continue
+            idx.insert(key, src, source_footprint(self, img, src), stamp)
+        for key in list(idx.keys()):
+            if not key in idx.order:
+                idx.remove(key)
+        idx.version = version
+        return idx
+
+    def _indexedSources(self, idx, keys):
+        keys = sorted(keys, key=lambda k: idx.order[k])
+        return [idx.get(k)[0] for k in keys]
+
+    def getSourcesInBox(self, img, x0, x1, y0, y1):
+        '''
+        Returns the sources (in catalog order) whose bounding boxes in
+        image *img* overlap [x0, x1) x [y0, y1).
+        '''
+        idx = self.getSourceIndex(img)
+        return self._indexedSources(idx, idx.queryBox(x0, x1, y0, y1))
+
+    def getSourcesAtPoint(self, img, x, y):
+        '''
+        Returns the sources (in catalog order) whose bounding boxes in
+        image *img* contain pixel (x, y).
+        '''
+        idx = self.getSourceIndex(img)
+        return self._indexedSources(idx, idx.queryPoint(x, y))
+
+    def getOverlappingSources(self, img, src):
+        '''
+        Returns the other sources (in catalog order) whose bounding
+        boxes in image *img* overlap that of *src*.
+        '''
+        idx = self.getSourceIndex(img)
+        return self._indexedSources(idx, idx.queryKey(id(src)))
+
     def _checkModelMask(self, patch, mask):
 
         if self.expectModelMasks:
@@ -414,19 +826,78 @@ class Tractor(MultiParams):
         '''
         if _isint(img):
             img = self.getImage(img)
+        if (self.incrementalModels and srcs is None and sky and
+            (minsb is None or minsb == img.modelMinval)):
+            return self._getIncrementalModel(img, minsb).mod.astype(
+                self.modtype)
         mod = np.zeros(img.getModelShape(), self.modtype)
         if sky:
             img.getSky().addTo(mod)
         if srcs is None:
             srcs = self.catalog
+        srcs = [src for src in srcs if src is not None]
+        nt = min(self.renderThreads, len(srcs))
+        if nt > 1:
+            # Each thread renders its share of the sources into its
+            # own buffer.
+            def render(srcs):
+                m = np.zeros(mod.shape, mod.dtype)
+                self._addModels(img, srcs, m, minsb)
+                return m
+            for m in self._getRenderPool().map(
+                    render, [srcs[i::nt] for i in range(nt)]):
+                mod += m
+        else:
+            self._addModels(img, srcs, mod, minsb)
+        return mod
+
+    def _addModels(self, img, srcs, mod, minsb):
+        '''
+        Adds the models of *srcs* in *img* to *mod*.
+        '''
+        if self.batchRendering:
+            srcs = self._addBatchModels(img, srcs, mod, minsb)
         for src in srcs:
-            if src is None:
-                continue
             patch = self.getModelPatch(img, src, minsb=minsb)
             if patch is None:
                 continue
             patch.addTo(mod)
-        return mod
+
+    def _addBatchModels(self, img, srcs, mod, minsb):
+        '''
+        Renders the sources in *srcs* that support it (see
+        setBatchRendering) into *mod* in one batch; returns the
+        remaining sources.
+        '''
+        from .mixture_profiles import MixtureOfGaussians
+        rest = []
+        mixes = []
+        for src in srcs:
+            if src is None:
+                continue
+            if self.modelMasks is not None:
+                rest.append(src)
+                continue
+            mm = getattr(src, 'getModelMixtures', None)
+            if mm is not None:
+                mm = mm(img, minsb=minsb)
+            if mm is None:
+                rest.append(src)
+                continue
+            mixes.extend(mm)
+        if len(mixes) == 0:
+            return rest
+        mix,offsets,extents,counts,minvals = zip(*mixes)
+        if mod.dtype == np.float64:
+            result = mod
+        else:
+            result = np.zeros(mod.shape)
+        MixtureOfGaussians.evaluate_grid_batch(
+            mix, offsets, extents, minvals=minvals, scales=counts,
+            result=result)
+        if result is not mod:
+            mod += result
+        return rest
 
     def getModelImages(self, **kwargs):
         for img in self.images:
@@ -448,7 +919,11 @@ class Tractor(MultiParams):
         # else:
         #     print('Sources:', srcs)
         # print('LogPriorDerivatives:', self.getLogPriorDerivatives())
-            
+
+        if (self.incrementalModels and srcs is None and
+            (minsb is None or minsb == 0.)):
+            return self._getIncrementalModel(img, minsb).chi.copy()
+
         mod = self.getModelImage(img, srcs=srcs, minsb=minsb)
         #print('mod:', mod.shape)
         chi = (img.getImage() - mod) * img.getInvError()
@@ -468,6 +943,11 @@ class Tractor(MultiParams):
         return chi
 
     def getLogLikelihood(self):
+        if self.incrementalModels:
+            chisq = 0.
+            for img in self.images:
+                chisq += self._getIncrementalModel(img, 0.).chisq
+            return -0.5 * chisq
         chisq = 0.
         for i,chi in enumerate(self.getChiImages()):
             chisq += (chi.astype(float) ** 2).sum()
@@ -491,3 +971,172 @@ class Tractor(MultiParams):
             return -np.inf
         return lnp
 
+    def getLogProbBatch(self, X, mp=None, nchunks=None):
+        '''
+        Returns a numpy array of the posterior log PDF evaluated at
+        each row of *X*, an array of shape (N, numberOfParams()) --
+        eg, the positions of the walkers of an ensemble sampler.
+
+        This gives the same answer as calling this Tractor (ie,
+        setParams() followed by getLogProb()) for each row, but when
+        the Image parameters are frozen, the sky and the frozen
+        sources are rendered only once per image and shared by all
+        rows, and the unit-flux model patches of the thawed sources
+        are reused between rows that differ only in the sources'
+        fluxes.
+
+        - `mp:` optional multiprocessing object with a `map` method
+          (eg, multiprocessing.Pool or astrometry.util.multiproc);
+          *X* is split into *nchunks* chunks (default: the number of
+          CPUs) that are evaluated in parallel.  See also
+          `LogProbPool`, which avoids shipping the images to the
+          workers for each call.
+
+        The parameters are restored to their original values on return.
+        '''
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        if mp is not None:
+            if nchunks is None:
+                import multiprocessing
+                nchunks = multiprocessing.cpu_count()
+            chunks = np.array_split(X, max(1, min(nchunks, len(X))))
+            lnps = mp.map(_logprob_batch_chunk,
+                          [(self, chunk) for chunk in chunks])
+            return np.hstack(lnps)
+
+        p0 = self.getParams()
+        try:
+            if (self.isParamFrozen('images') or
+                self.images.numberOfParams() == 0):
+                lnp = self._getLogProbBatch(X)
+            else:
+                # Image parameters change the sky and every source model;
+                # nothing to share.
+                lnp = np.array([self(x) for x in X])
+        finally:
+            self.setParams(p0)
+        return lnp
+
+    def _getLogProbBatch(self, X):
+        if self.isParamFrozen('catalog'):
+            srcs = []
+        else:
+            srcs = [src for src in self.catalog.getThawedSources()
+                    if src is not None]
+        fixed = [src for src in self.catalog
+                 if src is not None and not _contains(srcs, src)]
+
+        # sky + frozen sources, shared by all rows.
+        bgs = [self.getModelImage(img, srcs=fixed, minsb=0.)
+               for img in self.images]
+        # unit-flux patches, keyed by the non-flux parameters
+        umods = {}
+
+        lnps = np.zeros(len(X))
+        for i,x in enumerate(X):
+            self.setParams(x)
+            lnprior = self.getLogPrior()
+            if lnprior == -np.inf:
+                lnps[i] = lnprior
+                continue
+            chisq = 0.
+            for img,bg in zip(self.images, bgs):
+                mod = bg.copy()
+                for src in srcs:
+                    patch = self._getBatchModelPatch(img, src, umods)
+                    if patch is None:
+                        continue
+                    patch.addTo(mod)
+                chi = (img.getImage() - mod) * img.getInvError()
+                chisq += (chi.astype(float) ** 2).sum()
+            lnp = lnprior - 0.5 * chisq
+            if np.isnan(lnp):
+                lnp = -np.inf
+            lnps[i] = lnp
+        return lnps
+
+    def _getBatchModelPatch(self, img, src, umods):
+        mask = self._getModelMaskFor(img, src)
+        # HACK -- assume no mask -> no overlap
+        if self.expectModelMasks and mask is None:
+            return None
+        key = None
+        if (isinstance(src, MultiParams) and
+            hasattr(src, 'getUnitFluxModelPatches') and
+            hasattr(src, 'getBrightnesses')):
+            bright = src.getBrightnesses()
+            key = (id(src), id(img), id(mask),
+                   tuple(tuple(sub.getAllParams()) for sub in src.subs
+                         if not _contains(bright, sub)))
+        if key is None:
+            return src.getModelPatch(img, minsb=0., modelMask=mask)
+        ums = umods.get(key)
+        if ums is None:
+            ums = src.getUnitFluxModelPatches(img, minval=0., modelMask=mask)
+            umods[key] = ums
+        if len(ums) != len(bright):
+            return src.getModelPatch(img, minsb=0., modelMask=mask)
+        pcal = img.getPhotoCal()
+        mod = None
+        for um,b in zip(ums, bright):
+            if um is None or um.patch is None:
+                continue
+            counts = pcal.brightnessToCounts(b)
+            if counts == 0 or not np.isfinite(np.float32(counts)):
+                continue
+            mod = add_patches(mod, um * counts)
+        return mod
+
+
+def _logprob_batch_chunk(X):
+    (tractor, x) = X
+    return tractor.getLogProbBatch(x)
+
+# The Tractor held by each LogProbPool worker process
+_pool_tractor = None
+
+def _logprob_pool_init(tractor):
+    global _pool_tractor
+    _pool_tractor = tractor
+
+def _logprob_pool_chunk(x):
+    return _pool_tractor.getLogProbBatch(x)
+
+class LogProbPool(object):
+    '''
+    A pool of worker processes for evaluating Tractor.getLogProbBatch()
+    in parallel.
+
+    The Tractor (including its images) is handed to the workers once,
+    when the pool is created -- with the "fork" start method the
+    workers share the parent's image pixels copy-on-write -- so each
+    call only ships the parameter vectors and the log-probs.  The
+    workers hold a snapshot: create a new pool after changing
+    anything other than the thawed parameters (eg, freezing params or
+    adding sources).
+
+    Usage::
+
+        pool = LogProbPool(tractor, 8)
+        lnp = pool(X)    # X: (Nwalkers, Nparams)
+
+    The pool is callable, so it can be used directly as a vectorized
+    log-prob function (eg, emcee's `vectorize=True` mode).
+    '''
+    def __init__(self, tractor, processes=None):
+        import multiprocessing
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.nchunks = processes
+        self.pool = multiprocessing.Pool(processes, _logprob_pool_init,
+                                         (tractor,))
+
+    def __call__(self, X):
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        chunks = np.array_split(X, max(1, min(self.nchunks, len(X))))
+        return np.hstack(self.pool.map(_logprob_pool_chunk, chunks))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
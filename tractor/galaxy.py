@@ -93,6 +93,22 @@ class GalaxyShape(ParamList):
         # (~intermediate world coords)
         return re_deg * np.array([[cp, sp*self.ab], [-sp, cp*self.ab]])
 
+    def getRaDecBasisDerivatives(self):
+        '''
+        Returns the derivatives of getRaDecBasis() with respect to the
+        (thawed) parameters, as a list of 2x2 matrices.
+        '''
+        phi = np.deg2rad(90 - self.phi)
+        re_deg = max(1./30, self.re) / 3600.
+        dre = (1./3600.) if self.re > 1./30 else 0.
+        cp = np.cos(phi)
+        sp = np.sin(phi)
+        dG = [dre * np.array([[cp, sp*self.ab], [-sp, cp*self.ab]]),
+              re_deg * np.array([[0., sp], [0., cp]]),
+              -np.deg2rad(1.) * re_deg *
+              np.array([[-sp, cp*self.ab], [-cp, -sp*self.ab]])]
+        return [dG[i] for i in self.getThawedParamIndices()]
+
 
 plotnum = 0
 
@@ -292,13 +308,126 @@ class ProfileGalaxy(object):
         affine-transformed into the pixel space of the image.
         '''
         return None
+
+    # Subclasses that implement _getAffineProfileDerivatives can
+    # compute their derivatives analytically.
+    analyticDerivs = False
+
+    def _getAnalyticDerivsMode(self, img):
+        '''
+        Returns 'mog' or 'fft', the way getParamDerivatives will
+        compute analytic derivatives for *img*, or None for finite
+        differences.
+        '''
+        if not self.analyticDerivs:
+            return None
+        psf = img.getPsf()
+        if hasattr(psf, 'getMixtureOfGaussians'):
+            return 'mog'
+        if hasattr(psf, 'getFourierTransform'):
+            return 'fft'
+        return None
+
+    def _getUnitFluxDerivatives(self, img, mode, px, py, minval, dpix,
+                                shape, profile, modelMask):
+        '''
+        Returns (patch0, [Patch, ...]): the unit-flux model patch, and
+        its derivatives with respect to the position parameters (given
+        their pixel-space derivatives *dpix*), the thawed shape
+        parameters (if *shape*) and the profile parameters (if
+        *profile*), in that order (see _getAffineProfileDerivatives),
+        computed analytically as selected by *mode* (see
+        _getAnalyticDerivsMode).  Returns None if the model does not
+        overlap the image.
+        '''
+        if mode == 'fft':
+            patches = self._realGetUnitFluxModelPatch(
+                img, px, py, minval, modelMask=modelMask,
+                derivs=(dpix, shape, profile))
+            if patches is None:
+                return None
+            return patches[0], patches[1:]
+        patch0 = self.getUnitFluxModelPatch(img, px, py, minval=minval,
+                                            modelMask=modelMask)
+        if patch0 is None:
+            return None
+        return patch0, self._getMixtureDerivatives(img, px, py, minval, patch0,
+                                                   dpix, shape, profile,
+                                                   modelMask)
+
+    def _getMixtureDerivatives(self, img, px, py, minval, patch0, dpix, shape,
+                               profile, modelMask):
+        '''
+        Returns unit-flux derivative Patches, on the pixels of
+        *patch0*, with respect to the position parameters (given their
+        pixel-space derivatives *dpix*), the thawed shape parameters
+        (if *shape*) and the profile parameters (if *profile*), for
+        mixture-of-Gaussians PSFs.  Each component is evaluated only
+        where it is above its share of *minval*.
+        '''
+        amix,dvars,damps = self._getAffineProfileDerivatives(
+            img, px, py, shape=shape, profile=profile)
+        psfmix = img.getPsf().getMixtureOfGaussians(px=px, py=py)
+        cmix = amix.convolve(psfmix)
+        if len(dpix) + len(dvars) == 0:
+            return []
+        # Derivatives of the convolved mixture's components, one row
+        # per parameter: (mean_x, mean_y, var_xx, var_xy, var_yy, amp)
+        dparams = np.zeros((len(dpix) + len(dvars), cmix.K, 6))
+        for i,(dpx,dpy) in enumerate(dpix):
+            dparams[i,:,0] = dpx
+            dparams[i,:,1] = dpy
+        for i,(dv,da) in enumerate(zip(dvars, damps)):
+            # convolve() orders components by PSF component, then
+            # galaxy component.
+            dv = np.tile(dv, (psfmix.K, 1, 1))
+            d = dparams[len(dpix) + i]
+            d[:,2] = dv[:,0,0]
+            d[:,3] = dv[:,0,1]
+            d[:,4] = dv[:,1,1]
+            d[:,5] = np.tile(da, psfmix.K) * np.repeat(psfmix.amp, amix.K)
+        if modelMask is not None:
+            mask = modelMask.patch
+        else:
+            mask = (patch0.patch != 0)
+        ph,pw = patch0.shape
+        # The convolved mixture has the px,py offset built in.
+        p,pderivs = cmix.evaluate_grid_param_derivs(
+            patch0.x0, patch0.x0 + pw, patch0.y0, patch0.y0 + ph,
+            0., 0., dparams, mask=mask, minval=minval, value=False)
+        return pderivs
     
     def _getUnitFluxDeps(self, img, px, py):
         return None
 
     def _getUnitFluxPatchSize(self, img, minval):
         return 0
-    
+
+    def _getUnitFluxMixtures(self, img, minval):
+        '''
+        For batch rendering (see getModelMixtures): returns the
+        PSF-convolved mixture that _realGetUnitFluxModelPatch would
+        render, or None for PSFs that are not mixtures of Gaussians.
+        '''
+        psf = img.getPsf()
+        if not hasattr(psf, 'getMixtureOfGaussians'):
+            return None
+        (px,py) = img.getWcs().positionToPixel(self.getPosition(), self)
+        halfsize = self._getUnitFluxPatchSize(img, px, py, minval)
+        (outx, inx) = get_overlapping_region(
+            int(np.floor(px-halfsize)), int(np.ceil(px+halfsize+1)),
+            0, img.getWidth())
+        (outy, iny) = get_overlapping_region(
+            int(np.floor(py-halfsize)), int(np.ceil(py+halfsize+1)),
+            0, img.getHeight())
+        if inx == [] or iny == []:
+            return []
+        amix = self._getAffineProfile(img, px, py)
+        cmix = amix.convolve(psf.getMixtureOfGaussians(px=px, py=py))
+        # The convolved mixture has the px,py offset built in.
+        return [(cmix, (0., 0.), [outx.start, outx.stop,
+                                  outy.start, outy.stop])]
+
     def getUnitFluxModelPatch(self, img, px=None, py=None, minval=0.0,
                               extent=None, modelMask=None):
         if px is None or py is None:
@@ -344,8 +473,6 @@ class ProfileGalaxy(object):
 
         patch = self._realGetUnitFluxModelPatch(img, px, py, minval,
                                                 extent=extent, modelMask=modelMask)
-        if patch is not None:
-            patch = patch.copy()
         # print('Adding to cache:', deps,)
         # if patch is not None:
         #     print('patch shape', patch.shape)
@@ -354,14 +481,28 @@ class ProfileGalaxy(object):
         if patch is not None and modelMask is not None:
             assert(patch.shape == modelMask.shape)
         # print('modelMask:', modelMask)
-        _galcache.put(deps, (patch,minval))
+        # Cache a copy: callers may modify the returned patch in place.
+        cached = patch
+        if patch is not None:
+            cached = patch.copy()
+        _galcache.put(deps, (cached,minval))
         return patch
 
     def _realGetUnitFluxModelPatch(self, img, px, py, minval, extent=None,
-                                   modelMask=None):
+                                   modelMask=None, derivs=None):
         '''
         extent: if not None, [x0,x1,y0,y1], where the range to render
         is [x0, x1), [y0,y1).
+
+        derivs: (FFT rendering only) if not None, (dpix, shape,
+        profile): also compute the derivatives with respect to
+        position, where *dpix* is a list of (dpx,dpy) pixel-space
+        derivatives of the position parameters, and, if *shape* and
+        *profile* are True, the (thawed) shape and profile parameters
+        (see _getAffineProfileDerivatives).  These
+        are computed in Fourier space and transformed back in one
+        batched inverse FFT.  Returns a list of Patches: the model,
+        then the derivatives.
         '''
 
         #####
@@ -423,11 +564,14 @@ class ProfileGalaxy(object):
             # print('_realGetUnitFluxModelPatch: extent', x0,x1,y0,y1)
             if modelMask is None:
                 return mp.mixture_to_patch(cmix, x0, x1, y0, y1, minval,
-                                           exactExtent=(extent is not None))
+                                           exactExtent=(extent is not None),
+                                           precision=img.modelPrecision,
+                                           maxstep=img.modelMaxStep)
             else:
                 # The convolved mixture *already* has the px,py offset added
                 # (via px,py to amix) so set px,py=0,0 in this call.
-                p = cmix.evaluate_grid_masked(x0, y0, modelMask.patch, 0., 0.)
+                p = cmix.evaluate_grid_masked(x0, y0, modelMask.patch, 0., 0.,
+                                              precision=img.modelPrecision)
                 assert(p.shape == modelMask.shape)
                 return p
 
@@ -510,13 +654,17 @@ class ProfileGalaxy(object):
 
                 # print('Recursing:', self, ':', (mh,mw), 'to', (bigh,bigw))
                 bigmodel = self._realGetUnitFluxModelPatch(
-                    img, px, py, minval, extent=None, modelMask=bigMask)
+                    img, px, py, minval, extent=None, modelMask=bigMask,
+                    derivs=derivs)
 
                 if do_fft_timing:
                     t1 = CpuMeas()
                     fft_timing.append((timing_id, 'sourceout', t1.cpu_seconds_since(t0),
                                        (bigMask.shape, (mh,mw))))
 
+                if derivs is not None:
+                    return [Patch(x0, y0, b.patch[boffy:boffy+mh, boffx:boffx+mw])
+                            for b in bigmodel]
                 return Patch(x0, y0,
                              bigmodel.patch[boffy:boffy+mh, boffx:boffx+mw])
             
@@ -585,12 +733,33 @@ class ProfileGalaxy(object):
         if do_fft_timing:
             t0 = CpuMeas()
         
-        amix = self._getAffineProfile(img, mux, muy)
+        if derivs is None:
+            amix = self._getAffineProfile(img, mux, muy)
+        else:
+            dpix,shape,profile = derivs
+            amix,dvars,damps = self._getAffineProfileDerivatives(
+                img, mux, muy, shape=shape, profile=profile)
 
         if do_fft_timing:
             t1 = CpuMeas()
         
-        Fsum = amix.getFourierTransform(v, w)
+        if derivs is None:
+            Fsum = amix.getFourierTransform(v, w)
+        else:
+            # Stack of [model, d/dpos..., d/dshape..., d/dprofile...]
+            # transforms.
+            F = amix.getFourierTransformDerivatives(v, w, dvars)
+            for i,da in enumerate(damps):
+                if np.any(da != 0):
+                    F[1+i] += mp.MixtureOfGaussians.trusted(
+                        da, amix.mean, amix.var).getFourierTransform(v, w)
+            # Shifting the mean multiplies the transform by
+            # exp(-2 pi i (dx v + dy w))
+            Fsum = np.concatenate(
+                [F[:1]] +
+                [F[:1] * (-2j * np.pi * (dpx * v[np.newaxis,:] +
+                                         dpy * w[:,np.newaxis]))
+                 for dpx,dpy in dpix] + [F[1:]])
         
         if do_fft_timing:
             t2 = CpuMeas()
@@ -666,7 +835,7 @@ class ProfileGalaxy(object):
                                    (haveExtent, (pH,pW))))
             
 
-            gh,gw = G.shape
+            gh,gw = G.shape[-2:]
 
             if gx0 != 0 or gy0 != 0:
                 #print('gx0,gy0', gx0,gy0)
@@ -674,16 +843,16 @@ class ProfileGalaxy(object):
                 xi,xo = get_overlapping_region(-gx0, -gx0+mw-1, 0, gw-1)
 
                 # shifted
-                shG = np.zeros((mh,mw), G.dtype)
-                shG[yo,xo] = G[yi,xi]
+                shG = np.zeros(G.shape[:-2] + (mh,mw), G.dtype)
+                shG[...,yo,xo] = G[...,yi,xi]
                 G = shG
             
             if gh > mh or gw > mw:
-                G = G[:mh,:mw]
+                G = G[...,:mh,:mw]
             if modelMask is not None:
-                assert(G.shape == modelMask.shape)
+                assert(G.shape[-2:] == modelMask.shape)
             else:
-                assert(G.shape == (mh,mw))
+                assert(G.shape[-2:] == (mh,mw))
             
         else:
             #print('iFFT', (pW,pH))
@@ -715,21 +884,23 @@ class ProfileGalaxy(object):
             
             # Clip down to suggested "halfsize"
             if x0 > ix0:
-                G = G[:,x0 - ix0:]
+                G = G[...,:,x0 - ix0:]
                 ix0 = x0
             if y0 > iy0:
-                G = G[y0 - iy0:, :]
+                G = G[...,y0 - iy0:, :]
                 iy0 = y0
-            gh,gw = G.shape
+            gh,gw = G.shape[-2:]
             if gw+ix0 > x1:
-                G = G[:,:x1-ix0]
+                G = G[...,:,:x1-ix0]
             if gh+iy0 > y1:
-                G = G[:y1-iy0,:]
+                G = G[...,:y1-iy0,:]
 
         if do_fft_timing:
             fft_timing.append((timing_id, 'get_unit_patch_finished', CpuMeas().cpu_seconds_since(tpatch),
                                (self,)))
 
+        if derivs is not None:
+            return [Patch(ix0, iy0, g) for g in G]
         return Patch(ix0, iy0, G)
                     
 
@@ -750,15 +921,156 @@ class HoggGalaxy(ProfileGalaxy, Galaxy):
         galmix = self.getProfile()
         Tinv = np.linalg.inv(self.shape.getTensor(cd))
         amix = galmix.apply_affine(np.array([px,py]), Tinv.T)
-        amix.symmetrize()
         return amix
 
+    def _getProfileDerivatives(self):
+        '''
+        Returns (galmix, [(name, damp, dvar), ...]): the profile (as
+        in getProfile), and the derivatives of its component
+        amplitudes, shape (K,), and variances, shape (K,2,2), with
+        respect to any thawed parameters (beyond position, brightness
+        and shape) that change the profile, eg, the Sersic index.
+        Their derivatives follow the shape derivatives.
+        '''
+        return self.getProfile(), []
+
+    def _getAffineProfileDerivatives(self, img, px, py, shape=True,
+                                     profile=True):
+        '''
+        Returns (amix, dvars, damps): the affine-transformed profile
+        (as in _getAffineProfile), and the derivatives of its
+        component variances, (K,2,2) arrays, and amplitudes, (K,)
+        arrays, with respect to the thawed shape parameters (if
+        *shape*), followed by the profile parameters (if *profile*;
+        see _getProfileDerivatives).
+        '''
+        cd = img.getWcs().cdAtPixel(px, py)
+        galmix,dprofile = self._getProfileDerivatives()
+        Tinv = np.linalg.inv(self.shape.getTensor(cd))
+        amix = galmix.apply_affine(np.array([px,py]), Tinv.T)
+        dvars = []
+        damps = []
+        if shape:
+            # var = Tinv V Tinv^T, with Tinv = cd^-1 G
+            cdinv = np.linalg.inv(cd)
+            for dG in self.shape.getRaDecBasisDerivatives():
+                dTinv = np.dot(cdinv, dG)
+                dV = np.einsum('ij,kjl,ml->kim', dTinv, galmix.var, Tinv)
+                dvars.append(dV + np.transpose(dV, (0,2,1)))
+                damps.append(np.zeros(amix.K))
+        if profile:
+            for name,damp,dvar in dprofile:
+                dvars.append(np.einsum('ij,kjl,ml->kim', Tinv, dvar, Tinv))
+                damps.append(damp)
+        return amix, dvars, damps
+
+    # Compute position, shape and profile derivatives analytically
+    # when the PSF is a mixture of Gaussians or pixelized (otherwise,
+    # finite differences).
+    analyticDerivs = True
+
+    def _getAnalyticDerivsMode(self, img):
+        if not hasattr(self.shape, 'getRaDecBasisDerivatives'):
+            return None
+        return super(HoggGalaxy, self)._getAnalyticDerivsMode(img)
+
+    def getParamDerivatives(self, img, modelMask=None):
+        '''
+        Returns [ Patch, Patch, ... ] of length numberOfParams().
+
+        The derivatives with respect to position, shape and any
+        profile parameters (see _getProfileDerivatives) are computed
+        analytically, by chaining the derivatives of the profile
+        mixture's components through the WCS and the ellipse
+        parameterization:
+
+        - for mixture-of-Gaussians PSFs, in one pass over the pixels
+          of the (possibly truncated) model patch;
+        - for pixelized PSFs, in Fourier space, from the same product
+          of galaxy and PSF transforms as the model, with one batched
+          inverse FFT.
+        '''
+        mode = self._getAnalyticDerivsMode(img)
+        if mode is None:
+            return super(HoggGalaxy, self).getParamDerivatives(
+                img, modelMask=modelMask)
+
+        pos0 = self.getPosition()
+        (px0,py0) = img.getWcs().positionToPixel(pos0, self)
+        counts = img.getPhotoCal().brightnessToCounts(self.brightness)
+
+        minsb = img.modelMinval
+        if counts > 0:
+            minval = minsb / counts
+        else:
+            minval = None
+
+        names = []
+        dpix = []
+        if not self.isParamFrozen('pos') and counts != 0:
+            dpix = self._getPixelDerivatives(img, px0, py0)
+            names.extend(['d(%s)/d(pos%i)' % (self.dname, i)
+                          for i in range(len(dpix))])
+        npos = len(dpix)
+        shape = (not self.isParamFrozen('shape') and counts != 0)
+        if shape:
+            names.extend(['d(%s)/d(%s)' % (self.dname, gname)
+                          for gname in self.shape.getParamNames()])
+        nshape = len(names) - npos
+        dprofile = self._getProfileDerivatives()[1]
+        profile = (len(dprofile) > 0 and counts != 0)
+        if profile:
+            names.extend(['d(%s)/d(%s)' % (self.dname, pname)
+                          for pname,damp,dvar in dprofile])
+
+        patches = self._getUnitFluxDerivatives(img, mode, px0, py0, minval,
+                                               dpix, shape, profile,
+                                               modelMask)
+        if patches is None:
+            return [None] * self.numberOfParams()
+        patch0,pderivs = patches
+        for d,name in zip(pderivs, names):
+            d.patch = (d.patch * counts).astype(patch0.patch.dtype)
+            d.setName(name)
+
+        derivs = []
+        if not self.isParamFrozen('pos'):
+            if counts == 0:
+                derivs.extend([None] * pos0.numberOfParams())
+            else:
+                derivs.extend(pderivs[:npos])
+
+        # derivatives wrt brightness
+        if not self.isParamFrozen('brightness'):
+            params = self.brightness.getParams()
+            for i,bstep in enumerate(self.brightness.getStepSizes()):
+                oldval = self.brightness.setParam(i, params[i] + bstep)
+                countsi = img.getPhotoCal().brightnessToCounts(self.brightness)
+                self.brightness.setParam(i, oldval)
+                df = patch0 * ((countsi - counts) / bstep)
+                df.setName('d(%s)/d(bright%i)' % (self.dname, i))
+                derivs.append(df)
+
+        if not self.isParamFrozen('shape'):
+            if counts == 0:
+                derivs.extend([None] * self.shape.numberOfParams())
+            else:
+                derivs.extend(pderivs[npos:npos+nshape])
+
+        if len(dprofile):
+            if counts == 0:
+                derivs.extend([None] * len(dprofile))
+            else:
+                derivs.extend(pderivs[npos+nshape:])
+        return derivs
+
     def _getUnitFluxDeps(self, img, px, py):
-        # return ('unitpatch', self.getName(), px, py,
+        # The WCS and PSF are keyed by their version stamps (cheap);
+        # the shape by value, so that finite-difference steps that
+        # restore the shape still hit the cache.
         return hash(('unitpatch', self.getName(), px, py,
-                img.getWcs().hashkey(),
-                img.getPsf().hashkey(), self.shape.hashkey())
-                    )
+                     img.getWcs().versionkey(),
+                     img.getPsf().versionkey(), self.shape.hashkey()))
 
     def _getUnitFluxPatchSize(self, img, px, py, minval):
         if hasattr(self, 'halfsize'):
@@ -901,7 +1213,6 @@ class FixedCompositeGalaxy(MultiParams, ProfileGalaxy, SingleProfileSource):
         for f,p,s in profs:
             Tinv = np.linalg.inv(s.getTensor(cd))
             amix = p.apply_affine(np.array([px,py]), Tinv.T)
-            amix.symmetrize()
             amix.amp *= f
             mix.append(amix)
             #print('affine profile: shape', s, 'weight', f, '->', amix)
@@ -933,13 +1244,158 @@ class FixedCompositeGalaxy(MultiParams, ProfileGalaxy, SingleProfileSource):
     
     def _getUnitFluxDeps(self, img, px, py):
         return hash(('unitpatch', self.getName(),
-                     px, py, img.getWcs().hashkey(),
-                     img.getPsf().hashkey(),
+                     px, py, img.getWcs().versionkey(),
+                     img.getPsf().versionkey(),
                      self.shapeDev.hashkey(),
                      self.shapeExp.hashkey(),
                      self.fracDev.hashkey()))
     
+    analyticDerivs = True
+
+    def _getAnalyticDerivsMode(self, img):
+        if not (hasattr(self.shapeExp, 'getRaDecBasisDerivatives') and
+                hasattr(self.shapeDev, 'getRaDecBasisDerivatives')):
+            return None
+        return super(FixedCompositeGalaxy, self)._getAnalyticDerivsMode(img)
+
+    def _getAffineProfileDerivatives(self, img, px, py, shape=True,
+                                     profile=True):
+        '''
+        Returns (amix, dvars, damps) as in
+        HoggGalaxy._getAffineProfileDerivatives, for the summed exp
+        and deV profile, with respect to the thawed shapeExp and
+        shapeDev parameters (if *shape*), followed by fracDev (if
+        *profile* and it is thawed).
+
+        Unlike _getAffineProfile, *amix* includes both components even
+        if one of them has zero weight.
+        '''
+        f = self.fracDev.clipped()
+        cd = img.getWcs().cdAtPixel(px, py)
+        cdinv = np.linalg.inv(cd)
+        comps = [(1.-f, ExpGalaxy.profile, self.shapeExp, 'shapeExp'),
+                 (f, DevGalaxy.profile, self.shapeDev, 'shapeDev')]
+        amps = []
+        means = []
+        vars = []
+        sdvars = []
+        for w,p,s,name in comps:
+            Tinv = np.linalg.inv(s.getTensor(cd))
+            amix = p.apply_affine(np.array([px,py]), Tinv.T)
+            amps.append(amix.amp)
+            means.append(amix.mean)
+            vars.append(amix.var)
+            if not shape or self.isParamFrozen(name):
+                sdvars.append([])
+                continue
+            dv = []
+            for dG in s.getRaDecBasisDerivatives():
+                dTinv = np.dot(cdinv, dG)
+                dV = np.einsum('ij,kjl,ml->kim', dTinv, p.var, Tinv)
+                dv.append(dV + np.transpose(dV, (0,2,1)))
+            sdvars.append(dv)
+        Kexp = len(amps[0])
+        amix = mp.MixtureOfGaussians.trusted(
+            np.append((1.-f) * amps[0], f * amps[1]),
+            np.append(means[0], means[1], axis=0),
+            np.append(vars[0], vars[1], axis=0))
+        dvars = []
+        for i,dv in enumerate(sdvars):
+            for dV in dv:
+                dvar = np.zeros_like(amix.var)
+                if i == 0:
+                    dvar[:Kexp] = dV
+                else:
+                    dvar[Kexp:] = dV
+                dvars.append(dvar)
+        damps = [np.zeros(amix.K) for dv in dvars]
+        if profile and not self.isParamFrozen('fracDev'):
+            df = self.fracDev.derivative()
+            dvars.append(np.zeros_like(amix.var))
+            damps.append(df * np.append(-amps[0], amps[1]))
+        return amix, dvars, damps
+
     def getParamDerivatives(self, img, modelMask=None):
+        '''
+        Returns [ Patch, Patch, ... ] of length numberOfParams().
+
+        When the derivatives can be computed analytically (see
+        HoggGalaxy.getParamDerivatives), the exp and deV profiles are
+        treated as a single mixture, and the model and its derivatives
+        with respect to position, fracDev and both shapes are computed
+        in one pass.  Otherwise, each component is differentiated
+        separately.
+        '''
+        mode = self._getAnalyticDerivsMode(img)
+        if mode is None:
+            return self._getComponentParamDerivatives(img,
+                                                      modelMask=modelMask)
+        pos0 = self.getPosition()
+        (px0,py0) = img.getWcs().positionToPixel(pos0, self)
+        counts = img.getPhotoCal().brightnessToCounts(self.brightness)
+        if counts > 0:
+            minval = img.modelMinval / counts
+        else:
+            minval = None
+
+        dpix = []
+        if not self.isParamFrozen('pos') and counts != 0:
+            dpix = self._getPixelDerivatives(img, px0, py0)
+        npos = len(dpix)
+        shapenames = []
+        for name,dname in [('shapeExp', 'fcomp.exp'),
+                           ('shapeDev', 'fcomp.dev')]:
+            if not self.isParamFrozen(name):
+                shapenames.extend(['d(%s)/d(%s)' % (dname, gname) for gname
+                                   in getattr(self, name).getParamNames()])
+        shape = (counts != 0)
+        profile = (counts != 0 and not self.isParamFrozen('fracDev'))
+        patches = self._getUnitFluxDerivatives(img, mode, px0, py0, minval,
+                                               dpix, shape, profile,
+                                               modelMask)
+        if patches is None:
+            return [None] * self.numberOfParams()
+        patch0,pderivs = patches
+        for d in pderivs:
+            d.patch = (d.patch * counts).astype(patch0.patch.dtype)
+
+        derivs = []
+        if not self.isParamFrozen('pos'):
+            if counts == 0:
+                derivs.extend([None] * pos0.numberOfParams())
+            else:
+                for i,d in enumerate(pderivs[:npos]):
+                    d.setName('d(fcomp)/d(pos%i)' % i)
+                derivs.extend(pderivs[:npos])
+
+        if not self.isParamFrozen('brightness'):
+            params = self.brightness.getParams()
+            for i,bstep in enumerate(self.brightness.getStepSizes()):
+                oldval = self.brightness.setParam(i, params[i] + bstep)
+                countsi = img.getPhotoCal().brightnessToCounts(self.brightness)
+                self.brightness.setParam(i, oldval)
+                df = patch0 * ((countsi - counts) / bstep)
+                df.setName('d(fcomp)/d(bright%i)' % i)
+                derivs.append(df)
+
+        nshape = len(shapenames)
+        if not self.isParamFrozen('fracDev'):
+            if counts == 0:
+                derivs.append(None)
+            else:
+                df = pderivs[npos + nshape]
+                df.setName('d(fcomp)/d(fracDev)')
+                derivs.append(df)
+
+        if counts == 0:
+            derivs.extend([None] * nshape)
+        else:
+            for d,name in zip(pderivs[npos:npos+nshape], shapenames):
+                d.setName(name)
+            derivs.extend(pderivs[npos:npos+nshape])
+        return derivs
+
+    def _getComponentParamDerivatives(self, img, modelMask=None):
         e = ExpGalaxy(self.pos, self.brightness, self.shapeExp)
         d = DevGalaxy(self.pos, self.brightness, self.shapeDev)
         e.dname = 'fcomp.exp'
@@ -1085,9 +1541,46 @@ class CompositeGalaxy(MultiParams, BasicSource):
         pd = d.getModelPatch(img, modelMask=modelMask, **kw)
         return (pe,pd)
     
+    def _getFixedComposite(self, img):
+        '''
+        Returns (fcomp, countsExp, countsDev): a FixedCompositeGalaxy
+        with this galaxy's position and shapes, whose fracDev is the
+        deV fraction of the counts in *img*, and the counts.  *fcomp*
+        is None if the counts are not both non-negative.
+        '''
+        photocal = img.getPhotoCal()
+        ce = photocal.brightnessToCounts(self.brightnessExp)
+        cd = photocal.brightnessToCounts(self.brightnessDev)
+        if ce < 0 or cd < 0 or ce + cd == 0:
+            return None, ce, cd
+        fcomp = FixedCompositeGalaxy(self.pos, self.brightnessExp,
+                                     FracDev(cd / float(ce + cd)),
+                                     self.shapeExp, self.shapeDev)
+        for name in ['pos', 'shapeExp', 'shapeDev']:
+            if self.isParamFrozen(name):
+                fcomp.freezeParam(name)
+        if hasattr(self, 'halfsize'):
+            fcomp.halfsize = self.halfsize
+        return fcomp, ce, cd
+
     def getModelPatch(self, img, minsb=0., modelMask=None):
-        pe,pd = self._getModelPatches(img, minsb=minsb, modelMask=modelMask)
-        return add_patches(pe,pd)
+        '''
+        Renders the exp and deV components as a single mixture (see
+        FixedCompositeGalaxy), unless one of them has negative counts.
+        '''
+        fcomp,ce,cd = self._getFixedComposite(img)
+        if fcomp is None:
+            pe,pd = self._getModelPatches(img, minsb=minsb,
+                                          modelMask=modelMask)
+            return add_patches(pe,pd)
+        if minsb == 0. or minsb is None:
+            minsb = img.modelMinval
+        counts = ce + cd
+        upatch = fcomp.getUnitFluxModelPatch(img, minval=minsb / counts,
+                                             modelMask=modelMask)
+        if upatch is None:
+            return None
+        return upatch * counts
 
     def getUnitFluxModelPatches(self, img, minval=0., modelMask=None):
         if minval > 0:
@@ -1119,10 +1612,80 @@ class CompositeGalaxy(MultiParams, BasicSource):
             return pe
         return pe + pd
 
+    def getParamDerivatives(self, img, modelMask=None):
+        '''
+        Returns [ Patch, Patch, ... ] of length numberOfParams().
+
+        When both components have non-negative counts and the
+        derivatives can be computed analytically, renders the galaxy
+        as a FixedCompositeGalaxy, in one pass, and gets the
+        derivatives with respect to the component brightnesses from
+        its fracDev derivative.  Otherwise, each component is
+        differentiated separately.
+        '''
+        fcomp,ce,cd = self._getFixedComposite(img)
+        mode = None
+        if fcomp is not None:
+            mode = fcomp._getAnalyticDerivsMode(img)
+        if mode is None:
+            return self._getComponentParamDerivatives(img,
+                                                      modelMask=modelMask)
+        counts = ce + cd
+        f = cd / float(counts)
+        (px0,py0) = img.getWcs().positionToPixel(self.getPosition(), self)
+        dpix = []
+        if not self.isParamFrozen('pos'):
+            dpix = fcomp._getPixelDerivatives(img, px0, py0)
+        npos = len(dpix)
+        bright = not (self.isParamFrozen('brightnessExp') and
+                      self.isParamFrozen('brightnessDev'))
+        patches = fcomp._getUnitFluxDerivatives(
+            img, mode, px0, py0, img.modelMinval / counts, dpix, True,
+            bright, modelMask)
+        if patches is None:
+            return [None] * self.numberOfParams()
+        patch0,pderivs = patches
+        # unit-flux derivative wrt fracDev
+        if bright:
+            dfrac = pderivs.pop().patch
+
+        derivs = []
+        for i,d in enumerate(pderivs[:npos]):
+            d.patch = (d.patch * counts).astype(patch0.patch.dtype)
+            d.setName('d(comp)/d(pos%i)' % i)
+            derivs.append(d)
+        i0 = npos
+        # The model is ce U_exp + cd U_dev.  With the unit-flux
+        # U = (1-f) U_exp + f U_dev, and dfrac = dU/df = U_dev - U_exp,
+        # U_exp = U - f dfrac and U_dev = U + (1-f) dfrac.
+        for (name, bname, sname, c, w) in [
+                ('exp', 'brightnessExp', 'shapeExp', ce, -f),
+                ('dev', 'brightnessDev', 'shapeDev', cd, 1.-f)]:
+            if not self.isParamFrozen(bname):
+                brightness = getattr(self, bname)
+                ucomp = (patch0.patch + w * dfrac).astype(patch0.patch.dtype)
+                params = brightness.getParams()
+                for i,bstep in enumerate(brightness.getStepSizes()):
+                    oldval = brightness.setParam(i, params[i] + bstep)
+                    ci = img.getPhotoCal().brightnessToCounts(brightness)
+                    brightness.setParam(i, oldval)
+                    d = Patch(patch0.x0, patch0.y0,
+                              ucomp * ((ci - c) / bstep))
+                    d.setName('d(comp.%s)/d(bright%i)' % (name, i))
+                    derivs.append(d)
+            if not self.isParamFrozen(sname):
+                shape = getattr(self, sname)
+                for gname,d in zip(shape.getParamNames(), pderivs[i0:]):
+                    d.patch = (d.patch * counts).astype(patch0.patch.dtype)
+                    d.setName('d(comp.%s)/d(%s)' % (name, gname))
+                    derivs.append(d)
+                i0 += shape.numberOfParams()
+        return derivs
+
     # MAGIC: ORDERING OF EXP AND DEV PARAMETERS
     # MAGIC: ASSUMES EXP AND DEV SHAPES SAME LENGTH
     # CompositeGalaxy.
-    def getParamDerivatives(self, img, modelMask=None):
+    def _getComponentParamDerivatives(self, img, modelMask=None):
         #print('CompositeGalaxy: getParamDerivatives')
         #print('  Exp brightness', self.brightnessExp, 'shape', self.shapeExp)
         #print('  Dev brightness', self.brightnessDev, 'shape', self.shapeDev)
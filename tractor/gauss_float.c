@@ -0,0 +1,295 @@
+// Single-precision variants of c_gauss_2d_grid, c_gauss_2d_approx3
+// and c_gauss_2d_masked.  These are written so that the compiler can
+// vectorize the inner (per-row) loops for the baseline x86-64
+// instruction set (SSE2): each mixture component is evaluated over a
+// contiguous run of pixels in each row (the chord of the ellipse
+// where it is above the cut; see approx3.c), with a branch-free exp
+// approximation.
+
+
+// GCC will only if-convert (and so vectorize) the selects in these
+// loops if it may assume that floating-point comparisons don't trap.
+#if defined(__GNUC__) && !defined(__clang__)
+#define VECTORIZABLE __attribute__((optimize("no-trapping-math")))
+#else
+#define VECTORIZABLE
+#endif
+
+// exp(x) in single precision, for use in vectorized loops.
+//
+// exp(x) = 2^n exp(f), with n = round(x / ln 2) and |f| <= ln(2)/2
+// (computed with a two-part ln 2), and exp(f) from its degree-6
+// Taylor polynomial.  The truncation error is < 2e-7; the relative
+// error, including rounding, is < 5e-7 for -87 <= x <= 88.  Returns
+// 0 for x < -87 (rather than a denormal), and clamps at x = 88.
+VECTORIZABLE
+static inline float fast_expf(float x) {
+    union {
+        float f;
+        int32_t i;
+    } u;
+    float xc, t, f, p;
+    int32_t n;
+    xc = (x < -87.f) ? -87.f : x;
+    xc = (xc > 88.f) ? 88.f : xc;
+    t = xc * 1.44269504f;
+    n = (int32_t)(t + ((t < 0.f) ? -0.5f : 0.5f));
+    f = xc - (float)n * 0.693145752f;
+    f = f - (float)n * 1.42860677e-6f;
+    p = 1.f + f * (1.f + f * (0.5f + f * (1.f/6.f + f * (1.f/24.f +
+        f * (1.f/120.f + f * (1.f/720.f))))));
+    u.i = (n + 127) << 23;
+    return (x < -87.f) ? 0.f : p * u.f;
+}
+
+// Adds one component, evaluated at the "n" pixels at x offsets
+// dx0, dx0+1, ... from its mean (and y offset dy), to "r" (and the
+// derivatives with respect to the mean to "xd" and "yd", if not
+// NULL).
+// "I" is the scaled inverse covariance, as in eval_all_dxy.  If
+// "m" is not NULL, pixels where it is zero are skipped.
+VECTORIZABLE
+static void gauss_row_f(int n, float dx0, float dy,
+                        float I0, float I1, float I2, float scale,
+                        const uint8_t* restrict m, float* restrict r,
+                        float* restrict xd, float* restrict yd) {
+    float b = I1 * dy;
+    float c = I2 * dy * dy;
+    float yb = I2 * dy * 2.f;
+    int i;
+    // (separate loops, so that each is branch-free)
+    if (xd && m) {
+        #pragma omp simd
+        for (i=0; i<n; i++) {
+            float dx = dx0 + (float)i;
+            float G = scale * fast_expf((I0 * dx + b) * dx + c);
+            G = m[i] ? G : 0.f;
+            r[i] += G;
+            xd[i] += -G * (2.f * I0 * dx + b);
+            yd[i] += -G * (yb + I1 * dx);
+        }
+    } else if (xd) {
+        #pragma omp simd
+        for (i=0; i<n; i++) {
+            float dx = dx0 + (float)i;
+            float G = scale * fast_expf((I0 * dx + b) * dx + c);
+            r[i] += G;
+            xd[i] += -G * (2.f * I0 * dx + b);
+            yd[i] += -G * (yb + I1 * dx);
+        }
+    } else if (m) {
+        #pragma omp simd
+        for (i=0; i<n; i++) {
+            float dx = dx0 + (float)i;
+            float G = scale * fast_expf((I0 * dx + b) * dx + c);
+            r[i] += m[i] ? G : 0.f;
+        }
+    } else {
+        #pragma omp simd
+        for (i=0; i<n; i++) {
+            float dx = dx0 + (float)i;
+            r[i] += scale * fast_expf((I0 * dx + b) * dx + c);
+        }
+    }
+}
+
+// Evaluates K components, each within the ellipse where its exponent
+// is >= cuts[k] (and, within "hull" if not NULL, everywhere; see
+// approx3_row), into the [x0,x1) x [y0,y1) arrays "result",
+// "xderiv", "yderiv" (float, row-major).  The component parameters
+// are in double precision, with the means in pixel coordinates; the
+// pixel offsets are formed in double precision before conversion so
+// that large coordinates do not lose precision.  Sets "bbox" to the
+// [x0,x1,y0,y1] pixel range that was written.
+static void gauss_rows_f(int K, const double* II, const double* scales,
+                         const double* mxy, const double* cuts,
+                         int x0, int x1, int y0, int y1,
+                         const int* hull, const uint8_t* mask,
+                         float* result, float* xderiv, float* yderiv,
+                         int* bbox) {
+    int W = x1 - x0;
+    int bx0 = x1, bx1 = x0, by0 = y1, by1 = y0;
+    int iy;
+
+    #pragma omp parallel for schedule(dynamic) reduction(min:bx0,by0) reduction(max:bx1,by1) if ((long)W * (y1 - y0) * K > OMP_MIN_EVALS)
+    for (iy=y0; iy<y1; iy++) {
+        npy_intp off = (npy_intp)(iy - y0) * W - x0;
+        int k, xlo, xhi;
+        for (k=0; k<K; k++) {
+            const double* I = II + 3*k;
+            if (scales[k] == 0.)
+                continue;
+            if (!approx3_row(k, II, mxy, cuts, x0, x1, iy, hull, &xlo, &xhi))
+                continue;
+            gauss_row_f(xhi - xlo, (float)(xlo - mxy[2*k]),
+                        (float)(iy - mxy[2*k + 1]),
+                        (float)I[0], (float)I[1], (float)I[2],
+                        (float)scales[k],
+                        mask ? mask + off + xlo : NULL,
+                        result + off + xlo,
+                        xderiv ? xderiv + off + xlo : NULL,
+                        yderiv ? yderiv + off + xlo : NULL);
+            bx0 = MIN(bx0, xlo);
+            bx1 = MAX(bx1, xhi);
+            by0 = MIN(by0, iy);
+            by1 = MAX(by1, iy+1);
+        }
+    }
+    bbox[0] = bx0;
+    bbox[1] = bx1;
+    bbox[2] = by0;
+    bbox[3] = by1;
+}
+
+static int gauss_float_common(int x0, int x1, int y0, int y1,
+                              double fx, double fy, double minval,
+                              double defcut,
+                              PyObject* ob_amp, PyObject* ob_mean,
+                              PyObject* ob_var, PyObject* ob_result,
+                              PyObject* ob_xderiv, PyObject* ob_yderiv,
+                              PyObject* ob_mask, int needmask,
+                              const int* hull, int* bbox) {
+    float *amp, *mean, *var, *result;
+    float *xderiv=NULL, *yderiv=NULL;
+    uint8_t* mask=NULL;
+    int K;
+    int rtn = -1;
+    PyObject *np_amp=NULL, *np_mean=NULL, *np_var=NULL, *np_result=NULL;
+    PyObject *np_xderiv=NULL, *np_yderiv=NULL, *np_mask=NULL;
+    PyArray_Descr* ftype = PyArray_DescrFromType(PyArray_FLOAT32);
+
+    bbox[0] = bbox[1] = bbox[2] = bbox[3] = 0;
+
+    if ((ob_xderiv == Py_None) != (ob_yderiv == Py_None)) {
+        ERR("xderiv and yderiv must both be given, or neither\n");
+        goto bailout;
+    }
+    if (needmask && (ob_mask == Py_None)) {
+        ERR("mask must be given\n");
+        goto bailout;
+    }
+    if (get_np(ob_amp, ob_mean, ob_var, ob_result, ob_xderiv, ob_yderiv,
+               ob_mask, x1 - x0, y1 - y0,
+               &K, &np_amp, &np_mean, &np_var, &np_result, &np_xderiv, &np_yderiv,
+               &np_mask, ftype)) {
+        printf("get_np failed\n");
+        goto bailout;
+    }
+    rtn = 0;
+    amp    = PyArray_DATA(np_amp);
+    mean   = PyArray_DATA(np_mean);
+    var    = PyArray_DATA(np_var);
+    result = PyArray_DATA(np_result);
+    if (np_xderiv)
+        xderiv = PyArray_DATA(np_xderiv);
+    if (np_yderiv)
+        yderiv = PyArray_DATA(np_yderiv);
+    if (np_mask)
+        mask   = PyArray_DATA(np_mask);
+
+    if ((K == 0) || (x0 >= x1) || (y0 >= y1))
+        goto bailout;
+
+    {
+        double II[3*K];
+        double scales[K];
+        double mxy[2*K];
+        double cuts[K];
+        // the mixture parameters in double precision
+        double damp[K];
+        double dmean[2*K];
+        double dvar[4*K];
+        int i;
+        Py_BEGIN_ALLOW_THREADS
+        for (i=0; i<K; i++)
+            damp[i] = amp[i];
+        for (i=0; i<2*K; i++)
+            dmean[i] = mean[i];
+        for (i=0; i<4*K; i++)
+            dvar[i] = var[i];
+        if (!approx3_setup(K, damp, dmean, dvar, fx, fy, minval, defcut,
+                           II, scales, mxy, cuts))
+            gauss_rows_f(K, II, scales, mxy, cuts, x0, x1, y0, y1, hull,
+                         mask, result, xderiv, yderiv, bbox);
+        Py_END_ALLOW_THREADS
+    }
+
+ bailout:
+    Py_XDECREF(np_amp);
+    Py_XDECREF(np_mean);
+    Py_XDECREF(np_var);
+    Py_XDECREF(np_result);
+    Py_XDECREF(np_xderiv);
+    Py_XDECREF(np_yderiv);
+    Py_XDECREF(np_mask);
+    return rtn;
+}
+
+static int c_gauss_2d_grid_f(int x0, int x1, int y0, int y1,
+                             double fx, double fy,
+                             PyObject* ob_amp,
+                             PyObject* ob_mean,
+                             PyObject* ob_var,
+                             PyObject* ob_result) {
+    // As c_gauss_2d_grid, but with [x0,x1), [y0,y1) integer pixel
+    // ranges (as c_gauss_2d_approx3), and float32 arrays.  Each
+    // component is evaluated down to the float underflow limit.
+    int bbox[4];
+    return gauss_float_common(x0, x1, y0, y1, fx, fy, 0., -87.,
+                              ob_amp, ob_mean, ob_var, ob_result,
+                              Py_None, Py_None, Py_None, 0, NULL, bbox);
+}
+
+static int c_gauss_2d_approx3_f(int x0, int x1, int y0, int y1,
+                                double fx, double fy,
+                                double minval,
+                                PyObject* ob_amp,
+                                PyObject* ob_mean,
+                                PyObject* ob_var,
+                                PyObject* ob_result,
+                                PyObject* ob_xderiv,
+                                PyObject* ob_yderiv,
+                                PyObject* ob_mask,
+                                int xc, int yc,
+                                int minradius,
+                                int* sx0, int* sx1, int* sy0, int* sy1) {
+    // As c_gauss_2d_approx3, with float32 arrays.  The
+    // (sx0,sx1,sy0,sy1) slice covers the pixels that were evaluated.
+    int hull[4];
+    int bbox[4];
+    int rtn;
+    rtn = gauss_float_common(x0, x1, y0, y1, fx, fy, minval, -87.,
+                             ob_amp, ob_mean, ob_var, ob_result,
+                             ob_xderiv, ob_yderiv, ob_mask, 0,
+                             approx3_hull(x0, x1, y0, y1, xc, yc,
+                                          minradius, hull), bbox);
+    if (bbox[0] >= bbox[1] || bbox[2] >= bbox[3])
+        bbox[0] = bbox[1] = bbox[2] = bbox[3] = 0;
+    else {
+        bbox[0] -= x0;
+        bbox[1] -= x0;
+        bbox[2] -= y0;
+        bbox[3] -= y0;
+    }
+    *sx0 = bbox[0];
+    *sx1 = bbox[1];
+    *sy0 = bbox[2];
+    *sy1 = bbox[3];
+    return rtn;
+}
+
+static int c_gauss_2d_masked_f(int x0, int y0, int W, int H,
+                               double fx, double fy,
+                               PyObject* ob_amp,
+                               PyObject* ob_mean,
+                               PyObject* ob_var,
+                               PyObject* ob_result,
+                               PyObject* ob_xderiv,
+                               PyObject* ob_yderiv,
+                               PyObject* ob_mask) {
+    // As c_gauss_2d_masked (the results are added into *ob_result*).
+    int bbox[4];
+    return gauss_float_common(x0, x0 + W, y0, y0 + H, fx, fy, 0., -30.,
+                              ob_amp, ob_mean, ob_var, ob_result,
+                              ob_xderiv, ob_yderiv, ob_mask, 1, NULL, bbox);
+}
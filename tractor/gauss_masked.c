@@ -108,6 +108,8 @@ static int c_gauss_2d_masked(int x0, int y0, int W, int H,
             goto bailout;
 
         int dx, dy;
+        Py_BEGIN_ALLOW_THREADS
+        #pragma omp parallel for private(dx) firstprivate(pxd, pyd) if ((long)W * H * K > OMP_MIN_EVALS)
         for (dy=0; dy<H; dy++) {
             int y = y0 + dy;
             int i0 = dy * W;
@@ -141,6 +143,7 @@ static int c_gauss_2d_masked(int x0, int y0, int W, int H,
                 result[i0 + dx] = v;
             }
         }
+        Py_END_ALLOW_THREADS
     }
  bailout:
     Py_XDECREF(np_amp);
@@ -154,3 +157,234 @@ static int c_gauss_2d_masked(int x0, int y0, int W, int H,
     //printf("N expf calls: %i\n", n_expf - nexpf0);
     return rtn;
 }
+
+
+static int c_gauss_2d_param_derivs(int x0, int y0, int W, int H,
+                                   double fx, double fy, double minval,
+                                   PyObject* ob_amp,
+                                   PyObject* ob_mean,
+                                   PyObject* ob_var,
+                                   PyObject* ob_dparams,
+                                   PyObject* ob_result,
+                                   PyObject* ob_derivs,
+                                   PyObject* ob_mask) {
+
+    // Evaluates the mixture, and its derivatives with respect to P
+    // parameters, on the W x H grid starting at (x0,y0), in a single
+    // pass.
+    //
+    // As in c_gauss_2d_approx3, each component is evaluated only
+    // inside the ellipse where it is above its share of "minval" (or,
+    // for minval = 0, within the same cut as c_gauss_2d_grid), found
+    // row by row with approx3_setup / approx3_row.
+    //
+    // ob_dparams: numpy array, P x K x 6: the derivatives of each
+    //   component's (mean_x, mean_y, var_xx, var_xy, var_yy, amp)
+    //   with respect to each parameter.
+    // ob_result: if not None, H x W result array for the mixture
+    // ob_derivs: P x H x W result array for the derivatives
+    // ob_mask: if not None, H x W boolean: which pixels to evaluate.
+    //
+    // Results are *added* to the result arrays.
+
+    double *amp, *mean, *var, *dparams, *result=NULL, *derivs;
+    uint8_t* mask=NULL;
+    const int D=2;
+    const int NT=6;
+    int K, P, k, p, j;
+    int req = NPY_C_CONTIGUOUS | NPY_ALIGNED;
+    int reqout = req | NPY_WRITEABLE | NPY_UPDATEIFCOPY;
+    PyObject *np_amp=NULL, *np_mean=NULL, *np_var=NULL, *np_dparams=NULL;
+    PyObject *np_result=NULL, *np_derivs=NULL, *np_mask=NULL;
+    PyArray_Descr* dtype = PyArray_DescrFromType(PyArray_DOUBLE);
+    PyArray_Descr* btype = PyArray_DescrFromType(PyArray_BOOL);
+    int rtn = -1;
+
+    // PyArray_FromAny steals a reference to the dtype.
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    np_amp     = PyArray_FromAny(ob_amp,     dtype, 1, 1, req, NULL);
+    np_mean    = PyArray_FromAny(ob_mean,    dtype, 2, 2, req, NULL);
+    np_var     = PyArray_FromAny(ob_var,     dtype, 3, 3, req, NULL);
+    np_dparams = PyArray_FromAny(ob_dparams, dtype, 3, 3, req, NULL);
+    np_derivs  = PyArray_FromAny(ob_derivs,  dtype, 3, 3, reqout, NULL);
+    if (ob_result != Py_None)
+        np_result = PyArray_FromAny(ob_result, dtype, 2, 2, reqout, NULL);
+    else
+        Py_DECREF(dtype);
+    if (ob_mask != Py_None)
+        np_mask = PyArray_FromAny(ob_mask, btype, 2, 2, req, NULL);
+    else
+        Py_DECREF(btype);
+
+    if (!np_amp || !np_mean || !np_var || !np_dparams || !np_derivs ||
+        ((ob_result != Py_None) && !np_result) ||
+        ((ob_mask   != Py_None) && !np_mask)) {
+        ERR("c_gauss_2d_param_derivs: an array wasn't the type expected\n");
+        goto bailout;
+    }
+    K = (int)PyArray_DIM(np_amp, 0);
+    P = (int)PyArray_DIM(np_dparams, 0);
+    if ((PyArray_DIM(np_mean, 0) != K) || (PyArray_DIM(np_mean, 1) != D) ||
+        (PyArray_DIM(np_var, 0) != K) || (PyArray_DIM(np_var, 1) != D) ||
+        (PyArray_DIM(np_var, 2) != D) ||
+        (PyArray_DIM(np_dparams, 1) != K) ||
+        (PyArray_DIM(np_dparams, 2) != NT)) {
+        ERR("c_gauss_2d_param_derivs: expected mean K x 2, var K x 2 x 2, "
+            "dparams P x K x 6\n");
+        goto bailout;
+    }
+    if ((PyArray_DIM(np_derivs, 0) != P) ||
+        (PyArray_DIM(np_derivs, 1) != H) ||
+        (PyArray_DIM(np_derivs, 2) != W) ||
+        (np_result && ((PyArray_DIM(np_result, 0) != H) ||
+                       (PyArray_DIM(np_result, 1) != W))) ||
+        (np_mask && ((PyArray_DIM(np_mask, 0) != H) ||
+                     (PyArray_DIM(np_mask, 1) != W)))) {
+        ERR("c_gauss_2d_param_derivs: expected result H x W, "
+            "derivs P x H x W, mask H x W\n");
+        goto bailout;
+    }
+
+    rtn = 0;
+    amp     = PyArray_DATA(np_amp);
+    mean    = PyArray_DATA(np_mean);
+    var     = PyArray_DATA(np_var);
+    dparams = PyArray_DATA(np_dparams);
+    derivs  = PyArray_DATA(np_derivs);
+    if (np_result)
+        result = PyArray_DATA(np_result);
+    if (np_mask)
+        mask   = PyArray_DATA(np_mask);
+
+    {
+        // inverse covariances (xx, xy, yy) and normalizations
+        double II[3*K];
+        double norms[K];
+        // approx3's (scaled) inverse covariances, scales, offset
+        // means and cuts, for the row limits
+        double AI[3*K];
+        double scales[K];
+        double mxy[2*K];
+        double cuts[K];
+        // range [jlo, jhi) of non-zero derivatives for each
+        // (parameter, component) pair
+        uint8_t jlo[P*K];
+        uint8_t jhi[P*K];
+        // union of those ranges, for each component
+        uint8_t klo[K];
+        uint8_t khi[K];
+        double tk[NT];
+        const int NP = W*H;
+        int dy;
+
+        for (k=0; k<K; k++) {
+            double* I = II + 3*k;
+            double vxx =  var[k*D*D + 0];
+            double vxy = (var[k*D*D + 1] + var[k*D*D + 2])*0.5;
+            double vyy =  var[k*D*D + 3];
+            double det = vxx*vyy - vxy*vxy;
+            I[0] =  vyy / det;
+            I[1] = -vxy / det;
+            I[2] =  vxx / det;
+            norms[k] = 1. / (2.*M_PI * sqrt(det));
+            if (!(isfinite(I[0]) && isfinite(I[1]) && isfinite(I[2]) &&
+                  isfinite(norms[k]) && det > 0))
+                norms[k] = 0.;
+            klo[k] = NT;
+            khi[k] = 0;
+            for (p=0; p<P; p++) {
+                double* dp = dparams + (p*K + k)*NT;
+                jlo[p*K + k] = NT;
+                jhi[p*K + k] = 0;
+                for (j=0; j<NT; j++)
+                    if (dp[j] != 0.) {
+                        jlo[p*K + k] = MIN(jlo[p*K + k], j);
+                        jhi[p*K + k] = j+1;
+                    }
+                klo[k] = MIN(klo[k], jlo[p*K + k]);
+                khi[k] = MAX(khi[k], jhi[p*K + k]);
+            }
+        }
+        // (-50: the dsq < 100 cut of c_gauss_2d_grid)
+        approx3_setup(K, amp, mean, var, fx, fy, minval, -50.,
+                      AI, scales, mxy, cuts);
+
+        Py_BEGIN_ALLOW_THREADS
+        #pragma omp parallel for private(k, p, j, tk) if ((long)W * H * K > OMP_MIN_EVALS)
+        for (dy=0; dy<H; dy++) {
+            int iy = y0 + dy;
+            double y = iy - fy;
+            int i0 = dy * W - x0;
+            for (k=0; k<K; k++) {
+                double* I = II + 3*k;
+                double ddy;
+                int ix, xlo, xhi;
+                // (not scales[k], which is zero for zero-amplitude
+                // components that still have amplitude derivatives)
+                if (norms[k] == 0. || !(cuts[k] < 0.))
+                    continue;
+                if (!approx3_row(k, AI, mxy, cuts, x0, x0 + W, iy, NULL,
+                                 &xlo, &xhi))
+                    continue;
+                ddy = y - mean[2*k+1];
+                for (ix=xlo; ix<xhi; ix++) {
+                    double ddx, u0, u1, dsq, g, G;
+                    int i = i0 + ix;
+                    if (mask && !mask[i])
+                        continue;
+                    ddx = ix - fx - mean[2*k+0];
+                    // u = V^-1 (x - mean)
+                    u0 = I[0] * ddx + I[1] * ddy;
+                    u1 = I[1] * ddx + I[2] * ddy;
+                    dsq = ddx * u0 + ddy * u1;
+                    n_exp++;
+                    g = norms[k] * exp(-0.5 * dsq);
+                    G = amp[k] * g;
+                    if (result)
+                        result[i] += G;
+                    if (klo[k] >= khi[k])
+                        continue;
+                    // dG/dmean = G u
+                    // dG/dV    = G (u u^T - V^-1) / 2
+                    // dG/damp  = g
+                    if (klo[k] < 2) {
+                        tk[0] = G * u0;
+                        tk[1] = G * u1;
+                    }
+                    if (klo[k] < 5 && khi[k] > 2) {
+                        tk[2] = G * 0.5 * (u0*u0 - I[0]);
+                        tk[3] = G * (u0*u1 - I[1]);
+                        tk[4] = G * 0.5 * (u1*u1 - I[2]);
+                    }
+                    tk[5] = g;
+                    for (p=0; p<P; p++) {
+                        double* dp;
+                        double d = 0.;
+                        int pk = p*K + k;
+                        if (jlo[pk] >= jhi[pk])
+                            continue;
+                        dp = dparams + pk*NT;
+                        for (j=jlo[pk]; j<jhi[pk]; j++)
+                            d += dp[j] * tk[j];
+                        derivs[p*NP + i] += d;
+                    }
+                }
+            }
+        }
+        Py_END_ALLOW_THREADS
+    }
+
+ bailout:
+    Py_XDECREF(np_amp);
+    Py_XDECREF(np_mean);
+    Py_XDECREF(np_var);
+    Py_XDECREF(np_dparams);
+    Py_XDECREF(np_result);
+    Py_XDECREF(np_derivs);
+    Py_XDECREF(np_mask);
+    return rtn;
+}
@@ -58,6 +58,16 @@ class Image(MultiParams):
         # acceptable approximation level when rendering this model
         # image
         self.modelMinval = 0.
+        # floating-point precision of the Gaussian mixture rendering
+        # kernels for this image: 'double', or 'single' for the
+        # vectorized float32 kernels (with a fast exp approximation;
+        # relative errors ~1e-6).
+        self.modelPrecision = 'double'
+        # maximum subsampling step (a power of two) for rendering
+        # smooth, wide mixture components, within the modelMinval
+        # accuracy budget; 1 renders everything at full resolution.
+        # See MixtureOfGaussians.evaluate_grid_multires.
+        self.modelMaxStep = 1
             
         super(Image, self).__init__(psf, wcs, photocal, sky)
 
@@ -74,6 +84,9 @@ class Image(MultiParams):
                        photocal=self.photocal.copy())
         subtim.name = self.name
         subtim.time = self.time
+        subtim.modelMinval = self.modelMinval
+        subtim.modelPrecision = self.modelPrecision
+        subtim.modelMaxStep = self.modelMaxStep
         return subtim
     
     @staticmethod
@@ -139,6 +152,10 @@ class Image(MultiParams):
                 self.sky.hashkey(), self.wcs.hashkey(),
                 self.photocal.hashkey())
 
+    def versionkey(self):
+        # The pixels are not Params, so include them by identity.
+        return (id(self), self.getVersion(), id(self.data), id(self.inverr))
+
     def numberOfPixels(self):
         (H,W) = self.data.shape
         return W*H
@@ -149,11 +166,13 @@ class Image(MultiParams):
         return self.inverr**2
     def setInvvar(self, iv):
         self.inverr = np.sqrt(iv)
+        self.bumpVersion()
         
     def getImage(self):
         return self.data
     def setImage(self, img):
         self.data = img
+        self.bumpVersion()
 
     def getPsf(self):
         return self.psf
@@ -1,4 +1,5 @@
 from __future__ import print_function
+import time
 import numpy as np
 from astrometry.util.ttime import Time
 from .engine import logverb, isverbose, logmsg
@@ -7,6 +8,41 @@ from .utils import listmax
 
 class LsqrOptimizer(Optimizer):
 
+    # Solve for the update direction without building the sparse
+    # matrix of derivatives; see getUpdateDirection().
+    matrix_free = False
+    # Cache the sparse matrix structure between calls when the
+    # derivative footprints do not change.
+    reuse_structure = True
+
+    # Linear solver for the update direction: 'auto', 'dense',
+    # 'sparse', 'lsmr', 'lsqr', or a LinearSolver; see get_solver().
+    solver = 'auto'
+    # Info about the most recent solve: dict with keys 'solver',
+    # 'time', 'nrows', 'ncols', 'nnz'
+    lastSolve = None
+    # Line search in optimize(): 'linear' (tryUpdatesLinearized) or
+    # 'ladder' (tryUpdates)
+    linesearch = 'linear'
+
+    def __init__(self, matrix_free=False, reuse_structure=True,
+                 solver='auto', linesearch='linear'):
+        super(LsqrOptimizer, self).__init__()
+        self.matrix_free = matrix_free
+        self.reuse_structure = reuse_structure
+        self.solver = solver
+        self.linesearch = linesearch
+        self.lastSolve = None
+        # solver name -> [number of solves, total time]
+        self.solveStats = {}
+
+    def __getstate__(self):
+        # don't pickle the cached matrix structure
+        d = self.__dict__.copy()
+        d.pop('_jstructure', None)
+        d.pop('_linpred', None)
+        return d
+
     def _optimize_forcedphot_core(
             self, tractor,
             result, umodels, imlist, mod0, scales, skyderivs, minFlux,
@@ -250,7 +286,11 @@ class LsqrOptimizer(Optimizer):
     def optimize(self, tractor, alphas=None, damp=0, priors=True,
                  scale_columns=True,
                  shared_params=True, variance=False, just_variance=False,
-                 **nil):
+                 lnp0=None, **nil):
+        '''
+        *lnp0*, if given, is the current log-prob, which the linearized
+        line search then need not recompute.
+        '''
         logverb(tractor.getName()+': Finding derivs...')
         t0 = Time()
         allderivs = tractor.getDerivs()
@@ -284,7 +324,13 @@ class LsqrOptimizer(Optimizer):
         logverb('X: len', len(X), '; non-zero entries:', np.count_nonzero(X))
         logverb('Finding optimal step size...')
         t0 = Time()
-        (dlogprob, alpha) = self.tryUpdates(tractor, X, alphas=alphas)
+        pred = getattr(self, '_linpred', None)
+        if self.linesearch == 'linear' and pred is not None:
+            (dlogprob, alpha) = self.tryUpdatesLinearized(tractor, X, pred,
+                                                          alphas=alphas,
+                                                          lnp0=lnp0)
+        else:
+            (dlogprob, alpha) = self.tryUpdates(tractor, X, alphas=alphas)
         tstep = Time() - t0
         logverb('Finished opt2.')
         logverb('  alpha =',alpha)
@@ -297,10 +343,18 @@ class LsqrOptimizer(Optimizer):
 
     def optimize_loop(self, tractor, dchisq=0., steps=50, **kwargs):
         R = {}
+        # Each step reports its change in log-prob, so (for the
+        # linearized line search) we keep track of the current value
+        # rather than re-rendering to find it.
+        lnp = None
+        if self.linesearch == 'linear':
+            lnp = tractor.getLogProb()
         for step in range(steps):
-            dlnp,X,alpha = self.optimize(tractor, **kwargs)
+            dlnp,X,alpha = self.optimize(tractor, lnp0=lnp, **kwargs)
             if dlnp <= dchisq:
                 break
+            if lnp is not None:
+                lnp += dlnp
         R.update(steps=step)
         return R
     
@@ -308,7 +362,8 @@ class LsqrOptimizer(Optimizer):
                            scale_columns=True, scales_only=False,
                            chiImages=None, variance=False,
                            shared_params=True,
-                           get_A_matrix=False):
+                           get_A_matrix=False, matrix_free=None,
+                           solver=None):
         #
         # Returns: numpy array containing update direction.
         # If *variance* is True, return    (update,variance)
@@ -316,6 +371,18 @@ class LsqrOptimizer(Optimizer):
         # If *scale_only* is True, return column scalings
         # In cases of an empty matrix, returns the list []
         #
+        # If *matrix_free* is True (default: self.matrix_free), the
+        # derivative patches are wrapped in a LinearOperator rather
+        # than expanded into a sparse matrix, and only pixels touched
+        # by some derivative get rows; see _getPatchOperator().
+        #
+        # *solver* (default: self.solver) selects the linear solver;
+        # see get_solver().  Timings are recorded in self.lastSolve
+        # and self.solveStats.
+        #
+        # The linearized change in log-prob along the update direction
+        # is left in self._linpred for tryUpdatesLinearized().
+        #
         # allderivs: [
         #    (param0:)  [  (deriv, img), (deriv, img), ... ],
         #    (param1:)  [],
@@ -341,6 +408,8 @@ class LsqrOptimizer(Optimizer):
         # Parameters to optimize go in the columns of matrix A
         # Pixels go in the rows.
 
+        self._linpred = None
+
         if shared_params:
             # Find shared parameters
             p0 = tractor.getParams()
@@ -352,105 +421,117 @@ class LsqrOptimizer(Optimizer):
             paramindexmap = I
             #print('paramindexmap:', paramindexmap)
             #print('p1:', p1)
+        else:
+            paramindexmap = None
+
+        if matrix_free is None:
+            matrix_free = self.matrix_free
+        if matrix_free:
+            R = self._getPatchOperator(tractor, allderivs, priors,
+                                       scale_columns, scales_only,
+                                       chiImages, paramindexmap)
+            if scales_only or R is None or len(R) == 0:
+                return R
+            A,b,colscales = R
+            if get_A_matrix:
+                return A
+            return self._solveUpdate(A, b, colscales, allderivs, damp,
+                                     variance, scale_columns, paramindexmap,
+                                     solver)
             
-        # Build the sparse matrix of derivatives:
-        sprows = []
-        spcols = []
-        spvals = []
+        # Build the sparse matrix of derivatives.
+        #
+        # The structure of the matrix (which pixels each column
+        # touches) is cached between calls (see _JacobianStructure):
+        # if the derivative footprints have not changed since the last
+        # call, as is typical between optimize_loop() steps, only the
+        # values are refilled.
 
         # Keep track of row offsets for each image.
         imgoffs = {}
+        imgorder = []
         nextrow = 0
         for param in allderivs:
             for deriv,img in param:
                 if img in imgoffs:
                     continue
                 imgoffs[img] = nextrow
+                imgorder.append(img)
                 #print('Putting image', img.name, 'at row offset', nextrow)
                 nextrow += img.numberOfPixels()
         Nrows = nextrow
         del nextrow
-        Ncols = len(allderivs)
+        if shared_params:
+            Ncols = np.max(paramindexmap) + 1
+        else:
+            Ncols = len(allderivs)
 
         # FIXME -- shared_params should share colscales!
         
         colscales = np.ones(len(allderivs))
+        # (col, [(img, deriv, weighted values, above-threshold mask), ...])
+        columns = []
         for col, param in enumerate(allderivs):
-            RR = []
-            VV = []
-            WW = []
+            blocks = []
             for (deriv, img) in param:
-                inverrs = img.getInvError()
                 (H,W) = img.shape
-                row0 = imgoffs[img]
                 deriv.clipTo(W, H)
-                pix = deriv.getPixelIndices(img)
-                if len(pix) == 0:
+                if deriv.patch is None or deriv.patch.size == 0:
                     #print('This param does not influence this image!')
                     continue
-
-                assert(np.all(pix < img.numberOfPixels()))
-                # (grab non-zero indices)
                 dimg = deriv.getImage()
-                nz = np.flatnonzero(dimg)
-                #print('  source', j, 'derivative', p, 'has', len(nz), 'non-zero entries')
-                if len(nz) == 0:
-                    continue
-                rows = row0 + pix[nz]
-                #print('Adding derivative', deriv.getName(), 'for image', img.name)
-                vals = dimg.flat[nz]
-                w = inverrs[deriv.getSlice(img)].flat[nz]
-                assert(vals.shape == w.shape)
-                #if not scales_only:
-                RR.append(rows)
-                VV.append(vals)
-                WW.append(w)
-
-            # massage, re-scale, and clean up matrix elements
-            if len(VV) == 0:
+                vals = dimg * img.getInvError()[deriv.getSlice(img)]
+                blocks.append((img, deriv, vals))
+            if len(blocks) == 0:
                 continue
-            rows = np.hstack(RR)
-            VV = np.hstack(VV)
-            WW = np.hstack(WW)
-            vals = VV * WW
-
-            # shouldn't be necessary since we check len(nz)>0 above
-            #if len(vals) == 0:
-            #   continue
-            mx = np.max(np.abs(vals))
+            mx = max([np.max(np.abs(vals)) for img,deriv,vals in blocks])
             if mx == 0:
-                logmsg('mx == 0:', len(np.flatnonzero(VV)), 'of', len(VV), 'non-zero derivatives,',
-                       len(np.flatnonzero(WW)), 'of', len(WW), 'non-zero weights;',
-                       len(np.flatnonzero(vals)), 'non-zero products')
+                logmsg('mx == 0: column', col, 'has all-zero weighted derivatives')
                 continue
             # MAGIC number: near-zero matrix elements -> 0
             # 'mx' is the max value in this column.
             FACTOR = 1.e-10
-            I = (np.abs(vals) > (FACTOR * mx))
-            rows = rows[I]
-            vals = vals[I]
-            scale = np.sqrt(np.dot(vals, vals))
+            keeps = [(np.abs(vals) > (FACTOR * mx)) for img,deriv,vals in blocks]
+            scale = np.sqrt(sum([np.sum(vals[keep]**2) for (img,deriv,vals),keep
+                                 in zip(blocks, keeps)]))
             colscales[col] = scale
             #logverb('Column', col, 'scale:', scale)
             if scales_only:
                 continue
-
-            sprows.append(rows)
-            spcols.append(col)
-            #c = np.empty_like(rows)
-            #c[:] = col
-            #spcols.append(c)
-            if scale_columns:
-                if scale == 0.:
-                    spvals.append(vals)
-                else:
-                    spvals.append(vals / scale)
-            else:
-                spvals.append(vals)
+            if scale_columns and scale != 0.:
+                blocks = [(img, deriv, vals / scale)
+                          for img,deriv,vals in blocks]
+            columns.append((col, [(img, deriv, vals, keep) for
+                                  (img,deriv,vals),keep in zip(blocks, keeps)]))
                 
         if scales_only:
             return colscales
 
+        from scipy.sparse import csr_matrix
+
+        A = None
+        if len(columns):
+            key = (Nrows, Ncols, tuple([(id(img), imgoffs[img])
+                                        for img in imgorder]),
+                   None if paramindexmap is None else paramindexmap.tostring(),
+                   tuple([(col, tuple([(id(img), deriv.x0, deriv.y0,
+                                        vals.shape) for img,deriv,vals,keep
+                                       in blocks]))
+                          for col,blocks in columns]))
+            S = getattr(self, '_jstructure', None)
+            if not (self.reuse_structure and S is not None and
+                    S.matches(key, columns)):
+                S = _JacobianStructure(key, columns, imgoffs, paramindexmap,
+                                       Nrows, Ncols)
+                if self.reuse_structure:
+                    self._jstructure = S
+            else:
+                logverb('Reusing sparse matrix structure')
+            A = S.fill(columns)
+            if A is None:
+                print('Warning: infinite derivatives; bailing out')
+                return None
+
         b = None
         if priors:
             # We don't include the priors in the "colscales"
@@ -462,43 +543,39 @@ class LsqrOptimizer(Optimizer):
             X = tractor.getLogPriorDerivatives()
             if X is not None:
                 rA,cA,vA,pb,mub = X
-
-                sprows.extend([ri + Nrows for ri in rA])
-                spcols.extend(cA)
-                spvals.extend([vi / colscales[ci] for vi,ci in zip(vA,cA)])
                 oldnrows = Nrows
                 nr = listmax(rA, -1) + 1
                 Nrows += nr
                 logverb('Nrows was %i, added %i rows of priors => %i' % (oldnrows, nr, Nrows))
-                # if len(cA) == 0:
-                #     Ncols = 0
-                # else:
-                #     Ncols = 1 + max(cA)
+                if nr > 0:
+                    from scipy.sparse import vstack
+                    prows = np.hstack(rA).astype(int)
+                    pcols = np.hstack([np.zeros(len(ri), int) + ci
+                                       for ri,ci in zip(rA,cA)])
+                    pvals = np.hstack([np.array(vi, float) / colscales[ci]
+                                       for vi,ci in zip(vA,cA)])
+                    if shared_params:
+                        pcols = paramindexmap[pcols]
+                    P = csr_matrix((pvals, (prows, pcols)), shape=(nr, Ncols))
+                    if A is None:
+                        A = csr_matrix((oldnrows, Ncols))
+                    A = vstack([A, P], format='csr')
 
                 b = np.zeros(Nrows)
                 b[oldnrows:] = np.hstack(pb)
 
-        if len(spcols) == 0:
-            logverb("len(spcols) == 0")
+        if A is None or A.nnz == 0:
+            logverb("No sparse matrix elements")
             return []
 
-        # 'spcols' has one integer per 'sprows' block.
-        # below we hstack the rows, but before doing that, remember how
-        # many rows are in each chunk.
-        spcols = np.array(spcols)
-        nrowspercol = np.array([len(x) for x in sprows])
-        
-        if shared_params:
-            # Apply shared parameter map
-            #print('Before applying shared parameter map:')
-            #print('spcols:', len(spcols), 'elements')
-            #print('  ', len(set(spcols)), 'unique')
-            spcols = paramindexmap[spcols]
-            #print('After:')
-            #print('spcols:', len(spcols), 'elements')
-            #print('  ', len(set(spcols)), 'unique')
-            Ncols = np.max(spcols) + 1
-            logverb('Set Ncols=', Ncols)
+        if isverbose():
+            logverb('  Number of sparse matrix elements:', A.nnz)
+            nrows = np.count_nonzero(np.diff(A.indptr))
+            ncols = len(np.unique(A.indices))
+            logverb('  Unique rows (pixels):', nrows)
+            logverb('  Unique columns (params):', ncols)
+            logverb('  Sparsity factor (possible elements / filled elements):',
+                    float(nrows * ncols) / float(A.nnz))
 
         # b = chi
         #
@@ -528,66 +605,25 @@ class LsqrOptimizer(Optimizer):
             assert(np.all(np.isfinite(chi)))
             #print('Setting [%i:%i) from chi img' % (row0, row0+NP))
             b[row0 : row0 + NP] = chi
-        ###### Zero out unused rows -- FIXME, is this useful??
-        # print('Nrows', Nrows, 'vs len(urows)', len(urows))
-        # bnz = np.zeros(Nrows)
-        # bnz[urows] = b[urows]
-        # print('b', len(b), 'vs bnz', len(bnz))
-        # b = bnz
         assert(np.all(np.isfinite(b)))
 
-        from scipy.sparse import csr_matrix, csc_matrix
-        from scipy.sparse.linalg import lsqr
-
-        spvals = np.hstack(spvals)
-        if not np.all(np.isfinite(spvals)):
-            print('Warning: infinite derivatives; bailing out')
-            return None
-        assert(np.all(np.isfinite(spvals)))
-
-        sprows = np.hstack(sprows) # hogg's lovin' hstack *again* here
-        assert(len(sprows) == len(spvals))
-            
-        # For LSQR, expand 'spcols' to be the same length as 'sprows'.
-        cc = np.empty(len(sprows))
-        i = 0
-        for c,n in zip(spcols, nrowspercol):
-            cc[i : i+n] = c
-            i += n
-        spcols = cc
-        assert(i == len(sprows))
-        assert(len(sprows) == len(spcols))
-
-        logverb('  Number of sparse matrix elements:', len(sprows))
-        urows = np.unique(sprows)
-        ucols = np.unique(spcols)
-        logverb('  Unique rows (pixels):', len(urows))
-        logverb('  Unique columns (params):', len(ucols))
-        if len(urows) == 0 or len(ucols) == 0:
-            return []
-        logverb('  Max row:', urows[-1])
-        logverb('  Max column:', ucols[-1])
-        logverb('  Sparsity factor (possible elements / filled elements):', float(len(urows) * len(ucols)) / float(len(sprows)))
-        
-        # FIXME -- does it make LSQR faster if we remap the row and column
-        # indices so that no rows/cols are empty?
-
-        # FIXME -- we could probably construct the CSC matrix ourselves!
-
-        # Build sparse matrix
-        #A = csc_matrix((spvals, (sprows, spcols)), shape=(Nrows, Ncols))
-        A = csr_matrix((spvals, (sprows, spcols)), shape=(Nrows, Ncols))
-
         if get_A_matrix:
             return A
 
-        lsqropts = dict(show=isverbose(), damp=damp)
-        if variance:
-            lsqropts.update(calc_var=True)
+        logverb('Update direction: %i cols, %i elements' % (Ncols, A.nnz))
+        return self._solveUpdate(A, b, colscales, allderivs, damp, variance,
+                                 scale_columns, paramindexmap, solver)
 
-        # Run lsqr()
-        logverb('LSQR: %i cols (%i unique), %i elements' %
-               (Ncols, len(ucols), len(spvals)-1))
+    def _solveUpdate(self, A, b, colscales, allderivs, damp, variance,
+                     scale_columns, paramindexmap, solver=None):
+        # Solves A X = b (in the least-squares sense) for the scaled
+        # update direction, then undoes the shared-parameter map and
+        # column scaling.
+        shared_params = paramindexmap is not None
+
+        if solver is None:
+            solver = self.solver
+        solver = get_solver(solver)
 
         # print('A matrix:')
         # print(A.todense())
@@ -595,36 +631,39 @@ class LsqrOptimizer(Optimizer):
         # print(b)
 
         bail = False
+        t0 = time.time()
         try:
             # lsqr can trigger floating-point errors
             oldsettings = np.seterr(all='print')
-            (X, istop, niters, r1norm, r2norm, anorm, acond,
-             arnorm, xnorm, var) = lsqr(A, b, **lsqropts)
+            X,var = solver.solve(A, b, damp=damp, variance=variance)
         except ZeroDivisionError:
             print('ZeroDivisionError caught.  Returning zero.')
             bail = True
         # finally:
         np.seterr(**oldsettings)
-
-        del A
-        del b
+        dt = time.time() - t0
+        name = getattr(solver, 'chosen', None) or solver.name
+        self.lastSolve = dict(solver=name, time=dt, nrows=A.shape[0],
+                              ncols=A.shape[1],
+                              nnz=getattr(A, 'nnz', None))
+        stats = self.__dict__.setdefault('solveStats', {})
+        st = stats.setdefault(name, [0, 0.])
+        st[0] += 1
+        st[1] += dt
+        logverb('Solved for update direction with', name, 'in %.3f s' % dt)
 
         if bail:
             if shared_params:
                 return np.zeros(len(paramindexmap))
             return np.zeros(len(allderivs))
 
-        # print('LSQR results:')
-        # print('  istop =', istop)
-        # print('  niters =', niters)
-        # print('  r1norm =', r1norm)
-        # print('  r2norm =', r2norm)
-        # print('  anorm =', anorm)
-        # print('  acord =', acond)
-        # print('  arnorm =', arnorm)
-        # print('  xnorm =', xnorm)
-        # print('  var =', var)
-        
+        # Linearized model: a step alpha*X changes chi to b - alpha*A*X,
+        # so the log-prob changes by alpha*c1 - alpha^2*c2/2.
+        AX = A.dot(X)
+        self._linpred = (np.dot(b, AX), np.dot(AX, AX))
+        del A
+        del b
+
         logverb('scaled  X=', X)
         X = np.array(X)
 
@@ -651,6 +690,165 @@ class LsqrOptimizer(Optimizer):
 
         return X
 
+    def _getPatchOperator(self, tractor, allderivs, priors, scale_columns,
+                          scales_only, chiImages, paramindexmap):
+        #
+        # Matrix-free equivalent of the sparse-matrix construction in
+        # getUpdateDirection(): returns (A, b, colscales) where A is a
+        # scipy LinearOperator whose matvec / rmatvec apply the
+        # (inverse-error weighted, column-scaled) derivative patches
+        # directly.  The rows are only the pixels touched by some
+        # derivative (plus the prior rows), so neither pixel-index
+        # arrays nor full-image-sized vectors are built.
+        #
+        # Returns colscales if *scales_only*, [] for an empty system,
+        # and None for non-finite derivatives, like getUpdateDirection.
+        #
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.linalg import LinearOperator
+
+        if paramindexmap is None:
+            Ncols = len(allderivs)
+        else:
+            Ncols = np.max(paramindexmap) + 1
+
+        # img -> list of (column, deriv patch, weighted values)
+        blocks = {}
+        imgs = []
+        colscales = np.ones(len(allderivs))
+        for col, param in enumerate(allderivs):
+            cblocks = []
+            for (deriv, img) in param:
+                (H,W) = img.shape
+                deriv.clipTo(W, H)
+                if deriv.patch is None or deriv.patch.size == 0:
+                    continue
+                vals = deriv.patch * img.getInvError()[deriv.getSlice(img)]
+                if not np.any(vals):
+                    continue
+                cblocks.append((img, deriv, vals))
+            if len(cblocks) == 0:
+                continue
+            mx = max([np.max(np.abs(vals)) for img,deriv,vals in cblocks])
+            if mx == 0:
+                continue
+            # MAGIC number: near-zero matrix elements -> 0
+            FACTOR = 1.e-10
+            scale = 0.
+            for img,deriv,vals in cblocks:
+                vals[np.abs(vals) <= (FACTOR * mx)] = 0.
+                scale += np.sum(vals**2)
+            scale = np.sqrt(scale)
+            colscales[col] = scale
+            if scales_only:
+                continue
+            if not all([np.all(np.isfinite(vals))
+                        for img,deriv,vals in cblocks]):
+                print('Warning: infinite derivatives; bailing out')
+                return None
+            if paramindexmap is not None:
+                col = paramindexmap[col]
+            for img,deriv,vals in cblocks:
+                if scale_columns and scale != 0.:
+                    vals /= scale
+                if not img in blocks:
+                    blocks[img] = []
+                    imgs.append(img)
+                blocks[img].append((col, deriv, vals))
+
+        if scales_only:
+            return colscales
+
+        # Per image: the bounding box of its derivative patches, the
+        # mask of touched pixels within it, and its first row.
+        chimap = {}
+        if chiImages is not None:
+            for img,chi in zip(tractor.getImages(), chiImages):
+                chimap[img] = chi
+        spaces = []
+        bs = []
+        Nrows = 0
+        for img in imgs:
+            blist = blocks[img]
+            x0 = min([d.x0 for c,d,v in blist])
+            y0 = min([d.y0 for c,d,v in blist])
+            x1 = max([d.x0 + v.shape[1] for c,d,v in blist])
+            y1 = max([d.y0 + v.shape[0] for c,d,v in blist])
+            mask = np.zeros((y1-y0, x1-x0), bool)
+            slist = []
+            for c,d,v in blist:
+                (h,w) = v.shape
+                slc = (slice(d.y0 - y0, d.y0 - y0 + h),
+                       slice(d.x0 - x0, d.x0 - x0 + w))
+                mask[slc] |= (v != 0)
+                slist.append((c, slc, v))
+            n = np.sum(mask)
+            spaces.append((Nrows, n, mask, slist))
+            Nrows += n
+
+            chi = chimap.get(img, None)
+            if chi is None:
+                chi = tractor.getChiImage(img=img)
+            chi = chi[y0:y1, x0:x1][mask]
+            assert(np.all(np.isfinite(chi)))
+            bs.append(chi)
+        Npix = Nrows
+
+        P = None
+        if priors:
+            X = tractor.getLogPriorDerivatives()
+            if X is not None:
+                rA,cA,vA,pb,mub = X
+                nr = listmax(rA, -1) + 1
+                if nr > 0:
+                    prows = np.hstack(rA).astype(int)
+                    pcols = np.hstack([np.zeros(len(ri), int) + ci
+                                       for ri,ci in zip(rA,cA)])
+                    pvals = np.hstack([np.array(vi, float) / colscales[ci]
+                                       for vi,ci in zip(vA,cA)])
+                    if paramindexmap is not None:
+                        pcols = paramindexmap[pcols]
+                    P = csr_matrix((pvals, (prows, pcols)), shape=(nr, Ncols))
+                    Nrows += nr
+                    bs.append(np.hstack(pb))
+                    logverb('Added %i rows of priors' % nr)
+
+        if Nrows == 0:
+            logverb('No matrix elements')
+            return []
+        b = np.hstack(bs).astype(float)
+        assert(np.all(np.isfinite(b)))
+
+        def matvec(x):
+            x = np.ravel(x)
+            y = np.zeros(Nrows)
+            for row0,n,mask,slist in spaces:
+                canvas = np.zeros(mask.shape)
+                for c,slc,v in slist:
+                    canvas[slc] += x[c] * v
+                y[row0 : row0 + n] = canvas[mask]
+            if P is not None:
+                y[Npix:] = P.dot(x)
+            return y
+
+        def rmatvec(y):
+            y = np.ravel(y)
+            x = np.zeros(Ncols)
+            for row0,n,mask,slist in spaces:
+                canvas = np.zeros(mask.shape)
+                canvas[mask] = y[row0 : row0 + n]
+                for c,slc,v in slist:
+                    x[c] += np.sum(v * canvas[slc])
+            if P is not None:
+                x += P.T.dot(y[Npix:])
+            return x
+
+        logverb('Matrix-free LSQR: %i rows (%i pixels), %i cols' %
+                (Nrows, Npix, Ncols))
+        A = LinearOperator((Nrows, Ncols), matvec=matvec, rmatvec=rmatvec,
+                           dtype=float)
+        return A, b, colscales
+
     # def getParameterScales(self):
     #     print(self.getName()+': Finding derivs...')
     #     allderivs = self.getDerivs()
@@ -658,3 +856,351 @@ class LsqrOptimizer(Optimizer):
     #     s = self.getUpdateDirection(allderivs, scales_only=True)
     #     return s
 
+
+class SolverFailed(Exception):
+    '''
+    Raised by a LinearSolver that cannot (reliably) solve a system,
+    eg, because the normal equations are too ill-conditioned.
+    '''
+    pass
+
+class LinearSolver(object):
+    '''
+    Solves the damped linear least-squares problem
+
+        min_x  || A x - b ||^2 + damp^2 || x ||^2
+
+    for the update direction in LsqrOptimizer.getUpdateDirection().
+    *A* is a scipy sparse matrix or LinearOperator.
+
+    solve() returns (x, var), where *var* is the diagonal of the
+    covariance, (A^T A + damp^2 I)^-1, if *variance* is True, else
+    None.
+    '''
+    name = None
+
+    def solve(self, A, b, damp=0., variance=False):
+        raise NotImplementedError()
+
+def _normal_equations(A, b, damp, dense):
+    # Returns (A^T A + damp^2 I, A^T b); A^T A is a dense array if
+    # *dense*, else a CSC matrix.
+    from scipy.sparse import issparse, csc_matrix, identity
+    N = A.shape[1]
+    if issparse(A):
+        AtA = A.T.dot(A)
+        Atb = A.T.dot(b)
+        if dense:
+            AtA = AtA.toarray()
+        else:
+            AtA = AtA.tocsc()
+    else:
+        # LinearOperator: one matvec/rmatvec pair per column
+        AtA = np.zeros((N,N))
+        e = np.zeros(N)
+        for j in range(N):
+            e[j] = 1.
+            AtA[:,j] = A.rmatvec(A.matvec(e))
+            e[j] = 0.
+        Atb = A.rmatvec(b)
+        if not dense:
+            AtA = csc_matrix(AtA)
+    if damp:
+        if dense:
+            AtA[np.diag_indices(N)] += damp**2
+        else:
+            AtA = (AtA + damp**2 * identity(N, format='csc')).tocsc()
+    return AtA, np.asarray(Atb, float)
+
+class DenseCholeskySolver(LinearSolver):
+    '''
+    Forms the (dense) normal equations and solves them by Cholesky
+    decomposition -- very fast for a modest number of parameters, and
+    gives exact variances.
+
+    Raises SolverFailed if the (estimated) condition number of the
+    normal equations exceeds *maxcond*.
+    '''
+    name = 'dense'
+
+    def __init__(self, maxcond=1e12):
+        self.maxcond = maxcond
+
+    def solve(self, A, b, damp=0., variance=False):
+        from scipy.linalg import cho_factor, cho_solve, LinAlgError
+        AtA,Atb = _normal_equations(A, b, damp, True)
+        N = len(Atb)
+        X = np.zeros(N)
+        var = None
+        if variance:
+            var = np.zeros(N)
+        # columns with no derivatives get zero update (as in LSQR)
+        I = np.flatnonzero(np.diag(AtA) > 0)
+        if len(I) == 0:
+            return X, var
+        try:
+            C = cho_factor(AtA[np.ix_(I,I)])
+        except LinAlgError:
+            raise SolverFailed('normal equations not positive definite')
+        d = np.abs(np.diag(C[0]))
+        cond = (d.max() / d.min())**2
+        if not np.isfinite(cond) or cond > self.maxcond:
+            raise SolverFailed('normal equations ill-conditioned (%g)' % cond)
+        X[I] = cho_solve(C, Atb[I])
+        if variance:
+            var[I] = np.diag(cho_solve(C, np.eye(len(I))))
+        return X, var
+
+class SparseCholeskySolver(LinearSolver):
+    '''
+    Forms the sparse normal equations and factors them with CHOLMOD
+    (scikit-sparse), if available, or scipy's sparse LU otherwise.
+    Suitable for many parameters with block-sparse couplings (eg,
+    sources that overlap only their neighbours).
+
+    Variances take one solve per parameter (in blocks of *varblock*).
+    Raises SolverFailed for (estimated) condition number > *maxcond*.
+    '''
+    name = 'sparse'
+
+    def __init__(self, maxcond=1e12, varblock=256):
+        self.maxcond = maxcond
+        self.varblock = varblock
+
+    def solve(self, A, b, damp=0., variance=False):
+        AtA,Atb = _normal_equations(A, b, damp, False)
+        N = len(Atb)
+        X = np.zeros(N)
+        var = None
+        if variance:
+            var = np.zeros(N)
+        I = np.flatnonzero(AtA.diagonal() > 0)
+        if len(I) == 0:
+            return X, var
+        M = AtA[I,:][:,I].tocsc()
+        try:
+            from sksparse.cholmod import cholesky, CholmodError
+            try:
+                F = cholesky(M)
+            except CholmodError:
+                raise SolverFailed('normal equations not positive definite')
+            fsolve = F
+        except ImportError:
+            from scipy.sparse.linalg import splu
+            try:
+                F = splu(M)
+            except RuntimeError:
+                raise SolverFailed('normal equations singular')
+            d = np.abs(F.U.diagonal())
+            cond = d.max() / d.min()
+            if not np.isfinite(cond) or cond > self.maxcond:
+                raise SolverFailed('normal equations ill-conditioned (%g)' %
+                                   cond)
+            fsolve = F.solve
+        X[I] = fsolve(Atb[I])
+        if variance:
+            n = len(I)
+            for j0 in range(0, n, self.varblock):
+                j1 = min(n, j0 + self.varblock)
+                E = np.zeros((n, j1 - j0))
+                E[np.arange(j0, j1), np.arange(j1 - j0)] = 1.
+                Z = fsolve(E)
+                var[I[j0:j1]] = Z[np.arange(j0, j1), np.arange(j1 - j0)]
+        return X, var
+
+class LsqrSolver(LinearSolver):
+    '''
+    scipy's LSQR -- the original (and fully general) solver; its
+    variances are LSQR's estimates.
+    '''
+    name = 'lsqr'
+
+    def solve(self, A, b, damp=0., variance=False):
+        from scipy.sparse.linalg import lsqr
+        lsqropts = dict(show=isverbose(), damp=damp)
+        if variance:
+            lsqropts.update(calc_var=True)
+        (X, istop, niters, r1norm, r2norm, anorm, acond,
+         arnorm, xnorm, var) = lsqr(A, b, **lsqropts)
+        logverb('LSQR: istop', istop, 'niters', niters, 'acond', acond)
+        if not variance:
+            var = None
+        return np.array(X), var
+
+class LsmrSolver(LinearSolver):
+    '''
+    scipy's LSMR, which converges more smoothly than LSQR on
+    ill-conditioned problems.  LSMR does not estimate variances; if
+    they are requested they are computed from the sparse normal
+    equations.
+    '''
+    name = 'lsmr'
+
+    def solve(self, A, b, damp=0., variance=False):
+        from scipy.sparse.linalg import lsmr
+        R = lsmr(A, b, damp=damp, show=isverbose())
+        X,istop,niters = R[:3]
+        logverb('LSMR: istop', istop, 'niters', niters)
+        var = None
+        if variance:
+            N = A.shape[1]
+            try:
+                nil,var = SparseCholeskySolver(maxcond=np.inf).solve(
+                    A, np.zeros(A.shape[0]), damp=damp, variance=True)
+            except SolverFailed:
+                var = np.zeros(N)
+        return np.array(X), var
+
+class AutoSolver(LinearSolver):
+    '''
+    Chooses a solver based on the shape and sparsity of the problem:
+
+    - up to *dense_max_cols* parameters: DenseCholeskySolver;
+    - sparse matrices with up to *sparse_max_cols* parameters and at
+      most *sparse_max_nnz* non-zeros: SparseCholeskySolver;
+    - otherwise LsqrSolver.
+
+    If a normal-equations solver fails because the problem is too
+    ill-conditioned, falls back to LsmrSolver (or LsqrSolver, if
+    variances are wanted).  The name of the solver used is recorded
+    in *chosen*.
+    '''
+    name = 'auto'
+
+    def __init__(self, dense_max_cols=500, sparse_max_cols=20000,
+                 sparse_max_nnz=50000000):
+        self.dense_max_cols = dense_max_cols
+        self.sparse_max_cols = sparse_max_cols
+        self.sparse_max_nnz = sparse_max_nnz
+        self.chosen = None
+
+    def choose(self, A):
+        from scipy.sparse import issparse
+        N = A.shape[1]
+        if N <= self.dense_max_cols:
+            return DenseCholeskySolver()
+        if (issparse(A) and N <= self.sparse_max_cols and
+            A.nnz <= self.sparse_max_nnz):
+            return SparseCholeskySolver()
+        return LsqrSolver()
+
+    def solve(self, A, b, damp=0., variance=False):
+        solver = self.choose(A)
+        try:
+            R = solver.solve(A, b, damp=damp, variance=variance)
+        except SolverFailed as e:
+            logverb('Solver', solver.name, 'failed:', e)
+            if variance:
+                solver = LsqrSolver()
+            else:
+                solver = LsmrSolver()
+            R = solver.solve(A, b, damp=damp, variance=variance)
+        self.chosen = solver.name
+        return R
+
+_solvers = dict(auto=AutoSolver, dense=DenseCholeskySolver,
+                sparse=SparseCholeskySolver, lsqr=LsqrSolver,
+                lsmr=LsmrSolver)
+
+def get_solver(solver):
+    '''
+    Returns a LinearSolver given a LinearSolver or one of the names
+    'auto', 'dense', 'sparse', 'lsqr', 'lsmr'.  The explicitly-named
+    normal-equations solvers fall back to LSQR if they fail.
+    '''
+    if isinstance(solver, LinearSolver):
+        return solver
+    if solver is None:
+        solver = 'auto'
+    if solver in ['dense', 'sparse']:
+        return _FallbackSolver(_solvers[solver]())
+    return _solvers[solver]()
+
+class _FallbackSolver(LinearSolver):
+    def __init__(self, solver):
+        self.solver = solver
+        self.name = solver.name
+        self.chosen = None
+    def solve(self, A, b, damp=0., variance=False):
+        try:
+            R = self.solver.solve(A, b, damp=damp, variance=variance)
+            self.chosen = self.solver.name
+        except SolverFailed as e:
+            logmsg('Solver', self.solver.name, 'failed:', e,
+                   '; falling back to LSQR')
+            R = LsqrSolver().solve(A, b, damp=damp, variance=variance)
+            self.chosen = 'lsqr'
+        return R
+
+
+class _JacobianStructure(object):
+    '''
+    The sparsity structure of the (pixels x params) matrix of
+    derivatives built by LsqrOptimizer.getUpdateDirection().
+
+    The pattern of each derivative patch is the pixels with non-zero
+    inverse-error (rather than the non-zero derivatives, which come
+    and go, eg, along the symmetry axes of a source centered on a
+    pixel).  As long as the footprints (position and shape of each
+    patch in each column) are the same and the non-zero elements stay
+    within the pattern, a new set of derivatives can be poured into
+    the existing CSR structure with a single bincount, skipping the
+    COO-to-CSR conversion and its sort.
+    '''
+    def __init__(self, key, columns, imgoffs, paramindexmap, Nrows, Ncols):
+        self.key = key
+        self.shape = (Nrows, Ncols)
+        # per block, the flat indices (within the patch) in the pattern
+        self.patterns = []
+        rows = []
+        cols = []
+        for col,blocks in columns:
+            if paramindexmap is not None:
+                col = paramindexmap[col]
+            for img,deriv,vals,keep in blocks:
+                nz = np.flatnonzero(img.getInvError()[deriv.getSlice(img)])
+                self.patterns.append(nz)
+                pix = deriv.getPixelIndices(img)
+                rows.append(imgoffs[img] + pix[nz])
+                cols.append(np.zeros(len(nz), int) + col)
+        rows = np.hstack(rows)
+        cols = np.hstack(cols)
+        # unique (row,col) elements in CSR order; "inverse" maps each
+        # pattern element to its slot (duplicates get summed).
+        U,self.inverse = np.unique(rows * Ncols + cols, return_inverse=True)
+        self.indices = (U % Ncols).astype(np.int32)
+        counts = np.bincount((U // Ncols).astype(int), minlength=Nrows)
+        self.indptr = np.append(0, np.cumsum(counts)).astype(np.int32)
+
+    def matches(self, key, columns):
+        if key != self.key:
+            return False
+        i = 0
+        for col,blocks in columns:
+            for img,deriv,vals,keep in blocks:
+                if np.count_nonzero(keep) != np.count_nonzero(
+                        keep.flat[self.patterns[i]]):
+                    return False
+                i += 1
+        return True
+
+    def fill(self, columns):
+        '''
+        Returns the CSR matrix for the given derivative values, or None
+        if they are not all finite.
+        '''
+        from scipy.sparse import csr_matrix
+        vals = []
+        i = 0
+        for col,blocks in columns:
+            for img,deriv,v,keep in blocks:
+                nz = self.patterns[i]
+                v = v.flat[nz] * keep.flat[nz]
+                vals.append(v)
+                i += 1
+        vals = np.hstack(vals)
+        if not np.all(np.isfinite(vals)):
+            return None
+        data = np.bincount(self.inverse, weights=vals,
+                           minlength=len(self.indices))
+        return csr_matrix((data, self.indices, self.indptr), shape=self.shape)
@@ -7,6 +7,17 @@
 #include <math.h>
 #include <assert.h>
 #include <sys/param.h>
+#include <limits.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+// All the evaluators release the GIL while they run, so sources can
+// be rendered from several Python threads.  Above this many Gaussian
+// evaluations, they also split their rows across OpenMP threads (when
+// built with OpenMP).  (The n_exp counters are only approximate
+// then.)
+#define OMP_MIN_EVALS 100000
 
 static int n_exp = 0;
 static int n_expf = 0;
@@ -388,6 +399,8 @@ static int c_gauss_2d(PyObject* ob_pos, PyObject* ob_amp,
         scale[k] = amp[k] / sqrt(tpd * det);
     }
     
+    Py_BEGIN_ALLOW_THREADS
+    #pragma omp parallel for private(k) if ((long)N * K > OMP_MIN_EVALS)
     for (i=0; i<N; i++) {
         for (k=0; k<K; k++) {
             double dsq;
@@ -403,6 +416,7 @@ static int c_gauss_2d(PyObject* ob_pos, PyObject* ob_amp,
             result[i] += scale[k] * exp(-0.5 * dsq);
         }
     }
+    Py_END_ALLOW_THREADS
     rtn = 0;
 
 bailout:
@@ -461,8 +475,10 @@ static int c_gauss_2d_grid(int x0, int x1, int y0, int y1, double fx, double fy,
             scale[k] = amp[k] / sqrt(tpd * det);
         }
 
-        i = 0;
+        Py_BEGIN_ALLOW_THREADS
+        #pragma omp parallel for private(i, ix, k) if ((long)NX * NY * K > OMP_MIN_EVALS)
         for (iy=y0; iy<y1; iy++) {
+            i = (iy - y0) * NX;
             for (ix=x0; ix<x1; ix++) {
                 for (k=0; k<K; k++) {
                     double dsq;
@@ -479,6 +495,7 @@ static int c_gauss_2d_grid(int x0, int x1, int y0, int y1, double fx, double fy,
                 i++;
             }
         }
+        Py_END_ALLOW_THREADS
         rtn = 0;
     }
 
@@ -517,6 +534,7 @@ static int c_gauss_2d_approx(int x0, int x1, int y0, int y1,
     var = PyArray_DATA(np_var);
     result = PyArray_DATA(np_result);
 
+    Py_BEGIN_ALLOW_THREADS
     for (k=0; k<K; k++) {
         // We symmetrize the covariance matrix,
         // so V,I just have three elements: x**2, xy, y**2.
@@ -599,6 +617,7 @@ static int c_gauss_2d_approx(int x0, int x1, int y0, int y1,
                 break;
         }
     }
+    Py_END_ALLOW_THREADS
     rtn = 0;
 bailout:
     Py_XDECREF(np_amp);
@@ -649,6 +668,7 @@ static int c_gauss_2d_approx2(int x0, int x1, int y0, int y1,
     var = PyArray_DATA(np_var);
     result = PyArray_DATA(np_result);
 
+    Py_BEGIN_ALLOW_THREADS
     II = malloc(sizeof(double) * 3 * K);
     VV = malloc(sizeof(double) * 3 * K);
     scales = malloc(sizeof(double) * K);
@@ -1028,6 +1048,7 @@ static int c_gauss_2d_approx2(int x0, int x1, int y0, int y1,
         if (!any)
             break;
     }
+    Py_END_ALLOW_THREADS
     rtn = 0;
 
 #undef SET
@@ -1071,6 +1092,16 @@ static int c_gauss_2d_approx3(int x0, int x1, int y0, int y1,
                               int* p_sx0, int* p_sx1, int* p_sy0, int* p_sy1
                               );
 
+static int c_gauss_2d_approx3_extent(int x0, int x1, int y0, int y1,
+                                     double fx, double fy, double minval,
+                                     PyObject* ob_amp,
+                                     PyObject* ob_mean,
+                                     PyObject* ob_var,
+                                     int xc, int yc,
+                                     int minradius,
+                                     int* p_sx0, int* p_sx1, int* p_sy0, int* p_sy1
+                                     );
+
 #include "approx3.c"
 
 
@@ -1086,8 +1117,338 @@ static int c_gauss_2d_masked(int x0, int y0, int W, int H,
                              PyObject* ob_yderiv,
                              PyObject* ob_mask);
 
+static int c_gauss_2d_param_derivs(int x0, int y0, int W, int H,
+                                   double fx, double fy, double minval,
+                                   PyObject* ob_amp,
+                                   PyObject* ob_mean,
+                                   PyObject* ob_var,
+                                   PyObject* ob_dparams,
+                                   PyObject* ob_result,
+                                   PyObject* ob_derivs,
+                                   PyObject* ob_mask);
+
 #include "gauss_masked.c"
 
+static int c_gauss_2d_grid_f(int x0, int x1, int y0, int y1,
+                             double fx, double fy,
+                             PyObject* ob_amp,
+                             PyObject* ob_mean,
+                             PyObject* ob_var,
+                             PyObject* ob_result);
+
+static int c_gauss_2d_approx3_f(int x0, int x1, int y0, int y1,
+                                double fx, double fy,
+                                double minval,
+                                PyObject* ob_amp,
+                                PyObject* ob_mean,
+                                PyObject* ob_var,
+                                PyObject* ob_result,
+                                PyObject* ob_xderiv,
+                                PyObject* ob_yderiv,
+                                PyObject* ob_mask,
+                                int xc, int yc,
+                                int minradius,
+                                int* p_sx0, int* p_sx1, int* p_sy0, int* p_sy1
+                                );
+
+static int c_gauss_2d_masked_f(int x0, int y0, int W, int H,
+                               double fx, double fy,
+                               PyObject* ob_amp,
+                               PyObject* ob_mean,
+                               PyObject* ob_var,
+                               PyObject* ob_result,
+                               PyObject* ob_xderiv,
+                               PyObject* ob_yderiv,
+                               PyObject* ob_mask);
+
+#include "gauss_float.c"
+
+static void batch_render_one(int K, const double* amp,
+                             const double* mean, const double* var,
+                             double fx, double fy, const int32_t* bbox,
+                             double minval, int by0, int by1,
+                             double* image, int W, int H,
+                             double* patch) {
+    // Renders one mixture of c_gauss_2d_batch, restricted to rows
+    // [by0, by1): into *image* (W x H) if not NULL, else into its
+    // *patch*.
+    const int D = 2;
+    double tpd = pow(2.*M_PI, D);
+    int x0 = bbox[0];
+    int x1 = bbox[1];
+    int y0 = bbox[2];
+    int y1 = bbox[3];
+    int pw = x1 - x0;
+    int py0 = y0;
+    double ampsum = 0.;
+    double* dst;
+    int k, ix, iy;
+
+    if ((pw <= 0) || (y1 <= y0) || (K == 0))
+        return;
+    if (image) {
+        x0 = MAX(x0, 0);
+        x1 = MIN(x1, W);
+        y0 = MAX(y0, 0);
+        y1 = MIN(y1, H);
+    }
+    y0 = MAX(y0, by0);
+    y1 = MIN(y1, by1);
+    if ((x0 >= x1) || (y0 >= y1))
+        return;
+
+    for (k=0; k<K; k++)
+        ampsum += amp[k];
+
+    // Each component is evaluated only within the ellipse where it
+    // is above the cut (as in c_gauss_2d_approx3 for minval > 0;
+    // c_gauss_2d_grid otherwise); solve for its extent in each row.
+    for (k=0; k<K; k++) {
+        const double* V = var + k*D*D;
+        double v1 = (V[1] + V[2]) * 0.5;
+        double det = V[0]*V[3] - v1*v1;
+        double isc = -0.5 / det;
+        // exponent = I0 dx^2 + I1 dx dy + I2 dy^2
+        double I0 =  V[3] * isc;
+        double I1 = -v1 * isc * 2.0;
+        double I2 =  V[0] * isc;
+        double scale = amp[k] / sqrt(tpd * det);
+        double mx = mean[k*D + 0] + fx;
+        double my = mean[k*D + 1] + fy;
+        double cut, ry;
+        int ylo, yhi;
+
+        if (!(det > 0) || !isfinite(scale) || (scale == 0.) ||
+            !isfinite(mx) || !isfinite(my))
+            continue;
+        if (minval > 0.0) {
+            cut = log(minval * sqrt(tpd*det) / ampsum);
+            if (cut < -100.)
+                cut = -100.;
+        } else {
+            cut = -50.;
+        }
+        if (cut >= 0.)
+            continue;
+        // max |dy| on the ellipse  exponent = cut
+        ry = sqrt(-2. * cut * V[3]);
+        // (clamp in double precision; the ellipse can be huge)
+        ylo = (int)MAX((double)y0, ceil (my - ry));
+        yhi = (int)MIN((double)y1, floor(my + ry) + 1.);
+
+        for (iy=ylo; iy<yhi; iy++) {
+            double dy = iy - my;
+            double b = I1 * dy;
+            double c = I2 * dy * dy - cut;
+            double disc = b*b - 4. * I0 * c;
+            double sq, xa, xb;
+            int xlo, xhi;
+            if (disc < 0)
+                continue;
+            // I0 < 0
+            sq = sqrt(disc);
+            xa = (-b + sq) / (2. * I0);
+            xb = (-b - sq) / (2. * I0);
+            xlo = (int)MAX((double)x0, ceil (mx + xa));
+            xhi = (int)MIN((double)x1, floor(mx + xb) + 1.);
+            if (xlo >= xhi)
+                continue;
+            if (image)
+                dst = image + (npy_intp)iy * W;
+            else
+                dst = patch + (npy_intp)(iy - py0) * pw - bbox[0];
+            for (ix=xlo; ix<xhi; ix++) {
+                double dx = ix - mx;
+                dst[ix] += scale * exp(I0 * dx * dx + b * dx + c + cut);
+            }
+        }
+    }
+}
+
+static int c_gauss_2d_batch(PyObject* ob_amp,
+                            PyObject* ob_mean,
+                            PyObject* ob_var,
+                            PyObject* ob_koff,
+                            PyObject* ob_offset,
+                            PyObject* ob_bbox,
+                            PyObject* ob_minval,
+                            PyObject* ob_image,
+                            PyObject* ob_patches,
+                            PyObject* ob_poff) {
+    // Renders N mixtures of Gaussians in a single call.
+    //
+    // ob_amp, ob_mean, ob_var: (Ktot), (Ktot,2), (Ktot,2,2) doubles:
+    // the components of all the mixtures, concatenated; mixture i
+    // is components [koff[i], koff[i+1]).
+    //
+    // ob_koff: int32, N+1
+    // ob_offset: (N,2) doubles: (fx,fy) pixel offset of each mixture
+    // ob_bbox: int32, (N,4): [x0, x1, y0, y1) pixels to evaluate
+    // ob_minval: N doubles: as in c_gauss_2d_approx3, components are
+    //   not evaluated where they are below this value.
+    //
+    // ob_image: if not None, a 2-D array of doubles into which all
+    //   the mixtures are *added*; the bboxes are clipped to it.
+    //
+    // Otherwise, ob_patches: 1-D array of doubles into which mixture
+    //   i is added, as a (y1-y0, x1-x0) patch starting at element
+    //   ob_poff[i] (int32, N).
+    const int D = 2;
+    int req = NPY_C_CONTIGUOUS | NPY_ALIGNED;
+    int reqout = req | NPY_WRITEABLE | NPY_UPDATEIFCOPY;
+    PyObject *np_amp=NULL, *np_mean=NULL, *np_var=NULL, *np_koff=NULL;
+    PyObject *np_offset=NULL, *np_bbox=NULL, *np_minval=NULL;
+    PyObject *np_image=NULL, *np_patches=NULL, *np_poff=NULL;
+    double *amp, *mean, *var, *offset, *minval, *out;
+    int32_t *koff, *bbox, *poff = NULL;
+    int N, i;
+    int W = 0, H = 0;
+    npy_intp NP = 0;
+    int rtn = -1;
+
+    np_amp = PyArray_FromAny(ob_amp, PyArray_DescrFromType(NPY_DOUBLE),
+                             1, 1, req, NULL);
+    np_mean = PyArray_FromAny(ob_mean, PyArray_DescrFromType(NPY_DOUBLE),
+                              2, 2, req, NULL);
+    np_var = PyArray_FromAny(ob_var, PyArray_DescrFromType(NPY_DOUBLE),
+                             3, 3, req, NULL);
+    np_koff = PyArray_FromAny(ob_koff, PyArray_DescrFromType(NPY_INT32),
+                              1, 1, req, NULL);
+    np_offset = PyArray_FromAny(ob_offset, PyArray_DescrFromType(NPY_DOUBLE),
+                                2, 2, req, NULL);
+    np_bbox = PyArray_FromAny(ob_bbox, PyArray_DescrFromType(NPY_INT32),
+                              2, 2, req, NULL);
+    np_minval = PyArray_FromAny(ob_minval, PyArray_DescrFromType(NPY_DOUBLE),
+                                1, 1, req, NULL);
+    if (!np_amp || !np_mean || !np_var || !np_koff || !np_offset ||
+        !np_bbox || !np_minval) {
+        ERR("c_gauss_2d_batch: inputs weren't the type expected\n");
+        goto bailout;
+    }
+    if (ob_image != Py_None) {
+        np_image = PyArray_FromAny(ob_image, PyArray_DescrFromType(NPY_DOUBLE),
+                                   2, 2, reqout, NULL);
+        if (!np_image) {
+            ERR("c_gauss_2d_batch: image wasn't the type expected\n");
+            goto bailout;
+        }
+        H = (int)PyArray_DIM(np_image, 0);
+        W = (int)PyArray_DIM(np_image, 1);
+        out = PyArray_DATA(np_image);
+    } else {
+        np_patches = PyArray_FromAny(ob_patches,
+                                     PyArray_DescrFromType(NPY_DOUBLE),
+                                     1, 1, reqout, NULL);
+        np_poff = PyArray_FromAny(ob_poff, PyArray_DescrFromType(NPY_INT32),
+                                  1, 1, req, NULL);
+        if (!np_patches || !np_poff) {
+            ERR("c_gauss_2d_batch: patches wasn't the type expected\n");
+            goto bailout;
+        }
+        NP = PyArray_DIM(np_patches, 0);
+        out = PyArray_DATA(np_patches);
+        poff = PyArray_DATA(np_poff);
+    }
+
+    N = (int)PyArray_DIM(np_koff, 0) - 1;
+    if ((N < 0) ||
+        (PyArray_DIM(np_offset, 0) != N) || (PyArray_DIM(np_offset, 1) != D) ||
+        (PyArray_DIM(np_bbox, 0) != N) || (PyArray_DIM(np_bbox, 1) != 4) ||
+        (PyArray_DIM(np_minval, 0) != N) ||
+        (np_poff && (PyArray_DIM(np_poff, 0) != N))) {
+        ERR("c_gauss_2d_batch: koff, offset, bbox, minval, poff must have N+1, N entries\n");
+        goto bailout;
+    }
+    amp    = PyArray_DATA(np_amp);
+    mean   = PyArray_DATA(np_mean);
+    var    = PyArray_DATA(np_var);
+    koff   = PyArray_DATA(np_koff);
+    offset = PyArray_DATA(np_offset);
+    bbox   = PyArray_DATA(np_bbox);
+    minval = PyArray_DATA(np_minval);
+
+    for (i=0; i<N; i++) {
+        if ((koff[i] < 0) || (koff[i+1] < koff[i]) ||
+            (koff[i+1] > PyArray_DIM(np_amp, 0))) {
+            ERR("c_gauss_2d_batch: bad koff\n");
+            goto bailout;
+        }
+    }
+    if ((PyArray_DIM(np_mean, 0) != PyArray_DIM(np_amp, 0)) ||
+        (PyArray_DIM(np_mean, 1) != D) ||
+        (PyArray_DIM(np_var, 0) != PyArray_DIM(np_amp, 0)) ||
+        (PyArray_DIM(np_var, 1) != D) || (PyArray_DIM(np_var, 2) != D)) {
+        ERR("c_gauss_2d_batch: mean, var must be Ktot x D, Ktot x D x D\n");
+        goto bailout;
+    }
+
+    if (!np_image) {
+        for (i=0; i<N; i++) {
+            npy_intp pw = MAX(0, bbox[i*4 + 1] - bbox[i*4 + 0]);
+            npy_intp ph = MAX(0, bbox[i*4 + 3] - bbox[i*4 + 2]);
+            if ((poff[i] < 0) || ((npy_intp)poff[i] + pw * ph > NP)) {
+                ERR("c_gauss_2d_batch: patch %i overflows the patches array\n", i);
+                goto bailout;
+            }
+        }
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    {
+        // Split the output rows into bands; each band renders the
+        // parts of all the sources that fall in it, so threads never
+        // write the same pixels.
+        int ylo = INT_MAX, yhi = INT_MIN;
+        long work = 0;
+        int b, nb = 1;
+        for (i=0; i<N; i++) {
+            int y0 = bbox[i*4 + 2];
+            int y1 = bbox[i*4 + 3];
+            if (np_image) {
+                y0 = MAX(y0, 0);
+                y1 = MIN(y1, H);
+            }
+            if (y0 >= y1)
+                continue;
+            ylo = MIN(ylo, y0);
+            yhi = MAX(yhi, y1);
+            work += (long)(y1 - y0) * MAX(0, bbox[i*4 + 1] - bbox[i*4 + 0]) *
+                (koff[i+1] - koff[i]);
+        }
+#ifdef _OPENMP
+        if (work > OMP_MIN_EVALS)
+            nb = MIN(4 * omp_get_max_threads(), MAX(1, yhi - ylo));
+#endif
+        #pragma omp parallel for private(i) schedule(dynamic) if (nb > 1)
+        for (b=0; b<nb; b++) {
+            int by0 = ylo + (int)(((long)(yhi - ylo) * b) / nb);
+            int by1 = ylo + (int)(((long)(yhi - ylo) * (b+1)) / nb);
+            for (i=0; i<N; i++)
+                batch_render_one(koff[i+1] - koff[i], amp + koff[i],
+                                 mean + koff[i]*D, var + koff[i]*D*D,
+                                 offset[i*D + 0], offset[i*D + 1],
+                                 bbox + i*4, minval[i], by0, by1,
+                                 np_image ? out : NULL, W, H,
+                                 np_image ? NULL : out + poff[i]);
+        }
+    }
+    Py_END_ALLOW_THREADS
+    rtn = 0;
+
+bailout:
+    Py_XDECREF(np_amp);
+    Py_XDECREF(np_mean);
+    Py_XDECREF(np_var);
+    Py_XDECREF(np_koff);
+    Py_XDECREF(np_offset);
+    Py_XDECREF(np_bbox);
+    Py_XDECREF(np_minval);
+    Py_XDECREF(np_image);
+    Py_XDECREF(np_patches);
+    Py_XDECREF(np_poff);
+    return rtn;
+}
+
 
 %}
 
@@ -35,7 +35,11 @@ def get_exp_mixture():
 def get_dev_mixture():
     return MixtureOfGaussians(dev_amp, np.zeros((dev_amp.size, 2)), dev_var)
 
-class MixtureOfGaussians():
+class MixtureOfGaussians(object):
+
+    # These are created for every source, image and derivative step
+    # on the rendering path, so keep them light.
+    __slots__ = ('amp', 'mean', 'var', 'K', 'D')
 
     # symmetrize is an unnecessary step in principle, but in practice?
     def __init__(self, amp, mean, var):
@@ -51,6 +55,30 @@ class MixtureOfGaussians():
         self.symmetrize()
         #self.test()
 
+    @staticmethod
+    def trusted(amp, mean, var):
+        '''
+        Creates a mixture directly from float arrays of shapes (K,),
+        (K,D) and (K,D,D), with symmetric variances, without copying,
+        converting or symmetrizing them.
+        '''
+        mix = MixtureOfGaussians.__new__(MixtureOfGaussians)
+        mix.amp = amp
+        mix.mean = mean
+        mix.var = var
+        (mix.K, mix.D) = mean.shape
+        return mix
+
+    def __getstate__(self):
+        return (self.amp, self.mean, self.var)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled before __slots__
+            state = (state['amp'], state['mean'], state['var'])
+        (self.amp, self.mean, self.var) = state
+        (self.K, self.D) = self.mean.shape
+
     def __str__(self):
         result = "MixtureOfGaussians instance"
         result += " with %d components in %d dimensions:\n" % (self.K, self.D)
@@ -60,19 +88,18 @@ class MixtureOfGaussians():
         return result
 
     def set_var(self, var):
+        var = np.asarray(var)
         if var.size == self.K:
             self.var = np.zeros((self.K, self.D, self.D))
-            for d in range(self.D):
-                self.var[:,d,d] = var
+            d = np.arange(self.D)
+            self.var[:,d,d] = var.reshape((self.K, 1))
         else:
-            self.var = np.array(var).astype(float)
+            self.var = var.astype(float)
 
     def symmetrize(self):
-        for i in range(self.D):
-            for j in range(i):
-                tmpij = 0.5 * (self.var[:,i,j] + self.var[:,j,i])
-                self.var[:,i,j] = tmpij
-                self.var[:,j,i] = tmpij
+        # (in place)
+        self.var += np.swapaxes(self.var, 1, 2).copy()
+        self.var *= 0.5
 
     # very harsh testing, and expensive
     def test(self):
@@ -85,7 +112,8 @@ class MixtureOfGaussians():
             assert(np.linalg.det(thisvar) >= 0.)
 
     def copy(self):
-        return MixtureOfGaussians(self.amp, self.mean, self.var)
+        return MixtureOfGaussians.trusted(self.amp.copy(), self.mean.copy(),
+                                          self.var.copy())
 
     def normalize(self):
         self.amp /= np.sum(self.amp)
@@ -110,7 +138,7 @@ class MixtureOfGaussians():
         assert(amp.shape  == (K,))
         assert(mean.shape == (K, D))
         assert(var.shape  == (K, D, D))
-        s = MixtureOfGaussians(amp, mean, var)
+        s = MixtureOfGaussians.trusted(amp, mean, var)
         s.normalize()
         return s
         
@@ -122,27 +150,26 @@ class MixtureOfGaussians():
         assert(shift.shape == (self.D,))
         assert(scale.shape == (self.D, self.D))
         newmean = self.mean + shift
-        newvar = np.zeros_like(self.var)
-        for k in range(self.K):
-            newvar[k,:,:] = np.dot(scale.T, np.dot(self.var[k,:,:], scale))
-        return MixtureOfGaussians(self.amp.copy(), newmean, newvar)
+        # scale^T var_k scale, for all k
+        newvar = np.einsum('ji,kjm->kim', scale, np.dot(self.var, scale))
+        mix = MixtureOfGaussians.trusted(self.amp.copy(), newmean, newvar)
+        mix.symmetrize()
+        return mix
 
     # dstn: should this be called "correlate"?
     def convolve(self, other):
+        '''
+        Returns the (K * other.K)-component mixture, ordered by
+        component of *other*, then component of self.
+        '''
         assert(self.D == other.D)
-        newK = self.K * other.K
         D = self.D
-        newamp = np.zeros((newK))
-        newmean = np.zeros((newK, D))
-        newvar = np.zeros((newK, D, D))
-        newk = 0
-        for k in range(other.K):
-            nextnewk = newk + self.K
-            newamp[newk:nextnewk] = self.amp * other.amp[k]
-            newmean[newk:nextnewk,:] = self.mean + other.mean[k]
-            newvar[newk:nextnewk,:,:] = self.var + other.var[k]
-            newk = nextnewk
-        return MixtureOfGaussians(newamp, newmean, newvar)
+        newamp = (other.amp[:,np.newaxis] * self.amp[np.newaxis,:]).ravel()
+        newmean = (other.mean[:,np.newaxis,:] +
+                   self.mean[np.newaxis,:,:]).reshape((-1, D))
+        newvar = (other.var[:,np.newaxis,:,:] +
+                  self.var[np.newaxis,:,:,:]).reshape((-1, D, D))
+        return MixtureOfGaussians.trusted(newamp, newmean, newvar)
 
     def getFourierTransform(self, v, w, use_mp_fourier=True):
         '''
@@ -185,6 +212,47 @@ class MixtureOfGaussians():
 
         return Fsum        
     
+    def getFourierTransformDerivatives(self, v, w, dvars,
+                                       use_mp_fourier=True):
+        '''
+        Like getFourierTransform, but also computes the derivatives of
+        the transform with respect to a set of P parameters, given
+        the derivatives of the component variances.
+
+        dvars: list of P arrays of shape (K,D,D)
+
+        Returns an array of shape (1+P, len(w), len(v)): the transform,
+        followed by its P derivatives.
+        '''
+        dvars = np.array(dvars).reshape((-1, self.K, self.D, self.D))
+        P = len(dvars)
+        # (d var_xx, d var_xy, d var_yy)
+        dv = np.zeros((P, self.K, 3))
+        dv[:,:,0] = dvars[:,:,0,0]
+        dv[:,:,1] = 0.5 * (dvars[:,:,0,1] + dvars[:,:,1,0])
+        dv[:,:,2] = dvars[:,:,1,1]
+        if mp_fourier and use_mp_fourier:
+            return mp_fourier.mixture_profile_fourier_transform_derivs(
+                self.amp, self.mean, self.var, dv, v, w)
+
+        vv = v[np.newaxis,:]
+        ww = w[:,np.newaxis]
+        F = np.zeros((1+P, len(w), len(v)), complex)
+        for k in range(self.K):
+            a = self.var[k, 0, 0]
+            b = self.var[k, 0, 1]
+            d = self.var[k, 1, 1]
+            Fk = self.amp[k] * np.exp(-2. * np.pi**2 *
+                                      (a * vv**2 + d * ww**2 + 2*b*vv*ww))
+            F[0] += Fk
+            for p in range(P):
+                F[1+p] += (-2. * np.pi**2 * Fk *
+                           (dv[p,k,0] * vv**2 + dv[p,k,2] * ww**2 +
+                            2 * dv[p,k,1] * vv * ww))
+        mu = self.mean[0,:]
+        F *= np.exp(-2.*np.pi* 1j *(mu[0]*vv + mu[1]*ww))
+        return F
+    
     # ideally pos is a numpy array shape (N, self.D)
     # returns a numpy array shape (N)
     # may fail for self.D == 1
@@ -231,14 +299,25 @@ class MixtureOfGaussians():
             raise RuntimeError('c_gauss_2d failed')
         return result
 
-    def evaluate_grid_dstn(self, x0, x1, y0, y1, cx, cy):
+    def evaluate_grid_dstn(self, x0, x1, y0, y1, cx, cy, precision='double'):
         '''
         [x0,x1): (int) X values to evaluate
         [y0,y1): (int) Y values to evaluate
         (cx,cy): (float) pixel center of the MoG
+        precision: 'double', or 'single' to use the (vectorized)
+            float32 kernel; see Image.modelPrecision.
         '''
         from mix import c_gauss_2d_grid
         assert(self.D == 2)
+        if _single_precision(precision):
+            from mix import c_gauss_2d_grid_f
+            result = np.zeros((y1-y0, x1-x0), np.float32)
+            amp,mean,var,cx,cy = self._float32_args(cx, cy)
+            rtn = c_gauss_2d_grid_f(int(x0), int(x1), int(y0), int(y1),
+                                    cx, cy, amp, mean, var, result)
+            if rtn == -1:
+                raise RuntimeError('c_gauss_2d_grid_f failed')
+            return Patch(x0, y0, result)
         result = np.zeros((y1-y0, x1-x0))
         rtn = c_gauss_2d_grid(int(x0), int(x1), int(y0), int(y1), cx, cy,
                               self.amp, self.mean,self.var, result)
@@ -267,9 +346,13 @@ class MixtureOfGaussians():
         return result
 
     def evaluate_grid_masked(self, x0, y0, mask, fx, fy,
-                             derivs=False):
+                             derivs=False, precision='double'):
         '''
         mask: np array of booleans (NOT Patch object!)
+
+        precision: 'single' to use the vectorized float32 kernel (with
+            a fast exp approximation).  (The results are float32
+            either way.)
         '''
         from mix import c_gauss_2d_masked
 
@@ -280,6 +363,19 @@ class MixtureOfGaussians():
             xderiv = np.zeros_like(result)
             yderiv = np.zeros_like(result)
 
+        if _single_precision(precision):
+            from mix import c_gauss_2d_masked_f
+            amp,mean,var,fx,fy = self._float32_args(fx, fy)
+            rtn = c_gauss_2d_masked_f(int(x0), int(y0), int(w), int(h),
+                                      fx, fy, amp, mean, var,
+                                      result, xderiv, yderiv, mask)
+            if rtn == -1:
+                raise RuntimeError('c_gauss_2d_masked_f failed')
+            if derivs:
+                return (Patch(x0,y0,result), Patch(x0,y0,xderiv),
+                        Patch(x0,y0,yderiv))
+            return Patch(x0,y0,result)
+
         # print('gauss_2d_masked:', int(x0), int(y0), int(w), int (h), float(fx), float(fy),)
         # print('  ', self.amp.astype(np.float32),)
         # print('  ', self.mean.astype(np.float32),)
@@ -305,11 +401,118 @@ class MixtureOfGaussians():
             return (Patch(x0,y0,result), Patch(x0,y0,xderiv),
                     Patch(x0,y0,yderiv))
         return Patch(x0,y0,result)
-        
+
+    def evaluate_grid_param_derivs(self, x0, x1, y0, y1, fx, fy, dparams,
+                                   mask=None, minval=0., value=True):
+        '''
+        Evaluates the mixture and its derivatives with respect to a set
+        of P parameters, in a single pass.
+
+        [x0,x1): (int) X values to evaluate
+        [y0,y1): (int) Y values to evaluate
+        (fx,fy): (float) pixel offset of the MoG
+        dparams: array of shape (P, K, 6): the derivatives of each
+            component's (mean_x, mean_y, var_xx, var_xy, var_yy, amp)
+            with respect to each parameter.
+        mask: if not None, np array of booleans, shape (y1-y0, x1-x0):
+            which pixels to evaluate.
+        minval: small value at which to stop evaluating each
+            component, as in evaluate_grid_approx3; if zero (or None), the
+            evaluate_grid cut is used.
+        value: if False, the mixture itself is not computed, and None
+            is returned in its place.
+
+        Returns (Patch, [Patch, ...]): the mixture, and its P
+        derivatives.
+        '''
+        from mix import c_gauss_2d_param_derivs
+        h,w = y1-y0, x1-x0
+        dparams = np.asarray(dparams, dtype=float)
+        P = dparams.shape[0]
+        assert(dparams.shape == (P, self.K, 6))
+        result = None
+        if value:
+            result = np.zeros((h,w))
+        derivs = np.zeros((P,h,w))
+        if minval is None:
+            minval = 0.
+        rtn = c_gauss_2d_param_derivs(int(x0), int(y0), int(w), int(h),
+                                      float(fx), float(fy), float(minval),
+                                      self.amp, self.mean, self.var,
+                                      dparams, result, derivs, mask)
+        if rtn == -1:
+            raise RuntimeError('c_gauss_2d_param_derivs failed')
+        if result is not None:
+            result = Patch(x0,y0,result)
+        return (result, [Patch(x0,y0,d) for d in derivs])
+
+    @staticmethod
+    def evaluate_grid_batch(mixtures, offsets, extents, minvals=None,
+                            scales=None, result=None):
+        '''
+        Evaluates many mixtures in a single call into the C extension.
+
+        mixtures: list of N MixtureOfGaussians
+        offsets: N (fx,fy) pixel offsets of the mixtures
+        extents: N [x0,x1,y0,y1] integer boxes [x0,x1), [y0,y1) to
+            evaluate
+        minvals: if not None, N small values at which to stop
+            evaluating each mixture's components (in the units of the
+            scaled mixture; see evaluate_grid_approx3)
+        scales: if not None, N factors to multiply the amplitudes by
+            (eg, source counts)
+        result: if not None, a 2-D float64 array into which all the
+            mixtures are *added*, with the extents clipped to it.
+            This is returned.
+
+        Otherwise, returns a list of N Patches, each covering its
+        full extent.
+        '''
+        from mix import c_gauss_2d_batch
+        N = len(mixtures)
+        koff = np.zeros(N+1, np.int32)
+        koff[1:] = np.cumsum([m.K for m in mixtures])
+        if N:
+            amp = np.concatenate([m.amp for m in mixtures])
+            mean = np.concatenate([m.mean for m in mixtures])
+            var = np.concatenate([m.var for m in mixtures])
+        else:
+            amp,mean,var = np.zeros(0), np.zeros((0,2)), np.zeros((0,2,2))
+        if scales is not None:
+            amp *= np.repeat(np.asarray(scales, float), np.diff(koff))
+        offsets = np.asarray(offsets, float).reshape((N,2))
+        bbox = np.asarray(extents, np.int32).reshape((N,4))
+        if minvals is None:
+            minvals = np.zeros(N)
+        minvals = np.asarray(minvals, float).reshape(N)
+
+        if result is not None:
+            rtn = c_gauss_2d_batch(amp, mean, var, koff, offsets, bbox,
+                                   minvals, result, None, None)
+            if rtn == -1:
+                raise RuntimeError('c_gauss_2d_batch failed')
+            return result
+
+        sizes = (np.maximum(bbox[:,1] - bbox[:,0], 0) *
+                 np.maximum(bbox[:,3] - bbox[:,2], 0))
+        poff = np.zeros(N+1, np.int32)
+        poff[1:] = np.cumsum(sizes)
+        packed = np.zeros(poff[-1])
+        rtn = c_gauss_2d_batch(amp, mean, var, koff, offsets, bbox,
+                               minvals, None, packed, poff[:-1])
+        if rtn == -1:
+            raise RuntimeError('c_gauss_2d_batch failed')
+        patches = []
+        for (x0,x1,y0,y1),p0,p1 in zip(bbox, poff[:-1], poff[1:]):
+            h,w = max(y1-y0, 0), max(x1-x0, 0)
+            patches.append(Patch(int(x0), int(y0),
+                                 packed[p0:p1].reshape((h,w))))
+        return patches
+
 
     def evaluate_grid_approx3(self, x0, x1, y0, y1, fx, fy, minval,
                               derivs=False, minradius=3, doslice=True,
-                              maxmargin=100):
+                              maxmargin=100, precision='double'):
         '''
         minval: small value at which to stop evaluating
 
@@ -320,20 +523,22 @@ class MixtureOfGaussians():
 
         'maxmargin': don't render sources more than this distance outside the box.
 
+        Each component is evaluated only within the ellipse where it
+        is above its share of 'minval' (minval * amp_k / sum(amp)),
+        plus within 'minradius' pixels of its center.
+
         If 'doslice' is True, slices the images down to the non-zero
-        bounding-box.
+        bounding-box.  (Only the union of the components' bounding
+        boxes is allocated.)
 
         If 'derivs' is True, computes and returns x and y derivatives too.
+
+        If 'precision' is 'single', uses the vectorized float32 kernel,
+        and returns float32 Patches.
         
         Unlike evaluate_grid_approx, returns a Patch object.
         '''
-        from mix import c_gauss_2d_approx3
-
-        result = np.zeros((y1-y0, x1-x0))
-        xderiv = yderiv = mask = None
-        if derivs:
-            xderiv = np.zeros_like(result)
-            yderiv = np.zeros_like(result)
+        from mix import c_gauss_2d_approx3, c_gauss_2d_approx3_extent
 
         # guess:
         cx = int(self.mean[0,0] + fx)
@@ -343,11 +548,35 @@ class MixtureOfGaussians():
             cy < y0 - maxmargin or cy > y1 + maxmargin):
             return None
 
+        if doslice:
+            rtn,sx0,sx1,sy0,sy1 = c_gauss_2d_approx3_extent(
+                int(x0), int(x1), int(y0), int(y1),
+                float(fx), float(fy), float(minval),
+                self.amp, self.mean, self.var, cx, cy, int(minradius))
+            if rtn == -1:
+                raise RuntimeError('c_gauss_2d_approx3_extent failed')
+            x0,x1,y0,y1 = x0 + sx0, x0 + sx1, y0 + sy0, y0 + sy1
+
+        single = _single_precision(precision)
+        if single:
+            from mix import c_gauss_2d_approx3_f as c_gauss_2d_approx3
+            result = np.zeros((y1-y0, x1-x0), np.float32)
+        else:
+            result = np.zeros((y1-y0, x1-x0))
+        xderiv = yderiv = mask = None
+        if derivs:
+            xderiv = np.zeros_like(result)
+            yderiv = np.zeros_like(result)
+
+        amp,mean,var = self.amp, self.mean, self.var
+        if single:
+            amp,mean,var,fx,fy = self._float32_args(fx, fy)
+
         try:
             rtn,sx0,sx1,sy0,sy1 = c_gauss_2d_approx3(
                 int(x0), int(x1), int(y0), int(y1),
                 float(fx), float(fy), float(minval),
-                self.amp, self.mean, self.var,
+                amp, mean, var,
                 result, xderiv, yderiv, mask,
                 cx, cy, int(minradius))
         except:
@@ -360,7 +589,7 @@ class MixtureOfGaussians():
             print('-->', cx, cy, int(minradius))
             raise
         assert(rtn == 0)
-        if doslice:
+        if doslice and (sx0,sx1,sy0,sy1) != (0, x1-x0, 0, y1-y0):
             slc = slice(sy0,sy1),slice(sx0,sx1)
             result = result[slc].copy()
             if derivs:
@@ -375,6 +604,134 @@ class MixtureOfGaussians():
 
         return Patch(x0,y0,result)
     
+    def evaluate_grid_multires(self, x0, x1, y0, y1, fx, fy, minval,
+                               maxstep=8, doslice=True, precision='double'):
+        '''
+        Evaluates the mixture like evaluate_grid_approx3, but renders
+        smooth, wide components on subsampled grids and bilinearly
+        interpolates them up to full resolution.
+
+        Component k is rendered with the largest power-of-two step s
+        <= *maxstep* for which the interpolation error, bounded by
+        s**2/8 * peak_k * trace(var_k^-1), is at most its share of
+        *minval*, minval * amp_k / sum(amp) (so the total is at most
+        *minval*, on top of the truncation at *minval*).  The components with s = 1
+        are rendered at full resolution, each within its own
+        truncation radius (at its share of *minval*).  With minval =
+        0, this is just evaluate_grid.
+
+        [x0,x1): (int) X values to evaluate
+        [y0,y1): (int) Y values to evaluate
+        (fx,fy): (float) pixel offset of the MoG
+
+        Returns a Patch, sliced to the union of the rendered regions
+        if *doslice*, else covering [x0,x1), [y0,y1).
+        '''
+        if not minval:
+            return self.evaluate_grid(x0, x1, y0, y1, fx, fy,
+                                      precision=precision)
+        steps = self._multires_steps(minval, maxstep)
+        dtype = np.float32 if _single_precision(precision) else float
+        ampsum = np.sum(np.abs(self.amp))
+
+        patches = []
+        I = np.flatnonzero(steps == 1)
+        if len(I):
+            # (evaluate_grid_approx3 truncates each component at its
+            # share of the minval it is given)
+            sub = MixtureOfGaussians.trusted(self.amp[I], self.mean[I],
+                                             self.var[I])
+            p = sub.evaluate_grid_approx3(
+                x0, x1, y0, y1, fx, fy,
+                minval * np.sum(np.abs(self.amp[I])) / ampsum,
+                precision=precision)
+            if p is not None and p.patch.size:
+                patches.append(p)
+
+        # The wide components with step s are rendered on a grid with
+        # points at x0, x0+s, ..., past x1-1 (in whose coordinates
+        # they shrink by s), into which the next-coarser grid is
+        # interpolated; and so on down to full resolution.  (The grids
+        # are nested, so this is the same as interpolating each step's
+        # grid separately.)
+        coarse = None
+        # full-resolution extent of the non-zero coarse pixels
+        ext = None
+        s = steps.max()
+        while s > 1:
+            nx = (x1 - x0 - 1) // s + 2
+            ny = (y1 - y0 - 1) // s + 2
+            if coarse is not None:
+                coarse = _upsample2(coarse)[:ny, :nx]
+            I = np.flatnonzero(steps == s)
+            if len(I):
+                sub = MixtureOfGaussians.trusted(
+                    self.amp[I] / s**2,
+                    (self.mean[I] + np.array([fx - x0, fy - y0])) / s,
+                    self.var[I] / s**2)
+                c = sub.evaluate_grid_approx3(0, nx, 0, ny, 0., 0., minval,
+                                              precision=precision)
+                if c is not None and c.patch.size:
+                    if coarse is None:
+                        coarse = np.zeros((ny, nx), dtype)
+                    c.addTo(coarse)
+                    # (including the ramps down to the neighboring
+                    # zero pixels)
+                    e = [x0 + (c.x0 - 1) * s + 1, x0 + c.x1 * s,
+                         y0 + (c.y0 - 1) * s + 1, y0 + c.y1 * s]
+                    if ext is None:
+                        ext = e
+                    else:
+                        ext = [min(ext[0], e[0]), max(ext[1], e[1]),
+                               min(ext[2], e[2]), max(ext[3], e[3])]
+            s //= 2
+        if coarse is not None:
+            p = Patch(x0, y0, _upsample2(coarse)[:y1-y0, :x1-x0])
+            if p.clipToRoi(*ext):
+                patches.append(p)
+
+        if doslice:
+            if len(patches) == 0:
+                return Patch(x0, y0, np.zeros((0,0), dtype))
+            x0 = min([p.x0 for p in patches])
+            x1 = max([p.x1 for p in patches])
+            y0 = min([p.y0 for p in patches])
+            y1 = max([p.y1 for p in patches])
+        result = np.zeros((y1-y0, x1-x0), dtype)
+        for p in patches:
+            Patch(p.x0 - x0, p.y0 - y0, p.patch).addTo(result)
+        return Patch(x0, y0, result)
+
+    def _multires_steps(self, minval, maxstep):
+        '''
+        Returns the subsampling step for each component; see
+        evaluate_grid_multires.
+        '''
+        V = self.var
+        det = V[:,0,0] * V[:,1,1] - V[:,0,1] * V[:,1,0]
+        with np.errstate(all='ignore'):
+            # peak_k = amp_k / (2 pi sqrt(det_k))
+            # trace(var_k^-1) = (V_xx + V_yy) / det_k
+            smax = np.sqrt(8. * minval / np.sum(np.abs(self.amp)) *
+                           2. * np.pi * np.sqrt(det) * det /
+                           (V[:,0,0] + V[:,1,1]))
+            smax[np.logical_not(np.isfinite(smax) * (det > 0))] = 1.
+            steps = 2 ** np.floor(np.log2(np.clip(smax, 1., maxstep)))
+        return steps.astype(int)
+
+    def _float32_args(self, fx, fy):
+        '''
+        Returns (amp, mean, var, fx, fy) for the float32 kernels: the
+        means are shifted by an integer number of pixels (added to
+        the offsets, which stay in double precision), so that they
+        stay precise in float32.
+        '''
+        c = np.round(self.mean[0])
+        return (self.amp.astype(np.float32),
+                (self.mean - c).astype(np.float32),
+                self.var.astype(np.float32),
+                float(fx + c[0]), float(fy + c[1]))
+
     def evaluate_grid_hogg(self, xlo, xhi, ylo, yhi):
         assert(self.D == 2)
         xy = np.array(np.meshgrid(range(xlo, xhi), range(ylo, yhi)))
@@ -386,18 +743,55 @@ class MixtureOfGaussians():
     evaluate = evaluate_2
     evaluate_grid = evaluate_grid_dstn
 
-def mixture_to_patch(mixture, x0, x1, y0, y1, minval=0., exactExtent=False):
+def _single_precision(precision):
+    '''
+    Returns True for *precision* 'single', False for 'double'.
+    '''
+    if precision == 'single':
+        return True
+    if precision == 'double':
+        return False
+    raise ValueError('precision must be "single" or "double", not "%s"' %
+                     str(precision))
+
+def _upsample2(a):
+    '''
+    Linearly interpolates 2-d array *a* onto a grid twice as fine:
+    (h,w) samples become (2h-1, 2w-1).
+    '''
+    h,w = a.shape
+    r = np.empty((2*h-1, w), a.dtype)
+    r[::2] = a
+    r[1::2] = 0.5 * (a[:-1] + a[1:])
+    out = np.empty((2*h-1, 2*w-1), a.dtype)
+    out[:, ::2] = r
+    out[:, 1::2] = 0.5 * (r[:, :-1] + r[:, 1:])
+    return out
+
+def mixture_to_patch(mixture, x0, x1, y0, y1, minval=0., exactExtent=False,
+                     precision='double', maxstep=1):
     '''
     `mixture`: a MixtureOfGaussians
     `x0,x1,y0,y1`: integer bounds [x0,x1), [y0,y1) of the grid to evaluate
+    `precision`: 'double' or 'single'; see Image.modelPrecision
+    `maxstep`: if > 1, render wide components on subsampled grids; see
+    MixtureOfGaussians.evaluate_grid_multires and Image.modelMaxStep
 
     Returns: a Patch object
     '''
     if minval == 0. or minval is None:
-        return mixture.evaluate_grid(x0, x1, y0, y1, 0., 0.)
+        return mixture.evaluate_grid(x0, x1, y0, y1, 0., 0.,
+                                     precision=precision)
+
+    if maxstep > 1:
+        return mixture.evaluate_grid_multires(x0, x1, y0, y1, 0., 0., minval,
+                                              maxstep=maxstep,
+                                              doslice=not(exactExtent),
+                                              precision=precision)
 
     p = mixture.evaluate_grid_approx3(x0, x1, y0, y1, 0., 0., minval,
-                                      doslice=not(exactExtent))
+                                      doslice=not(exactExtent),
+                                      precision=precision)
     #print('mixture_to_patch: got extent', [x0,x1,y0,y1], 'returning extent', p.getExtent())
     return p
     
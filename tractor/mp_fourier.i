@@ -5,6 +5,14 @@
 #include <numpy/arrayobject.h>
 #include <math.h>
 #include <assert.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+// The transforms release the GIL while they run, and above this many
+// (frequency, component) evaluations, split their rows across OpenMP
+// threads (when built with OpenMP).
+#define OMP_MIN_EVALS 100000
     %}
 
 %init %{
@@ -109,8 +117,10 @@ static PyObject* mixture_profile_fourier_transform(
 
     double mu0 = means[0];
     double mu1 = means[1];
-    double* ff = f;
+    Py_BEGIN_ALLOW_THREADS
+    #pragma omp parallel for private(i, k) if ((long)NV * NW * K > OMP_MIN_EVALS)
     for (j=0; j<NW; j++) {
+        double* ff = f + 2*j*NV;
         for (i=0; i<NV; i++) {
             double s = 0;
             double* V = vars;
@@ -137,6 +147,158 @@ static PyObject* mixture_profile_fourier_transform(
             ff++;
         }
     }
+    Py_END_ALLOW_THREADS
+    return np_F;
+}
+
+static PyObject* mixture_profile_fourier_transform_derivs(
+    PyObject* np_amps,
+    PyObject* np_means,
+    PyObject* np_vars,
+    PyObject* np_dvars,
+    PyObject* np_v,
+    PyObject* np_w
+    ) {
+    // Like mixture_profile_fourier_transform, but also computes the
+    // derivatives of the transform with respect to P parameters,
+    // given the derivatives of the component variances:
+    //
+    //   np_dvars: P x K x 3: (d var_xx, d var_xy, d var_yy)
+    //
+    // Returns a (1+P) x NW x NV array: the transform, followed by its
+    // derivatives.
+
+    npy_intp K, P, NW,NV;
+    const npy_intp D = 2;
+    npy_intp i,j,k,p;
+    double* amps, *means, *vars, *dvars, *vv, *ww;
+    PyObject* np_F;
+    double* f;
+    npy_intp dims[3];
+
+    if (!PyArray_Check(np_amps) || !PyArray_Check(np_means) ||
+        !PyArray_Check(np_vars) || !PyArray_Check(np_dvars) ||
+        !PyArray_Check(np_v) || !PyArray_Check(np_w)) {
+        PyErr_SetString(PyExc_ValueError, "Expected numpy arrays");
+        return NULL;
+    }
+
+    if ((PyArray_TYPE(np_amps) != NPY_DOUBLE) ||
+        (PyArray_TYPE(np_means ) != NPY_DOUBLE) ||
+        (PyArray_TYPE(np_vars) != NPY_DOUBLE) ||
+        (PyArray_TYPE(np_dvars) != NPY_DOUBLE) ||
+        (PyArray_TYPE(np_v)    != NPY_DOUBLE) ||
+        (PyArray_TYPE(np_w)    != NPY_DOUBLE)) {
+        PyErr_SetString(PyExc_ValueError, "Expected numpy double arrays");
+        return NULL;
+    }
+    if (!PyArray_ISCARRAY_RO(np_amps) || !PyArray_ISCARRAY_RO(np_means) ||
+        !PyArray_ISCARRAY_RO(np_vars) || !PyArray_ISCARRAY_RO(np_dvars) ||
+        !PyArray_ISCARRAY_RO(np_v) || !PyArray_ISCARRAY_RO(np_w)) {
+        PyErr_SetString(PyExc_ValueError, "Expected contiguous arrays");
+        return NULL;
+    }
+
+    if (PyArray_NDIM(np_amps) != 1) {
+        PyErr_SetString(PyExc_ValueError, "Expected 'amps' to be 1-d");
+        return NULL;
+    }
+    K = PyArray_DIM(np_amps, 0);
+    if ((PyArray_NDIM(np_means) != 2) ||
+        (PyArray_DIM(np_means, 0) != K) ||
+        (PyArray_DIM(np_means, 1) != D)) {
+        PyErr_SetString(PyExc_ValueError, "Expected 'means' to be K x D");
+        return NULL;
+    }
+    if ((PyArray_NDIM(np_vars) != 3) ||
+        (PyArray_DIM(np_vars, 0) != K) ||
+        (PyArray_DIM(np_vars, 1) != D) ||
+        (PyArray_DIM(np_vars, 2) != D)) {
+        PyErr_SetString(PyExc_ValueError, "Expected 'vars' to be K x D x D");
+        return NULL;
+    }
+    if ((PyArray_NDIM(np_dvars) != 3) ||
+        (PyArray_DIM(np_dvars, 1) != K) ||
+        (PyArray_DIM(np_dvars, 2) != 3)) {
+        PyErr_SetString(PyExc_ValueError, "Expected 'dvars' to be P x K x 3");
+        return NULL;
+    }
+    P = PyArray_DIM(np_dvars, 0);
+    if ((PyArray_NDIM(np_v) != 1) || (PyArray_NDIM(np_w) != 1)) {
+        PyErr_SetString(PyExc_ValueError, "Expected 'v' and 'w' to be 1-d");
+        return NULL;
+    }
+
+    amps = PyArray_DATA(np_amps);
+    means = PyArray_DATA(np_means);
+    vars = PyArray_DATA(np_vars);
+    dvars = PyArray_DATA(np_dvars);
+    vv = PyArray_DATA(np_v);
+    ww = PyArray_DATA(np_w);
+
+    for (k=0; k<K; k++) {
+        if ((means[k*D] != means[0]) ||
+            (means[k*D+1] != means[1])) {
+            PyErr_SetString(PyExc_ValueError, "Assume all means are equal");
+            return NULL;
+        }
+    }
+
+    NV = PyArray_DIM(np_v, 0);
+    NW = PyArray_DIM(np_w, 0);
+    dims[0] = 1+P;
+    dims[1] = NW;
+    dims[2] = NV;
+    np_F = PyArray_SimpleNew(3, dims, NPY_COMPLEX128);
+    f = PyArray_DATA(np_F);
+
+    {
+        double mu0 = means[0];
+        double mu1 = means[1];
+        double twopisquare = -2. * M_PI * M_PI;
+        const npy_intp NP = NV*NW;
+        Py_BEGIN_ALLOW_THREADS
+        #pragma omp parallel for private(i, k, p) if ((long)NV * NW * K * (1+P) > OMP_MIN_EVALS)
+        for (j=0; j<NW; j++) {
+            double* ff = f + 2*j*NV;
+            double sd[P];
+            for (i=0; i<NV; i++) {
+                double s = 0;
+                double* V = vars;
+                double vsq  = vv[i]*vv[i];
+                double vw2  = 2.*vv[i]*ww[j];
+                double wsq  = ww[j]*ww[j];
+                double angle, c, sn;
+                for (p=0; p<P; p++)
+                    sd[p] = 0;
+                for (k=0; k<K; k++) {
+                    double a, b, d, e;
+                    a = V[0];
+                    b = V[1];
+                    // skip c
+                    d = V[3];
+                    V += 4;
+                    e = amps[k] * exp(twopisquare * (a*vsq + b*vw2 + d*wsq));
+                    s += e;
+                    for (p=0; p<P; p++) {
+                        double* dv = dvars + (p*K + k)*3;
+                        sd[p] += e * (dv[0]*vsq + dv[1]*vw2 + dv[2]*wsq);
+                    }
+                }
+                angle = -2. * M_PI * (mu0 * vv[i] + mu1 * ww[j]);
+                c = cos(angle);
+                sn = sin(angle);
+                ff[0] = s * c;
+                ff[1] = s * sn;
+                for (p=0; p<P; p++) {
+                    ff[2*NP*(p+1) + 0] = twopisquare * sd[p] * c;
+                    ff[2*NP*(p+1) + 1] = twopisquare * sd[p] * sn;
+                }
+                ff += 2;
+            }
+        }
+        Py_END_ALLOW_THREADS
+    }
     return np_F;
 }
 
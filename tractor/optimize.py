@@ -431,6 +431,63 @@ class Optimizer(object):
         tractor.setParams(pa)
         return pBest - pBefore, alphaBest
 
+    def tryUpdatesLinearized(self, tractor, X, pred, alphas=None,
+                             lnp0=None):
+        '''
+        Line search along the update direction *X*, guided by the
+        linearized model: *pred* = (c1, c2), such that a step of
+        alpha*X is predicted to change the log-prob by
+        alpha*c1 - alpha**2 * c2 / 2.
+
+        The step the model predicts to be best, c1/c2 (within the
+        range of *alphas*), is evaluated first.  If it does not
+        improve the log-prob, we jump to the peak of the quadratic
+        through the two known values and the slope at zero, rather
+        than walking down a ladder of steps.
+
+        *lnp0*, if given, is the current log-prob (saving one
+        evaluation).
+
+        Returns (delta-logprob, alpha), like tryUpdates().
+        '''
+        c1,c2 = pred
+        if not (np.isfinite(c1) and np.isfinite(c2) and c1 > 0 and c2 > 0):
+            return self.tryUpdates(tractor, X, alphas=alphas)
+        if alphas is None:
+            # 1/1024 to 1 in factors of 2, + sqrt(2.) + 2.
+            alphas = np.append(2.**np.arange(-10, 1), [np.sqrt(2.), 2.])
+        amin,amax = np.min(alphas), np.max(alphas)
+        alpha = min(max(c1 / c2, amin), amax)
+        logverb('  Predicted best step: alpha =', alpha, 'for delta-logprob',
+                alpha * c1 - 0.5 * alpha**2 * c2)
+
+        if lnp0 is None:
+            lnp0 = tractor.getLogProb()
+        pBefore = lnp0
+        logverb('  log-prob before:', pBefore)
+        p0 = tractor.getParams()
+        nlnp = 0
+        while alpha >= amin:
+            tractor.setParams([p + alpha * d for p,d in zip(p0, X)])
+            dlnp = tractor.getLogProb() - pBefore
+            nlnp += 1
+            logverb('  alpha =', alpha, ': delta log-prob', dlnp,
+                    'predicted', alpha * c1 - 0.5 * alpha**2 * c2)
+            if dlnp > 0:
+                logverb('  Stepping by', alpha, 'for delta-logprob', dlnp,
+                        'after', nlnp, 'evaluations')
+                return dlnp, alpha
+            # The quadratic with slope c1 at zero and value dlnp at
+            # alpha peaks at c1 alpha^2 / (2 (c1 alpha - dlnp)), which
+            # is below alpha/2; don't shrink by more than 10x.
+            if np.isfinite(dlnp):
+                alpha = max(c1 * alpha**2 / (2. * (c1 * alpha - dlnp)),
+                            0.1 * alpha)
+            else:
+                alpha *= 0.1
+        tractor.setParams(p0)
+        return 0, 0.
+
     def _getims(self, fluxes, imgs, umodels, mod0, scales, sky, minFlux, rois):
         ims = []
         for i,(img,umods,m0,scale
@@ -54,6 +54,42 @@ class SingleProfileSource(BasicSource):
 
         return p
 
+    def getModelMixtures(self, img, minsb=None):
+        counts = img.getPhotoCal().brightnessToCounts(self.brightness)
+        if counts == 0 or not np.isfinite(np.float32(counts)):
+            return []
+        if minsb is None:
+            minsb = img.modelMinval
+        mixes = self._getUnitFluxMixtures(img, minsb / counts)
+        if mixes is None:
+            return None
+        return [(mix, offset, extent, counts, minsb)
+                for mix,offset,extent in mixes]
+
+    def _getUnitFluxMixtures(self, img, minval):
+        '''
+        Returns a list of (MixtureOfGaussians, (fx,fy), extent) that
+        render the unit-flux model (see getModelMixtures), or None.
+        '''
+        return None
+
+    def _getPixelDerivatives(self, img, px0, py0):
+        '''
+        Returns [(dpx,dpy), ...]: the derivatives of the pixel
+        position with respect to each position parameter.
+        '''
+        # The WCS is locally linear, so step in Position space to
+        # get d(pixel)/d(pos).
+        pos0 = self.getPosition()
+        wcs = img.getWcs()
+        params = pos0.getParams()
+        dpix = []
+        for i,pstep in enumerate(pos0.getStepSizes()):
+            oldval = pos0.setParam(i, params[i]+pstep)
+            (px,py) = wcs.positionToPixel(pos0, self)
+            pos0.setParam(i, oldval)
+            dpix.append(((px - px0) / pstep, (py - py0) / pstep))
+        return dpix
 
 
 class PointSource(MultiParams, SingleProfileSource):
@@ -95,11 +131,33 @@ class PointSource(MultiParams, SingleProfileSource):
             r = psf.getRadius()
         if px + r < 0 or px - r > W or py + r < 0 or py - r > H:
             return None
+        kwargs = {}
+        # (only pass non-default precision, for PSFs that don't know it)
+        if img.modelPrecision != 'double':
+            kwargs.update(precision=img.modelPrecision)
         patch = psf.getPointSourcePatch(px, py, minval=minval, extent=[0,W,0,H],
                                         radius=self.fixedRadius, derivs=derivs,
-                                        minradius=self.minRadius, modelMask=modelMask)
+                                        minradius=self.minRadius, modelMask=modelMask,
+                                        **kwargs)
         return patch
 
+    def _getUnitFluxMixtures(self, img, minval):
+        psf = self._getPsf(img)
+        if not hasattr(psf, 'getPointSourcePatches') or self.minRadius is not None:
+            return None
+        (px,py) = img.getWcs().positionToPixel(self.getPosition(), self)
+        H,W = img.shape
+        r = self.fixedRadius
+        if r is None:
+            r = psf.getRadius()
+        if px + r < 0 or px - r > W or py + r < 0 or py - r > H:
+            return []
+        extent = psf._getPointSourceExtent(px, py, minval, [0,W,0,H],
+                                           self.fixedRadius)
+        if extent is None:
+            return []
+        return [(psf.getMixtureOfGaussians(), (px, py), extent)]
+
     def _getPsf(self, img):
         return img.getPsf()
 
@@ -168,13 +226,12 @@ class PointSource(MultiParams, SingleProfileSource):
 
                 # Convert x,y derivatives to Position derivatives
 
+                # (through the WCS's Jacobian: the Position parameters
+                # need not be in the units of its CD matrix)
                 px,py = wcs.positionToPixel(pos, self)
-                cd = wcs.cdAtPixel(px, py)
-                cdi = np.linalg.inv(cd)
-                # Get thawed Position parameter indices
-                thawed = pos.getThawedParamIndices()
-                for i,pname in zip(thawed, pos.getParamNames()):
-                    deriv = (patchdx * cdi[0,i] + patchdy * cdi[1,i]) * counts0
+                dpix = self._getPixelDerivatives(img, px, py)
+                for (dpx,dpy),pname in zip(dpix, pos.getParamNames()):
+                    deriv = (patchdx * dpx + patchdy * dpy) * counts0
                     deriv.setName('d(ptsrc)/d(pos.%s)' % pname)
                     derivs.append(deriv)
 
@@ -19,6 +19,59 @@ from . import ducks
 #     def getShifted(self, x0, y0):
 #         return self
 
+def _lanczos_derivative(L, x):
+    '''
+    Returns the derivative of the Lanczos-*L* filter
+    (astrometry.util.miscutils.lanczos_filter) at *x*.
+    '''
+    x = np.atleast_1d(x).astype(float)
+    d = np.zeros(len(x))
+    nz = np.logical_and(x != 0., np.abs(x) < L)
+    u = np.pi * x[nz]
+    su,cu = np.sin(u), np.cos(u)
+    sa,ca = np.sin(u / L), np.cos(u / L)
+    d[nz] = np.pi * L * ((cu * sa + su * ca / L) / u**2 - 2. * su * sa / u**3)
+    return d
+
+def _lanczos_kernel(L, dx, derivs=False):
+    '''
+    Returns the (2*L+1)-tap Lanczos-*L* kernel for a shift of *dx*
+    pixels, normalized to preserve flux.
+
+    If *derivs* is True, returns (kernel, d(kernel)/d(dx)).
+    '''
+    x = np.arange(-L, L+1) + dx
+    k = lanczos_filter(L, x)
+    ksum = k.sum()
+    if not derivs:
+        return k / ksum
+    k /= ksum
+    dk = _lanczos_derivative(L, x)
+    dk = (dk - k * dk.sum()) / ksum
+    return k, dk
+
+def _subpixel_kernel_error(L, nsub, nsample=16):
+    '''
+    Bounds the L1 difference between the bilinear blend of Lanczos
+    kernels tabulated at 1/*nsub*-pixel phases and the exact 2-D
+    (separable) kernel, evaluated on a grid of shifts *nsample* times
+    finer than the table.
+
+    Writing the blended kernels as K' = K + e, the 2-D difference
+    K'y K'x - Ky Kx = ey K'x + Ky ex, and K'x is a convex combination
+    of tabulated kernels, so |.|_1 <= 2 max|e|_1 max|K|_1.
+    '''
+    N = nsub * nsample
+    t = np.arange(N+1) / float(N) - 0.5
+    K = np.array([_lanczos_kernel(L, ti) for ti in t])
+    i = np.minimum(np.arange(N+1) // nsample, nsub-1)
+    u = (np.arange(N+1) - i * nsample) / float(nsample)
+    Kp = K[::nsample]
+    blend = (1.-u)[:,np.newaxis] * Kp[i] + u[:,np.newaxis] * Kp[i+1]
+    e = np.max(np.sum(np.abs(blend - K), axis=1))
+    k1 = np.max(np.sum(np.abs(K), axis=1))
+    return 2. * e * k1
+
 class PixelizedPSF(BaseParams, ducks.ImageCalibration):
     '''
     A PSF model based on an image postage stamp, which will be
@@ -46,10 +99,125 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
         self.H, self.W = H,W
         self.Lorder = Lorder
         self.fftcache = {}
-        
+        self.subpixel = 0
+        self.sublibrary = None
+
     def __str__(self):
         return 'PixelizedPSF'
 
+    # For pickling: the sub-pixel library is rebuilt on demand.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['sublibrary'] = None
+        return state
+
+    def setSubpixelLibrary(self, nsub=32, maxbytes=64*1024*1024):
+        '''
+        Makes getPointSourcePatch render by blending (bilinearly) the
+        four nearest of a library of PSF stamps Lanczos-shifted to a
+        grid of 1/*nsub*-pixel phases, instead of Lanczos-shifting the
+        PSF image on every call.
+
+        The stamps are computed as they are first needed and kept in
+        an LRU cache of at most *maxbytes*; call this again if the PSF
+        image is changed.  *nsub* = 0 turns the library off.
+
+        Returns the bound on the per-pixel error relative to the exact
+        Lanczos shift, in units of the largest absolute PSF pixel; see
+        `getSubpixelErrorBound`.
+        '''
+        self.subpixel = nsub
+        self.sublibrary = None
+        self.subpixelmaxbytes = maxbytes
+        if not nsub:
+            self.subpixelerror = 0.
+            return 0.
+        self.subpixelerror = _subpixel_kernel_error(self.Lorder, nsub)
+        return self.subpixelerror
+
+    def getSubpixelErrorBound(self, px=0., py=0.):
+        '''
+        Returns the largest absolute difference, per pixel, between a
+        point-source patch at (*px*,*py*) rendered from the sub-pixel
+        library and the exactly Lanczos-shifted one.  (Zero if the
+        library is off or cannot be used at this position.)
+        '''
+        if not getattr(self, 'subpixel', 0):
+            return 0.
+        weights = self._getSubpixelWeights(px, py)
+        if weights is None:
+            return 0.
+        bases = self._getSubpixelBases()
+        scale = np.sum(np.abs(weights) *
+                       np.max(np.abs(bases.reshape(len(bases), -1)), axis=1))
+        return self.subpixelerror * scale
+
+    def _getSubpixelBases(self):
+        '''
+        Returns the (N,H,W) stack of images that the sub-pixel library
+        shifts; the PSF at a position is their sum weighted by
+        `_getSubpixelWeights`.
+        '''
+        return self.img[np.newaxis,:,:]
+
+    def _getSubpixelWeights(self, px, py):
+        '''
+        Returns the weights of `_getSubpixelBases` at (*px*,*py*), or
+        None if the library cannot be used there.
+        '''
+        return np.ones(1)
+
+    def _getSubpixelPhase(self, i, j):
+        from scipy.ndimage.filters import correlate1d
+        from .cache import Cache
+
+        key = (i, j)
+        if self.sublibrary is not None:
+            stack = self.sublibrary.get(key, None)
+            if stack is not None:
+                return stack
+        bases = self._getSubpixelBases()
+        if self.sublibrary is None:
+            self.sublibrary = Cache(
+                maxsize=max(4, self.subpixelmaxbytes // bases.nbytes))
+        n = float(self.subpixel)
+        Lx = _lanczos_kernel(self.Lorder, i/n - 0.5)
+        Ly = _lanczos_kernel(self.Lorder, j/n - 0.5)
+        stack = np.array([correlate1d(correlate1d(b, Lx, axis=1, mode='constant'),
+                                      Ly, axis=0, mode='constant')
+                          for b in bases])
+        self.sublibrary.put(key, stack)
+        return stack
+
+    def _getSubpixelStamp(self, dx, dy, weights):
+        '''
+        Blends the library stamps bracketing the sub-pixel shift
+        (*dx*,*dy*), each in [-0.5, 0.5].
+        '''
+        n = self.subpixel
+        fx = (dx + 0.5) * n
+        fy = (dy + 0.5) * n
+        i = min(max(int(fx), 0), n-1)
+        j = min(max(int(fy), 0), n-1)
+        u = fx - i
+        v = fy - j
+        stamp = None
+        for ii,jj,c in [(i,   j,   (1.-u)*(1.-v)),
+                        (i+1, j,   u*(1.-v)),
+                        (i,   j+1, (1.-u)*v),
+                        (i+1, j+1, u*v)]:
+            if c == 0.:
+                continue
+            stack = self._getSubpixelPhase(ii, jj)
+            nb,H,W = stack.shape
+            s = np.dot(c * weights, stack.reshape((nb, H*W)))
+            if stamp is None:
+                stamp = s
+            else:
+                stamp += s
+        stamp = stamp.reshape((H,W))
+        return stamp
+
     def clear_cache(self):
         self.fftcache = {}
 
@@ -60,6 +228,10 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
     def hashkey(self):
         return ('PixelizedPSF', tuple(self.img.ravel()))
 
+    def versionkey(self):
+        # (the pixels are not Params)
+        return (id(self), self.getVersion(), id(self.img))
+
     def copy(self):
         return PixelizedPSF(self.img.copy())
 
@@ -77,13 +249,28 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
     def getImage(self, px, py):
         return self.img
 
-    def getPointSourcePatch(self, px, py, minval=0., modelMask=None, **kwargs):
+    def getPointSourcePatch(self, px, py, minval=0., modelMask=None,
+                            derivs=False, **kwargs):
+        '''
+        Returns a Patch of the PSF, Lanczos-shifted to center
+        (*px*,*py*), clipped or padded to *modelMask* if given.
+
+        If *derivs* is True, returns (patch, dpx, dpy), the patch and
+        its derivatives with respect to *px* and *py*, computed with
+        the derivative-of-Lanczos kernels.
+        '''
         from scipy.ndimage.filters import correlate1d
         from astrometry.util.miscutils import get_overlapping_region
 
-        img = self.getImage(px, py)
+        weights = None
+        if getattr(self, 'subpixel', 0) and not derivs:
+            weights = self._getSubpixelWeights(px, py)
+        if weights is None:
+            img = self.getImage(px, py)
+            H,W = img.shape
+        else:
+            H,W = self._getSubpixelBases().shape[1:]
 
-        H,W = img.shape
         ix = int(np.round(px))
         iy = int(np.round(py))
         dx = px - ix
@@ -108,18 +295,35 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
             # Otherwise, we'll just produce the Lanczos-shifted PSF image as usual,
             # and then copy it into the modelMask space.
 
-        L = self.Lorder
-        Lx = lanczos_filter(L, np.arange(-L, L+1) + dx)
-        Ly = lanczos_filter(L, np.arange(-L, L+1) + dy)
-        # Normalize the Lanczos interpolants (preserve flux)
-        Lx /= Lx.sum()
-        Ly /= Ly.sum()
-        sx      = correlate1d(img, Lx, axis=1, mode='constant')
-        shifted = correlate1d(sx,  Ly, axis=0, mode='constant')
+        if weights is not None:
+            shifted = self._getSubpixelStamp(dx, dy, weights)
+        elif derivs:
+            # The shifted image is img(x - dx, y - dy), so d/dpx = d/ddx.
+            Lx,dLx = _lanczos_kernel(self.Lorder, dx, derivs=True)
+            Ly,dLy = _lanczos_kernel(self.Lorder, dy, derivs=True)
+            sx      = correlate1d(img, Lx,  axis=1, mode='constant')
+            dsx     = correlate1d(img, dLx, axis=1, mode='constant')
+            shifted = correlate1d(sx,  Ly,  axis=0, mode='constant')
+            shiftdx = correlate1d(dsx, Ly,  axis=0, mode='constant')
+            shiftdy = correlate1d(sx,  dLy, axis=0, mode='constant')
+            return tuple([self._placePatch(p, x0, y0, modelMask)
+                          for p in [shifted, shiftdx, shiftdy]])
+        else:
+            # (the Lanczos interpolants are normalized to preserve flux)
+            Lx = _lanczos_kernel(self.Lorder, dx)
+            Ly = _lanczos_kernel(self.Lorder, dy)
+            sx      = correlate1d(img, Lx, axis=1, mode='constant')
+            shifted = correlate1d(sx,  Ly, axis=0, mode='constant')
+        return self._placePatch(shifted, x0, y0, modelMask)
+
+    def _placePatch(self, shifted, x0, y0, modelMask):
         if modelMask is None:
             return Patch(x0, y0, shifted)
 
         # Pad or clip to modelMask size
+        H,W = shifted.shape
+        mh,mw = modelMask.shape
+        mx0,my0 = modelMask.x0, modelMask.y0
         mm = np.zeros((mh,mw), shifted.dtype)
         yo = y0 - my0
         yi = 0
@@ -308,6 +512,7 @@ class GaussianMixturePSF(ParamList, ducks.ImageCalibration):
     def shiftBy(self, dx, dy):
         self.mog.mean[:,0] += dx
         self.mog.mean[:,1] += dy
+        self.bumpVersion()
     
     def computeRadius(self):
         import numpy.linalg
@@ -326,19 +531,48 @@ class GaussianMixturePSF(ParamList, ducks.ImageCalibration):
     # returns a Patch object.
     def getPointSourcePatch(self, px, py, minval=0., extent=None, radius=None,
                             derivs=False, minradius=None, modelMask=None,
-                            **kwargs):
+                            precision='double', **kwargs):
         '''
         extent = [x0,x1,y0,y1], clip to [x0,x1), [y0,y1).
+
+        precision: 'double' or 'single'; see Image.modelPrecision.
         '''
 
         if modelMask is not None:
             return self.mog.evaluate_grid_masked(modelMask.x0, modelMask.y0,
                                                  modelMask.patch, px, py,
-                                                 derivs=derivs, **kwargs)
+                                                 derivs=derivs,
+                                                 precision=precision, **kwargs)
 
         if minval is None:
             minval = 0.
         if minval > 0. or minradius is not None:
+            ext = self._getPointSourceExtent(px, py, minval, extent, radius)
+            if ext is None:
+                return None
+            x0,x1,y0,y1 = ext
+
+            kwa = {}
+            if minradius is not None:
+                kwa['minradius'] = minradius
+            
+            return self.mog.evaluate_grid_approx3(
+                x0, x1, y0, y1, px, py, minval, derivs=derivs,
+                precision=precision, **kwa)
+            
+        x0,x1,y0,y1 = self._getPointSourceExtent(px, py, 0., extent, radius,
+                                                 clip=False)
+        return self.mog.evaluate_grid(x0, x1, y0, y1, px, py,
+                                      precision=precision)
+
+    def _getPointSourceExtent(self, px, py, minval, extent, radius,
+                              clip=True):
+        '''
+        Returns the [x0,x1,y0,y1] box to render a point source at
+        (px,py) in, clipped to *extent*; or None if it is empty (and
+        *clip*).
+        '''
+        if minval > 0.:
             if radius is not None:
                 rr = radius
             elif self.radius is not None:
@@ -353,39 +587,16 @@ class GaussianMixturePSF(ParamList, ducks.ImageCalibration):
                     if r2 > 0:
                         r = max(r, np.sqrt(r2))
                 rr = int(np.ceil(r))
+        elif radius is None:
+            rr = self.getRadius()
+        else:
+            rr = radius
 
-            x0 = int(np.floor(px - rr))
-            x1 = int(np.ceil (px + rr)) + 1
-            y0 = int(np.floor(py - rr))
-            y1 = int(np.ceil (py + rr)) + 1
-
-            if extent is not None:
-                [xl,xh,yl,yh] = extent
-                # clip
-                x0 = max(x0, xl)
-                x1 = min(x1, xh)
-                y0 = max(y0, yl)
-                y1 = min(y1, yh)
-
-            if x0 >= x1:
-                return None
-            if y0 >= y1:
-                return None
-
-            kwa = {}
-            if minradius is not None:
-                kwa['minradius'] = minradius
-            
-            return self.mog.evaluate_grid_approx3(
-                x0, x1, y0, y1, px, py, minval, derivs=derivs, **kwa)
-            
+        x0 = int(np.floor(px - rr))
+        x1 = int(np.ceil (px + rr)) + 1
+        y0 = int(np.floor(py - rr))
+        y1 = int(np.ceil (py + rr)) + 1
 
-        if radius is None:
-            r = self.getRadius()
-        else:
-            r = radius
-        x0,x1 = int(np.floor(px-r)), int(np.ceil(px+r)) + 1
-        y0,y1 = int(np.floor(py-r)), int(np.ceil(py+r)) + 1
         if extent is not None:
             [xl,xh,yl,yh] = extent
             # clip
@@ -393,7 +604,55 @@ class GaussianMixturePSF(ParamList, ducks.ImageCalibration):
             x1 = min(x1, xh)
             y0 = max(y0, yl)
             y1 = min(y1, yh)
-        return self.mog.evaluate_grid(x0, x1, y0, y1, px, py)
+
+        if clip and (x0 >= x1 or y0 >= y1):
+            return None
+        return [x0,x1,y0,y1]
+
+    def getPointSourcePatches(self, pxy, minvals=None, extent=None,
+                              radius=None, scales=None, result=None):
+        '''
+        Renders point sources at N pixel positions *pxy* with a single
+        call into the C extension; see
+        MixtureOfGaussians.evaluate_grid_batch.
+
+        minvals: None or N values, as the *minval* argument of
+            getPointSourcePatch.
+        scales: None or N fluxes (the *minvals* are in unit-flux
+            units, as usual).
+        result: if not None, an image into which the point sources
+            are added (and which is returned); *extent* should then
+            be its bounds.
+
+        Otherwise, returns a list of N Patches, with None for sources
+        outside *extent*.
+        '''
+        N = len(pxy)
+        if minvals is None:
+            minvals = np.zeros(N)
+        if scales is None:
+            scales = np.ones(N)
+        keep = []
+        exts = []
+        for i,((px,py),mv) in enumerate(zip(pxy, minvals)):
+            ext = self._getPointSourceExtent(px, py, mv, extent, radius)
+            if ext is None:
+                continue
+            keep.append(i)
+            exts.append(ext)
+        keep = np.array(keep, int)
+        pxy = np.asarray(pxy, float).reshape((N,2))[keep]
+        scales = np.asarray(scales, float)[keep]
+        minvals = np.asarray(minvals, float)[keep] * scales
+        patches = mp.MixtureOfGaussians.evaluate_grid_batch(
+            [self.mog] * len(keep), pxy, exts, minvals=minvals,
+            scales=scales, result=result)
+        if result is not None:
+            return result
+        allpatches = [None] * N
+        for i,p in zip(keep, patches):
+            allpatches[i] = p
+        return allpatches
 
     def __str__(self):
         return (
@@ -710,12 +969,11 @@ class NCircularGaussianPSF(MultiParams, ducks.ImageCalibration):
 
     def getMixtureOfGaussians(self, px=None, py=None):
         K = len(self.myweights)
-        amps = np.array(self.myweights)
+        amps = np.array(self.myweights, dtype=float)
         means = np.zeros((K,2))
         vars = np.zeros((K,2,2))
-        for k in range(K):
-            vars[k,0,0] = vars[k,1,1] = self.mysigmas[k]**2
-        return mp.MixtureOfGaussians(amps, means, vars)
+        vars[:,0,0] = vars[:,1,1] = np.array(self.mysigmas, dtype=float)**2
+        return mp.MixtureOfGaussians.trusted(amps, means, vars)
         
     def hashkey(self):
         hk = ('NCircularGaussianPSF', tuple(self.sigmas), tuple(self.weights))
@@ -746,7 +1004,8 @@ class NCircularGaussianPSF(MultiParams, ducks.ImageCalibration):
 
     # returns a Patch object.
     def getPointSourcePatch(self, px, py, minval=0., radius=None,
-                            modelMask=None, extent=None, **kwargs):
+                            modelMask=None, extent=None, precision='double',
+                            **kwargs):
         ## FIXME!
         assert(modelMask is None)
 
@@ -766,4 +1025,5 @@ class NCircularGaussianPSF(MultiParams, ducks.ImageCalibration):
         mix = self.getMixtureOfGaussians()
         mix.mean[:,0] += px
         mix.mean[:,1] += py
-        return mp.mixture_to_patch(mix, x0, x1, y0, y1, minval=minval)
+        return mp.mixture_to_patch(mix, x0, x1, y0, y1, minval=minval,
+                                   precision=precision)
@@ -6,16 +6,21 @@ from .basics import *
 from .utils import *
 from . import mixture_profiles as mp
 from . import ducks
+from .cache import SpatialCache, SpatialCacheMixin
 
 from astrometry.util.fits import fits_table
 
-class VaryingGaussianPSF(MultiParams, ducks.ImageCalibration):
+class VaryingGaussianPSF(MultiParams, SpatialCacheMixin, ducks.ImageCalibration):
     '''
     A mixture-of-Gaussians (MoG) PSF with spatial variation,
     represented as a spline(x,y) in each of the MoG parameters.
 
     This is a base class -- subclassers must implement "instantiateAt"
+
+    psfAt results can be cached with `setSpatialCache`.
     '''
+    spatialCachedMethod = '_psfAt'
+
     def __init__(self, W, H, nx=11, ny=11, K=3, psfClass=GaussianMixturePSF):
         '''
         W,H: image size (for the image where this PSF lives)
@@ -81,6 +86,9 @@ class VaryingGaussianPSF(MultiParams, ducks.ImageCalibration):
         '''
         Returns a PSF model at the given pixel position (x, y)
         '''
+        return self._spatialCached(self._psfAt, x, y)
+
+    def _psfAt(self, x, y):
         #print('VaryingGaussianPSF: at', x,y)
         params = self.psfParamsAt(x, y)
         return self.psfclass(*params)
@@ -191,6 +199,12 @@ class PsfExModel(object):
             self.radius = (bh+1)/2.
             self.x0,self.y0 = x0,y0
 
+    # For pickling: drop the resampled bases.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_nativebases', None)
+        return state
+
     def writeto(self, fn):
         from astrometry.util.fits import fits_table
         import fitsio
@@ -249,33 +263,76 @@ class PsfExModel(object):
         return self.psfbases
 
     def polynomials(self, x, y, powers=False):
+        if not powers:
+            return self.polynomials_many(x, y)[0]
         dx = (x - self.x0) / self.xscale
         dy = (y - self.y0) / self.yscale
-        nb,h,w = self.psfbases.shape
-        terms = np.zeros(nb)
-
-        if powers:
-            xpows = np.zeros(nb, int)
-            ypows = np.zeros(nb, int)
+        xpows,ypows = self._polynomialPowers()
+        terms = dx**xpows * dy**ypows
+        return (terms, xpows, ypows)
 
+    def _polynomialPowers(self):
+        '''
+        Returns (xpows, ypows), the powers of x and y in each
+        polynomial term, in PsfEx order.
+        '''
+        nb,h,w = self.psfbases.shape
+        xpows = np.zeros(nb, int)
+        ypows = np.zeros(nb, int)
         for d in range(self.degree + 1):
             # x polynomial degree = j
             # y polynomial degree = k
             for j in range(d+1):
                 k = d - j
-                amp = dx**j * dy**k
                 # PSFEx manual pg. 111 ?
                 ii = j + (self.degree+1) * k - (k * (k-1))/ 2
-                #print('getPolynomialTerms: j=', j, 'k=', k, 'd=', d, 'ii=', ii)
                 # It goes: order 0, order 1, order 2, ...
                 # and then j=0, j=1, ...
-                terms[ii] = amp
-                if powers:
-                    xpows[ii] = j
-                    ypows[ii] = k
-        if powers:
-            return (terms, xpows, ypows)
-        return terms
+                xpows[ii] = j
+                ypows[ii] = k
+        return xpows, ypows
+
+    def polynomials_many(self, x, y):
+        '''
+        Returns the (N x nbases) array of polynomial terms at pixel
+        coordinates *x*, *y* (scalars or length-N arrays).
+        '''
+        dx = (np.atleast_1d(x).astype(float) - self.x0) / self.xscale
+        dy = (np.atleast_1d(y).astype(float) - self.y0) / self.yscale
+        xpows,ypows = self._polynomialPowers()
+        return (dx[:,np.newaxis]**xpows[np.newaxis,:] *
+                dy[:,np.newaxis]**ypows[np.newaxis,:])
+
+    def _nativeBases(self):
+        '''
+        Returns the bases resampled to the native pixel scale.
+
+        The resampling is linear, so resampling the bases once is
+        equivalent to resampling each PSF instantiated from them.
+        '''
+        cached = getattr(self, '_nativebases', None)
+        if (cached is not None and cached[0] is self.psfbases and
+            cached[1] == self.sampling):
+            return cached[2]
+        from scipy.ndimage.interpolation import affine_transform
+        nb,ny,nx = self.psfbases.shape
+        bases = np.array([affine_transform(base, [1./self.sampling]*2,
+                                           offset=nx/2 * (self.sampling - 1.))
+                          for base in self.psfbases])
+        self._nativebases = (self.psfbases, self.sampling, bases)
+        return bases
+
+    def at_many(self, x, y, nativeScale=True):
+        '''
+        Returns an (N x H x W) stack of images of the PSF at pixel
+        coordinates *x*, *y* (length-N arrays); the vectorized
+        equivalent of calling `at` at each position.
+        '''
+        if nativeScale and self.sampling != 1:
+            bases = self._nativeBases()
+        else:
+            bases = self.psfbases
+        return np.tensordot(self.polynomials_many(x, y), bases, axes=1)
 
     def fft_at(self, x, y):
         pass
@@ -381,7 +438,15 @@ class PsfExModel(object):
         
 
 
-class PixelizedPsfEx(PixelizedPSF):
+class PixelizedPsfEx(PixelizedPSF, SpatialCacheMixin):
+    '''
+    A PixelizedPSF whose image varies over the image as given by a
+    PsfEx model.
+
+    getImage results can be cached with `setSpatialCache`.
+    '''
+    spatialCachedMethod = '_getImage'
+
     def __init__(self, fn, ext=1, psfexmodel=PsfExModel, psfex=None):
         if fn is not None:
             self.psfex = psfexmodel(fn=fn, ext=ext)
@@ -398,6 +463,42 @@ class PixelizedPsfEx(PixelizedPSF):
     def __str__(self):
         return 'PixelizedPsfEx'
 
+    # summed FFTs, by FFT size and position cell; see setFourierCache
+    fftsumcache = None
+
+    def clear_cache(self):
+        super(PixelizedPsfEx, self).clear_cache()
+        if self.fftsumcache is not None:
+            self.fftsumcache.clear()
+
+    def setFourierCache(self, rounding=16, maxbytes=64*1024*1024):
+        '''
+        Makes getFourierTransform return the FFT of the PSF at the
+        center of the *rounding* x *rounding*-pixel cell containing the
+        requested position, keeping the summed FFTs in a
+        `SpatialCache` of at most *maxbytes*, so that galaxies in the
+        same region of the image share one PSF FFT.  *rounding* = 0
+        turns this off.
+
+        The cache's hits and misses are reported by
+        `getFourierCacheStats`.
+        '''
+        if rounding:
+            self.fftsumcache = SpatialCache(rounding=rounding,
+                                            maxbytes=maxbytes,
+                                            maxsize=1000000)
+        else:
+            self.fftsumcache = None
+
+    def getFourierCacheStats(self):
+        '''
+        Returns (hits, misses, number of entries, bytes held) for the
+        cache of summed FFTs (see `setFourierCache`), or None.
+        '''
+        if self.fftsumcache is None:
+            return None
+        return self.fftsumcache.stats()
+
     def hashkey(self):
         return ('PixelizedPsfEx', self.fn, self.ext)
 
@@ -409,6 +510,14 @@ class PixelizedPsfEx(PixelizedPSF):
     def getShifted(self, dx, dy):
         psfex = self.psfex.shifted(dx, dy)
         s = self.__class__(None, psfex=psfex)
+        # the caches are keyed in the model frame, so they are shared.
+        s.spatialcache = self.spatialcache
+        s.fftsumcache = self.fftsumcache
+        # the bases are not shifted, so the sub-pixel library is shared.
+        if self.subpixel:
+            for k in ['subpixel', 'subpixelmaxbytes', 'subpixelerror',
+                      'sublibrary']:
+                setattr(s, k, getattr(self, k))
         return s
 
     def shift(self, dx, dy):
@@ -420,6 +529,7 @@ class PixelizedPsfEx(PixelizedPSF):
         None
         '''
         self.psfex.shift(dx, dy)
+        self.bumpVersion()
 
     def constantPsfAt(self, x, y):
         pix = self.psfex.at(x, y)
@@ -429,13 +539,36 @@ class PixelizedPsfEx(PixelizedPSF):
         return self.radius
 
     def getImage(self, px, py):
+        return self._spatialCached(self._getImage, px, py)
+
+    def _getImage(self, px, py):
         return self.psfex.at(px, py)
 
+    def _spatialCacheOrigin(self):
+        # The model's origin moves with shift()
+        return (self.psfex.x0, self.psfex.y0)
+
     # getPointSourcePatch is inherited from PixelizedPSF
 
+    def _getSubpixelBases(self):
+        return self.psfex.bases()
+
+    def _getSubpixelWeights(self, px, py):
+        # The library holds shifted bases at the native sampling only.
+        if self.psfex.sampling != 1:
+            return None
+        return self.psfex.polynomials(px, py)
+
     def getFourierTransform(self, px, py, radius):
         sz = self.getFourierTransformSize(radius)
-
+        if self.fftsumcache is None:
+            return self._getFourierTransform(px, py, sz)
+        return self.fftsumcache(
+            lambda x,y: self._getFourierTransform(x, y, sz), px, py,
+            origin=self._spatialCacheOrigin(),
+            key=('_getFourierTransform', sz))
+
+    def _getFourierTransform(self, px, py, sz):
         if sz in self.fftcache:
             fftbases,cx,cy,shape,v,w = self.fftcache[sz]
         else:
@@ -645,35 +778,16 @@ class CachingPsfEx(PsfEx):
         return c
 
     def __init__(self, *args, **kwargs):
-        from tractor.cache import Cache
         rounding = kwargs.pop('rounding', 100)
         super(CachingPsfEx, self).__init__(*args, **kwargs)
-        self.cache = Cache(maxsize=100)
         # round pixel coordinates to the nearest...
         self.rounding = rounding
+        self.setSpatialCache(rounding=rounding, maxsize=100)
 
     def __str__(self):
         return '%s: rounding %i, %s' % (getClassName(self), self.rounding,
                                         super(CachingPsfEx, self).__str__())
 
-    # For pickling
-    def __getstate__(self):
-        self.cache.clear()
-        return self.__dict__
-
-    def psfAt(self, x, y):
-        # Center of rounding cell:
-        cx = int(x / self.rounding) * self.rounding + self.rounding/2
-        cy = int(y / self.rounding) * self.rounding + self.rounding/2
-        key = (cx,cy)
-        mog = self.cache.get(key, None)
-        if mog is not None:
-            return mog
-        mog = super(CachingPsfEx, self).psfAt(cx, cy)
-        #print 'CachingPsf: getting PSF at', cx,cy, '->', mog
-        self.cache.put(key, mog)
-        return mog
-    
 # class PixelizedPsfEx(PsfEx):
 #     def getPointSourcePatch(self, px, py, minval=0., extent=None):
 #         pix = self.instantiateAt(px, py, nativeScale=True)
@@ -1179,6 +1179,7 @@ class SdssMagsPhotoCal(BaseParams):
     def setParam(self, i, p):
         assert(i == 0)
         self.aa = p
+        self.bumpVersion()
 
     def getParamNames(self):
         return ['aa']
@@ -1319,6 +1320,7 @@ class SdssWcs(ParamList):
     def setX0Y0(self, x0, y0):
         self.x0 = x0
         self.y0 = y0
+        self.bumpVersion()
 
     # This function is not used by the tractor, and it works in
     # *original* pixel coords (no x0,y0 offsets)
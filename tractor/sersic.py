@@ -30,6 +30,18 @@ class SersicMixture(object):
             SersicMixture.singleton = SersicMixture()
         return SersicMixture.singleton._getProfile(sindex)
 
+    @staticmethod
+    def getProfileDerivatives(sindex):
+        '''
+        Returns (mix, damps, dvars): the profile at Sersic index
+        *sindex*, and the derivatives of its (normalized) component
+        amplitudes and (isotropic) variances with respect to the
+        index, each shape (K,).
+        '''
+        if SersicMixture.singleton is None:
+            SersicMixture.singleton = SersicMixture()
+        return SersicMixture.singleton._getProfileDerivatives(sindex)
+
     
     def __init__(self):
 
@@ -291,12 +303,64 @@ class SersicMixture(object):
             InterpolatedUnivariateSpline(
                 inds, [vars[i] for index,amps,vars in self.fits])
             for i in range(N)]
-            
+
+        # Tabulate the splines and their derivatives on a fine grid;
+        # cubic Hermite interpolation in the table reproduces the
+        # (piecewise cubic) splines, whose knots are on the grid.
+        self.tablestep = 0.01
+        self.tablemin = inds[0]
+        nn = self.tablemin + self.tablestep * np.arange(
+            int(np.round((inds[-1] - inds[0]) / self.tablestep)) + 1)
+        # shape (len(nn), 2, N): amps, vars
+        self.table = np.array([[f(nn) for f in self.amps],
+                               [f(nn) for f in self.vars]]).transpose(2,0,1)
+        self.dtable = np.array([[f(nn, 1) for f in self.amps],
+                                [f(nn, 1) for f in self.vars]]
+                               ).transpose(2,0,1)
+
+    def _lookup(self, sindex):
+        '''
+        Returns (vals, dvals): arrays of shape (2,N), the (unnormalized)
+        amplitudes and variances at *sindex*, and their derivatives
+        with respect to it.
+        '''
+        x = (sindex - self.tablemin) / self.tablestep
+        n = len(self.table)
+        if not (x >= 0 and x <= n-1):
+            # extrapolate (or NaN)
+            vals = np.array([[f(sindex) for f in fs]
+                             for fs in (self.amps, self.vars)])
+            dvals = np.array([[f(sindex, 1) for f in fs]
+                              for fs in (self.amps, self.vars)])
+            return vals, dvals
+        i = min(int(x), n-2)
+        t = x - i
+        f0,f1 = self.table[i], self.table[i+1]
+        d0,d1 = self.dtable[i] * self.tablestep, self.dtable[i+1] * self.tablestep
+        t2 = t*t
+        t3 = t2*t
+        vals = ((2.*t3 - 3.*t2 + 1.) * f0 + (t3 - 2.*t2 + t) * d0 +
+                (3.*t2 - 2.*t3) * f1 + (t3 - t2) * d1)
+        dvals = ((6.*t2 - 6.*t) * (f0 - f1) + (3.*t2 - 4.*t + 1.) * d0 +
+                 (3.*t2 - 2.*t) * d1) / self.tablestep
+        return vals, dvals
+
     def _getProfile(self, sindex):
-        amps = np.array([f(sindex) for f in self.amps])
-        vars = np.array([f(sindex) for f in self.vars])
-        amps /= amps.sum()
-        return mp.MixtureOfGaussians(amps, np.zeros((len(amps),2)), vars)
+        (amps,vars),nil = self._lookup(sindex)
+        return self._mixture(amps / amps.sum(), vars)
+
+    def _mixture(self, amps, vars):
+        return mp.MixtureOfGaussians.trusted(
+            amps, np.zeros((len(amps),2)),
+            vars[:,np.newaxis,np.newaxis] * np.eye(2))
+
+    def _getProfileDerivatives(self, sindex):
+        (amps,vars),(damps,dvars) = self._lookup(sindex)
+        # normalize: d(a/S) = (da - (a/S) dS) / S
+        S = amps.sum()
+        amps = amps / S
+        damps = (damps - amps * damps.sum()) / S
+        return self._mixture(amps, vars), damps, dvars
 
 class SersicIndex(ScalarParam):
     stepsize = 0.01
@@ -326,18 +390,34 @@ class SersicGalaxy(HoggGalaxy):
     def getProfile(self):
         return SersicMixture.getProfile(self.sersicindex.val)
 
+    def _getProfileDerivatives(self):
+        if self.isParamFrozen('sersicindex'):
+            return self.getProfile(), []
+        mix,damps,dvars = SersicMixture.getProfileDerivatives(
+            self.sersicindex.val)
+        dvar = np.zeros((mix.K, 2, 2))
+        dvar[:,0,0] = dvar[:,1,1] = dvars
+        name = self.sersicindex.getParamNames()[0]
+        return mix, [(name, damps, dvar)]
+
     def copy(self):
         return SersicGalaxy(self.pos.copy(), self.brightness.copy(),
                             self.shape.copy(), self.sersicindex.copy())
     
     def _getUnitFluxDeps(self, img, px, py):
         return hash(('unitpatch', self.getName(), px, py,
-                     img.getWcs().hashkey(),
-                     img.getPsf().hashkey(),
+                     img.getWcs().versionkey(),
+                     img.getPsf().versionkey(),
                      self.shape.hashkey(),
                      self.sersicindex.hashkey()))
 
     def getParamDerivatives(self, img, modelMask=None):
+        if self._getAnalyticDerivsMode(img) is not None:
+            # the Sersic index derivative is chained through the
+            # profile (see _getProfileDerivatives)
+            return super(SersicGalaxy, self).getParamDerivatives(
+                img, modelMask=modelMask)
+
         # superclass produces derivatives wrt pos, brightness, and shape.
         derivs = super(SersicGalaxy, self).getParamDerivatives(img, modelMask=modelMask)
 
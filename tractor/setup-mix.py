@@ -1,13 +1,19 @@
+import os
 from distutils.core import setup, Extension
 from numpy.distutils.misc_util import get_numpy_include_dirs
 
 numpy_inc = get_numpy_include_dirs()
 
+# The rendering kernels use OpenMP; set NO_OPENMP=1 to build without.
+openmp = [] if os.environ.get('NO_OPENMP') else ['-fopenmp']
+
 #sources = ['mix_wrap.c' ],
 c_swig_module = Extension('_mix',
                           sources = ['mix.i'],
                           include_dirs = numpy_inc,
 						  extra_objects = [],
+                          extra_compile_args = openmp,
+                          extra_link_args = openmp,
     )
 #undef_macros=['NDEBUG'],
 #extra_compile_args=['-O0','-g'],
@@ -1,13 +1,17 @@
+import os
 from distutils.core import setup, Extension
 from numpy.distutils.misc_util import get_numpy_include_dirs
 
 numpy_inc = get_numpy_include_dirs()
 
+# The transforms use OpenMP; set NO_OPENMP=1 to build without.
+openmp = [] if os.environ.get('NO_OPENMP') else ['-fopenmp']
+
 c_swig_module = Extension('_mp_fourier',
 						  sources = ['mp_fourier_wrap.c' ],
 						  include_dirs = numpy_inc,
-                          extra_compile_args=['-g'],
-                          extra_link_args=['-g'],
+                          extra_compile_args=['-g'] + openmp,
+                          extra_link_args=['-g'] + openmp,
     )
 #extra_objects = [],
 #undef_macros=['NDEBUG'],
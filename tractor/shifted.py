@@ -1,4 +1,4 @@
-from .utils import BaseParams
+from .utils import BaseParams, _addParent
 import ducks
     
 # class SubImage(Image):
@@ -29,6 +29,11 @@ import ducks
 class ParamsWrapper(BaseParams):
     def __init__(self, real):
         self.real = real
+        # changes to "real" bump our version stamp
+        _addParent(real, self)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        _addParent(self.real, self)
     def hashkey(self):
         return self.real.hashkey()
     def getLogPrior(self):
@@ -41,6 +41,7 @@ class ConstantSky(ScalarParam, ducks.ImageCalibration):
         Scales this sky model by a factor of *s*.
         '''
         self.val *= s
+        self.bumpVersion()
 
     def shift(self, x0,y0):
         pass
@@ -0,0 +1,128 @@
+'''
+This file is part of the Tractor project.
+Licensed under the GPLv2; see the file COPYING for details.
+
+`sourceindex.py`
+===========
+
+A grid-bucket spatial index of (source) pixel bounding boxes, for
+answering "which sources touch this region of this image" without
+scanning the whole catalog.  See `Tractor.getSourceIndex`.
+'''
+from __future__ import print_function
+
+class SourceIndex(object):
+    '''
+    Spatial index of [x0, x1, y0, y1) boxes within a W x H image.
+
+    The image is divided into square cells of *cellsize* pixels; each
+    cell holds the keys of the boxes that touch it, so box and point
+    queries only look at the boxes in the cells they touch.
+
+    Each entry has a *key* (eg, id(source)), an *obj* that is returned
+    by queries, its *box*, and a *stamp* that the owner can use to
+    decide whether the entry is stale.
+    '''
+    def __init__(self, W, H, cellsize=64):
+        self.W = W
+        self.H = H
+        self.cellsize = cellsize
+        self.nx = max(1, (W + cellsize - 1) // cellsize)
+        self.ny = max(1, (H + cellsize - 1) // cellsize)
+        self.cells = [set() for i in range(self.nx * self.ny)]
+        # key -> (obj, box, stamp)
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _cellrange(self, x0, x1, y0, y1):
+        # cells touched by the box, or None
+        x0,y0 = max(x0, 0), max(y0, 0)
+        x1,y1 = min(x1, self.W), min(y1, self.H)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        cs = self.cellsize
+        return (int(x0) // cs, (int(x1) - 1) // cs,
+                int(y0) // cs, (int(y1) - 1) // cs)
+
+    def _cells(self, box):
+        r = self._cellrange(*box)
+        if r is None:
+            return []
+        cx0,cx1,cy0,cy1 = r
+        return [cy * self.nx + cx for cy in range(cy0, cy1+1)
+                for cx in range(cx0, cx1+1)]
+
+    def insert(self, key, obj, box, stamp=None):
+        '''
+        Adds (or replaces) an entry; *box* may be None for objects
+        that do not touch the image.
+        '''
+        self.remove(key)
+        self.entries[key] = (obj, box, stamp)
+        if box is None:
+            return
+        for c in self._cells(box):
+            self.cells[c].add(key)
+
+    def remove(self, key):
+        e = self.entries.pop(key, None)
+        if e is None or e[1] is None:
+            return
+        for c in self._cells(e[1]):
+            self.cells[c].discard(key)
+
+    def get(self, key):
+        '''
+        Returns the (obj, box, stamp) entry for *key*, or None.
+        '''
+        return self.entries.get(key)
+
+    def getBox(self, key):
+        e = self.entries.get(key)
+        if e is None:
+            return None
+        return e[1]
+
+    def keys(self):
+        return self.entries.keys()
+
+    def queryBox(self, x0, x1, y0, y1):
+        '''
+        Returns the keys of entries whose boxes overlap [x0, x1) x [y0, y1).
+        '''
+        r = self._cellrange(x0, x1, y0, y1)
+        if r is None:
+            return []
+        cx0,cx1,cy0,cy1 = r
+        keys = set()
+        for cy in range(cy0, cy1+1):
+            for cx in range(cx0, cx1+1):
+                keys.update(self.cells[cy * self.nx + cx])
+        res = []
+        for k in keys:
+            bx0,bx1,by0,by1 = self.entries[k][1]
+            if bx0 < x1 and x0 < bx1 and by0 < y1 and y0 < by1:
+                res.append(k)
+        return res
+
+    def queryPoint(self, x, y):
+        '''
+        Returns the keys of entries whose boxes contain pixel (x, y).
+        '''
+        x,y = int(x // 1), int(y // 1)
+        return self.queryBox(x, x+1, y, y+1)
+
+    def queryKey(self, key):
+        '''
+        Returns the keys of the other entries whose boxes overlap
+        that of *key*.
+        '''
+        box = self.getBox(key)
+        if box is None:
+            return []
+        return [k for k in self.queryBox(*box) if k != key]
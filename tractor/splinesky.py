@@ -5,6 +5,9 @@ from utils import *
 import ducks
 
 class SplineSky(ParamList, ducks.ImageCalibration):
+    # self.vals is the spline's coefficient list (and is re-assigned),
+    # so it can't be replaced by a view into packed storage.
+    packable = False
 
     @staticmethod
     def BlantonMethod(image, mask, gridsize):
@@ -69,6 +72,7 @@ class SplineSky(ParamList, ducks.ImageCalibration):
     def shift(self, x0,y0):
         self.x0 += x0
         self.y0 += y0
+        self.bumpVersion()
 
     def shifted(self, x0, y0):
         s = self.copy()
@@ -81,6 +85,7 @@ class SplineSky(ParamList, ducks.ImageCalibration):
         c = [ci + dsky for ci in c]
         self.spl.tck = (tx, ty, c)
         self.vals = c
+        self.bumpVersion()
         #sky1 = self.spl(0,0)
         #print('Offset sky by', dsky, ':', sky0, 'to', sky1)
 
@@ -92,6 +97,7 @@ class SplineSky(ParamList, ducks.ImageCalibration):
         (tx,ty,c) = self.spl.tck
         c *= s
         self.vals = c
+        self.bumpVersion()
         sky1 = self.spl(0,0)
         #print('Scaled sky:', sky0, 'x', s, '=', sky0*s, 'vs', sky1)
 
@@ -12,6 +12,9 @@ could be useful outside the Tractor context.
 
 """
 from __future__ import print_function
+import itertools
+import weakref
+
 import numpy as np
 
 try:
@@ -178,9 +181,110 @@ class GaussianPriorsMixin(object):
     def getGaussianLogPrior(self):
         return self.gpriors.getLogPrior(param=self)
 
+# Source of modification stamps for Params objects; see
+# BaseParams.getVersion().  Stamps are globally increasing, so a stamp
+# is never reused, even by a new object that happens to get the same id().
+_version_counter = itertools.count(1)
+
+class _ParamsVersion(object):
+    '''
+    The modification stamp of a Params object, plus weak references
+    to the Params objects that contain it (its "parents"), which get
+    stamped too when it changes.
+
+    This is deliberately neither pickled nor shared between copies:
+    an unpickled (or copied) object gets a fresh stamp, and its
+    container re-registers itself as a parent.
+    '''
+    def __init__(self, owner=None):
+        self.owner = None
+        if owner is not None:
+            self.owner = weakref.ref(owner)
+        self.version = next(_version_counter)
+        self.parents = []
+
+    def __reduce__(self):
+        return (_ParamsVersion, ())
+
+    def addParent(self, parent):
+        refs = []
+        for r in self.parents:
+            p = r()
+            if p is None:
+                continue
+            if p is parent:
+                return
+            refs.append(r)
+        refs.append(weakref.ref(parent))
+        self.parents = refs
+
+    def removeParent(self, parent):
+        refs = []
+        for r in self.parents:
+            p = r()
+            if p is None or p is parent:
+                continue
+            refs.append(r)
+        self.parents = refs
+
+    def stamp(self, version):
+        # Iterative, since parents can be shared (eg, an Image in two
+        # Tractors); skip any already stamped.
+        todo = [self]
+        while len(todo):
+            pv = todo.pop()
+            pv.version = version
+            for r in pv.parents:
+                p = r()
+                if p is None:
+                    continue
+                ppv = p._getParamsVersion()
+                if ppv.version < version:
+                    todo.append(ppv)
+
+def _addParent(child, parent):
+    '''
+    Registers *parent* as a container of *child*, so that changes to
+    *child* update the version stamp of *parent*.  Children that are
+    not BaseParams (eg, None or other duck types) are ignored.
+    '''
+    if isinstance(child, BaseParams):
+        child._getParamsVersion().addParent(parent)
+
+def _removeParent(child, parent):
+    if isinstance(child, BaseParams):
+        child._getParamsVersion().removeParent(parent)
+
+# Incremented whenever the "shape" of a packed Params tree changes:
+# params frozen or thawed, or sub-Params added, removed or replaced.
+# Used to invalidate PackedParams layouts.
+_layout_epoch = [0]
+
+def _layoutChanged(obj=None):
+    '''
+    Records a change in the layout of *obj*'s params; only objects
+    that are part of a PackedParams layout (or None: unconditionally)
+    count.
+    '''
+    if obj is not None and not obj.__dict__.get('_packed', False):
+        return
+    _layout_epoch[0] += 1
+
+def _contains(lst, x):
+    # "x in lst", by identity (ScalarParam.__eq__ compares values)
+    for y in lst:
+        if y is x:
+            return True
+    return False
+
 class BaseParams(object):
     '''
     A basic implementation of the `Params` duck type.
+
+    BaseParams objects also carry a modification stamp (see
+    `getVersion`), which is bumped whenever their parameters are set,
+    and propagated to the Params objects that contain them, allowing
+    caches to use cheap integer keys rather than `hashkey()`.
     '''
     def __repr__(self):
         return getClassName(self) + repr(self.getParams())
@@ -195,6 +299,46 @@ class BaseParams(object):
     #def __eq__(self, other):
     #    return hash(self.hashkey()) == hash(other.hashkey())
 
+    def _getParamsVersion(self):
+        pv = self.__dict__.get('_paramsversion', None)
+        if pv is None or pv.owner is None or pv.owner() is not self:
+            pv = _ParamsVersion(self)
+            self._paramsversion = pv
+        return pv
+
+    def getVersion(self):
+        '''
+        Returns the modification stamp of this object: an integer that
+        increases whenever parameters of this object -- or any of its
+        sub-Params -- are set.  O(1).
+        '''
+        return self._getParamsVersion().version
+
+    def changedSince(self, version):
+        '''
+        Returns True if this object (or any of its sub-Params) has
+        been modified since *version* was returned by `getVersion()`.
+        '''
+        return self.getVersion() > version
+
+    def bumpVersion(self):
+        '''
+        Records that this object has been modified, updating the
+        modification stamps of it and its containers.  The Params
+        classes here call this from setParam(), setParams(), etc;
+        subclasses that change their state by other means must call
+        it themselves.
+        '''
+        self._getParamsVersion().stamp(next(_version_counter))
+
+    def versionkey(self):
+        '''
+        Returns a cheap cache key for the current state of this
+        object; an alternative to `hashkey()` that does not depend on
+        parameter values.
+        '''
+        return (id(self), self.getVersion())
+
     def getParamNames(self):
         ''' Returns a list containing the names of the parameters. '''
         return []
@@ -315,6 +459,7 @@ class ScalarParam(BaseParams):
         return oldval
     def _set(self, val):
         self.val = val
+        self.bumpVersion()
     def getValue(self):
         return self.val
     def setValue(self, v):
@@ -448,7 +593,9 @@ class NamedParams(object):
     def _getNamedThing(self, nm):
         return self._getThing(self.namedparams[nm])
     def _setNamedThing(self, nm, v):
-        return self._setThing(self.namedparams[nm], v)
+        rtn = self._setThing(self.namedparams[nm], v)
+        self.bumpVersion()
+        return rtn
 
     def _iterNamesAndVals(self):
         '''
@@ -480,6 +627,7 @@ class NamedParams(object):
             if i is None:
                 continue
             self.liquid[i] = False
+            _layoutChanged(self)
         if '*' in pnames:
             self.freezeAllParams()
 
@@ -489,6 +637,7 @@ class NamedParams(object):
             if i is None:
                 continue
             self.liquid[i] = True
+            _layoutChanged(self)
         if '*' in pnames:
             self.thawAllParams()
         
@@ -502,6 +651,7 @@ class NamedParams(object):
             i = self.getNamedParamIndex(paramname)
             assert(i is not None)
         self.liquid[i] = False
+        _layoutChanged(self)
     def freezeAllBut(self, *args):
         self.freezeAllParams()
         self.thawParams(*args)
@@ -516,6 +666,7 @@ class NamedParams(object):
             if i is None:
                 continue
             self.liquid[i] = True
+            _layoutChanged(self)
             thawed = True
         return thawed
 
@@ -530,17 +681,20 @@ class NamedParams(object):
             i = self._getThings().index(paramname)
             
         self.liquid[i] = True
+        _layoutChanged(self)
     def thawParams(self, *args):
         for n in args:
             self.thawParam(n)
     def thawAllParams(self):
         self.liquid[:] = [True]*len(self.liquid)
+        _layoutChanged(self)
     unfreezeParam = thawParam
     unfreezeParams = thawParams
     unfreezeAllParams = thawAllParams
     
     def freezeAllParams(self):
         self.liquid[:] = [False]*len(self.liquid)
+        _layoutChanged(self)
     def getFrozenParams(self):
         return [self.getNamedParamName(i) for i in self.getFrozenParamIndices()]
     def getThawedParams(self):
@@ -633,6 +787,10 @@ class ParamList(GaussianPriorsMixin, NamedParams, BaseParams):
     '''
     An implementation of Params that holds values in a list.
     '''
+    # Can self.vals be replaced by a view into a PackedParams buffer?
+    # Subclasses that re-assign self.vals must set this False.
+    packable = True
+
     def __init__(self, *args):
         self.vals = list(args)
         self.lowers = [None for v in self.vals]
@@ -684,10 +842,12 @@ class ParamList(GaussianPriorsMixin, NamedParams, BaseParams):
         ii = self._indexLiquid(i)
         oldval = self._getThing(ii)
         self._setThing(ii, val)
+        self.bumpVersion()
         return oldval
     def setParams(self, p):
         for i,j in self._indexBoth():
             self._setThing(j, p[i])
+        self.bumpVersion()
     def numberOfParams(self):
         return self._countLiquid()
     def getParams(self):
@@ -706,6 +866,7 @@ class ParamList(GaussianPriorsMixin, NamedParams, BaseParams):
     def setAllParams(self, p):
         for i,pp in enumerate(p):
             self._setThing(i, pp)
+        self.bumpVersion()
 
     def getLowerBounds(self):
         return list(self._getLiquidArray(self.lowers))
@@ -829,6 +990,21 @@ class MultiParams(BaseParams, NamedParams):
         else:
             self.subs = []
         super(MultiParams,self).__init__()
+        self._adoptSubs()
+
+    def __setstate__(self, state):
+        # For unpickling: the parent links for version stamps are not
+        # pickled, so re-create them.
+        self.__dict__.update(state)
+        self._adoptSubs()
+
+    def _adoptSubs(self):
+        '''
+        Registers this object as the parent of its sub-Params, so that
+        their version stamps propagate to this object.
+        '''
+        for s in self.subs:
+            _addParent(s, self)
 
     def copy(self):
         x = self.__class__(*[s.copy() for s in self.subs])
@@ -839,17 +1015,31 @@ class MultiParams(BaseParams, NamedParams):
     def append(self, x):
         self.subs.append(x)
         self.liquid.append(True)
+        _addParent(x, self)
+        _layoutChanged(self)
+        self.bumpVersion()
     def prepend(self, x):
         self.subs = [x] + self.subs
         self.liquid = [True] + self.liquid
+        _addParent(x, self)
+        _layoutChanged(self)
+        self.bumpVersion()
     def extend(self, x):
         self.subs.extend(x)
         self.liquid.extend([True] * len(x))
+        for s in x:
+            _addParent(s, self)
+        _layoutChanged(self)
+        self.bumpVersion()
     def remove(self, x):
         i = self.subs.index(x)
         self.subs = self.subs[:i] + self.subs[i+1:]
         self.liquid = self.liquid[:i] + self.liquid[i+1:]
         #self.subs.remove(x)
+        if not _contains(self.subs, x):
+            _removeParent(x, self)
+        _layoutChanged(self)
+        self.bumpVersion()
     def index(self, x):
         return self.subs.index(x)
         
@@ -859,7 +1049,13 @@ class MultiParams(BaseParams, NamedParams):
     def __getitem__(self, key):
         return self.subs.__getitem__(key)
     def __setitem__(self, key, val):
-        return self.subs.__setitem__(key, val)
+        if _isint(key):
+            return self._setThing(key, val)
+        rtn = self.subs.__setitem__(key, val)
+        self._adoptSubs()
+        _layoutChanged(self)
+        self.bumpVersion()
+        return rtn
     def __iter__(self):
         return self.subs.__iter__()
 
@@ -907,7 +1103,13 @@ class MultiParams(BaseParams, NamedParams):
     # These underscored versions are for use by NamedParams(), and ignore
     # the active/inactive state.
     def _setThing(self, i, val):
+        old = self.subs[i]
         self.subs[i] = val
+        if not _contains(self.subs, old):
+            _removeParent(old, self)
+        _addParent(val, self)
+        _layoutChanged(self)
+        self.bumpVersion()
     def _getThing(self, i):
         return self.subs[i]
     def _getThings(self):
@@ -1163,3 +1365,227 @@ class NpArrayParams(ParamList):
     def __getstate__(self): return self.__dict__
     def __setstate__(self, d): self.__dict__.update(d)
 
+
+
+def _sameMethods(obj, base, names):
+    cls = obj.__class__
+    for name in names:
+        if getattr(cls, name, None) != getattr(base, name):
+            return False
+    return True
+
+class PackedParams(object):
+    '''
+    Flat, contiguous storage for the parameters of a Params tree (eg,
+    a Tractor).
+
+    Every plain ParamList leaf reachable through thawed params has its
+    *vals* list replaced by a view into one float64 numpy array, so
+    the thawed parameters of the whole tree can be read and written
+    with a single fancy-indexing operation using a precomputed index
+    array, rather than by walking the tree in Python.
+
+    Plain ScalarParams can't be viewed, so their values are gathered
+    and scattered with a list comprehension.  Other leaves (Params
+    that override the ParamList/MultiParams accessors) are
+    "mirrored": their thawed values are copied in from getParams()
+    before a read, and pushed out through setParams() after a write.
+
+    The layout is recomputed whenever params in the tree are frozen
+    or thawed, or sub-Params are added, removed or replaced (see
+    `_layoutChanged`).
+    '''
+    _paramlist_methods = ['_getThing', '_setThing', '_getThings',
+                          '_numberOfThings', 'getParams', 'setParams',
+                          'setParam', 'getAllParams', 'setAllParams']
+    _scalar_methods = ['_set', 'getParams', 'setParams', 'setParam',
+                       'numberOfParams']
+    _multiparams_methods = ['_getActiveSubs', 'getParams', 'setParams',
+                            'setParam', 'numberOfParams']
+
+    def __init__(self, root):
+        self.root = root
+        self.epoch = None
+        self.buffer = None
+        self.pack()
+
+    def isValid(self):
+        return self.epoch == _layout_epoch[0]
+
+    def _walk(self, p, leaves):
+        # Mark the objects whose freezing/thawing invalidates our layout
+        if isinstance(p, BaseParams):
+            p._packed = True
+        if (isinstance(p, MultiParams) and
+            _sameMethods(p, MultiParams, self._multiparams_methods)):
+            for s in p._getActiveSubs():
+                self._walk(s, leaves)
+            return
+        if p.numberOfParams() == 0:
+            return
+        leaves.append(p)
+
+    def _isPackable(self, p):
+        if not (isinstance(p, ParamList) and p.packable and
+                _sameMethods(p, ParamList, self._paramlist_methods)):
+            return False
+        vals = p.__dict__.get('vals', None)
+        if not isinstance(vals, (list, np.ndarray)):
+            return False
+        try:
+            np.array(vals, np.float64)
+        except (TypeError, ValueError):
+            return False
+        return True
+
+    def _isScalar(self, p):
+        return (isinstance(p, ScalarParam) and
+                _sameMethods(p, ScalarParam, self._scalar_methods) and
+                np.isscalar(p.val))
+
+    def pack(self):
+        '''
+        (Re-)computes the layout, copying the current parameter values
+        into a new buffer.
+        '''
+        leaves = []
+        self.root._packed = True
+        for s in self.root._getActiveSubs():
+            self._walk(s, leaves)
+
+        # [(leaf, offset, n)] for packed and mirrored leaves; for
+        # mirrored leaves "n" counts only the thawed params.
+        packed = []
+        scalars = []
+        mirrored = []
+        thawed = []
+        off = 0
+        for leaf in leaves:
+            if self._isPackable(leaf):
+                n = len(leaf.vals)
+                packed.append((leaf, off, n))
+                thawed.extend(off + i for i,v in enumerate(leaf.liquid) if v)
+            elif self._isScalar(leaf):
+                n = 1
+                scalars.append((leaf, off, n))
+                thawed.append(off)
+            else:
+                n = leaf.numberOfParams()
+                mirrored.append((leaf, off, n))
+                thawed.extend(range(off, off + n))
+            off += n
+
+        buf = np.zeros(off, np.float64)
+        # index into self.leaves of each buffer element (for version
+        # stamping); -1 for mirrored leaves, which stamp themselves.
+        owner = np.zeros(off, np.int32) - 1
+        self.leaves = []
+        for (leaf,o,n) in packed:
+            buf[o:o+n] = leaf.vals
+            owner[o:o+n] = len(self.leaves)
+            leaf.vals = buf[o:o+n]
+            self.leaves.append(leaf)
+        for (leaf,o,n) in scalars:
+            owner[o] = len(self.leaves)
+            self.leaves.append(leaf)
+        self.scalars = [leaf for (leaf,o,n) in scalars]
+        self.scalaridx = np.array([o for (leaf,o,n) in scalars], dtype=int)
+        # where each buffer element is a scalar: its index in self.scalars
+        self.scalarpos = np.zeros(off, int) - 1
+        self.scalarpos[self.scalaridx] = np.arange(len(self.scalars))
+        self.buffer = buf
+        self.owner = owner
+        self.packed = packed
+        self.mirrored = mirrored
+        self.thawed = np.array(thawed, dtype=int)
+        self._refresh()
+        # Packing changes the storage of leaves that may be packed
+        # elsewhere too.
+        _layoutChanged()
+        self.epoch = _layout_epoch[0]
+
+    def unpack(self):
+        '''
+        Returns the packed leaves to list storage.
+        '''
+        for (leaf,o,n) in self.packed:
+            leaf.vals = [float(v) for v in leaf.vals]
+        self.packed = []
+        self.leaves = []
+        self.scalars = []
+        self.mirrored = []
+        _layoutChanged()
+        self.epoch = None
+
+    def _refresh(self):
+        # Copies the values of the non-viewed leaves into the buffer.
+        buf = self.buffer
+        if len(self.scalars):
+            buf[self.scalaridx] = [s.val for s in self.scalars]
+        for (leaf,o,n) in self.mirrored:
+            buf[o:o+n] = leaf.getParams()
+
+    def numberOfParams(self):
+        return len(self.thawed)
+
+    def getParams(self):
+        self._refresh()
+        return self.buffer[self.thawed].tolist()
+
+    def setParams(self, p):
+        p = np.asarray(p, dtype=np.float64)
+        assert(len(p) == len(self.thawed))
+        self._refresh()
+        buf = self.buffer
+        I = self.thawed
+        changed = I[buf[I] != p]
+        if len(changed) == 0:
+            return
+        buf[I] = p
+        scalars = self.scalars
+        for i in self.scalarpos[changed]:
+            if i >= 0:
+                scalars[i].val = float(buf[self.scalaridx[i]])
+        self._stamp(changed)
+        if len(self.mirrored):
+            ch = np.zeros(len(buf), bool)
+            ch[changed] = True
+            for (leaf,o,n) in self.mirrored:
+                if np.any(ch[o:o+n]):
+                    leaf.setParams(buf[o:o+n].tolist())
+
+    def isMirrored(self, i):
+        '''
+        Is thawed parameter *i* stored in a mirrored leaf?
+        '''
+        return self.owner[self.thawed[i]] < 0
+
+    def setParam(self, i, p):
+        '''
+        Sets thawed parameter *i*, which must not be mirrored (see
+        `isMirrored`); returns the old value.
+        '''
+        j = self.thawed[i]
+        leaf = self.leaves[self.owner[j]]
+        k = self.scalarpos[j]
+        if k >= 0:
+            return leaf.setParam(0, p)
+        old = float(self.buffer[j])
+        self.buffer[j] = p
+        self._stamp([j])
+        return old
+
+    def _stamp(self, changed):
+        '''
+        Bumps the version stamps of the (non-mirrored) leaves owning
+        the given buffer elements, using a single stamp so that shared
+        containers are only stamped once.
+        '''
+        owners = self.owner[np.asarray(changed, dtype=int)]
+        owners = np.unique(owners[owners >= 0])
+        if len(owners) == 0:
+            return
+        v = next(_version_counter)
+        leaves = self.leaves
+        for i in owners:
+            leaves[i]._getParamsVersion().stamp(v)
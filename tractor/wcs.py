@@ -26,7 +26,7 @@ class NullWCS(BaseParams, ducks.WCS):
     def pixscale_at(self, x, y):
         return self.pixscale
     def shifted(self, x, y):
-        return self.copy()
+        return NullWCS(pixscale=self.pixscale, dx=self.dx - x, dy=self.dy - y)
 
 class WcslibWcs(BaseParams, ducks.ImageCalibration):
     '''
@@ -97,6 +97,7 @@ class WcslibWcs(BaseParams, ducks.ImageCalibration):
         '''
         self.x0 = x0
         self.y0 = y0
+        self.bumpVersion()
 
     def positionToPixel(self, pos, src=None):
         ok,x,y = self.wcs.radec2pixelxy(pos.ra, pos.dec)
@@ -172,6 +173,7 @@ class ConstantFitsWcs(ParamList, ducks.ImageCalibration):
         '''
         self.x0 = x0
         self.y0 = y0
+        self.bumpVersion()
 
     def positionToPixel(self, pos, src=None):
         '''
@@ -47,12 +47,42 @@ class WisePSF(VaryingGaussianPSF):
             YY = np.linspace(0, S-1, NY)
             self.fitSavedData(pp2, XX, YY)
 
+    spatialCachedMethod = '_instantiateAt'
+
+    def setSpatialCache(self, rounding=None, **kwargs):
+        '''
+        As for VaryingGaussianPSF, but *rounding* defaults to the
+        spacing of the grid of PSF stamps, so that instantiateAt's
+        cells are centered on the grid points.
+        '''
+        if rounding is None:
+            rounding = (self.W - 1) / float(self.ngrid - 1)
+        super(WisePSF, self).setSpatialCache(rounding=rounding, **kwargs)
+
+    def _spatialCacheOrigin(self):
+        r = self.spatialcache.rounding
+        return (-r/2., -r/2.)
+
+    def psfAt(self, x, y):
+        '''
+        Returns the fitted PSF model at the given pixel position (x,
+        y).  Unlike VaryingGaussianPSF, this is not cached: the
+        spatial cache is for instantiateAt, whose cells would round
+        (x, y) to the grid of PSF stamps.
+        '''
+        return self._psfAt(x, y)
+
+    mogAt = psfAt
+
     def instantiateAt(self, x, y):
         '''
         This is used during fitting.  When used afterwards, you just
         want to use the getPointSourcePatch() and similar methods
         defined in the parent class.
         '''
+        return self._spatialCached(self._instantiateAt, x, y)
+
+    def _instantiateAt(self, x, y):
         # clip to nearest grid point...
         dx = (self.W - 1) / float(self.ngrid - 1)
         gx = dx * int(np.round(x / dx))